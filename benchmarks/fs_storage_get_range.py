@@ -0,0 +1,70 @@
+"""
+Compare `FileSystemStorage` range read paths: seek+read vs memory map.
+
+Simulates a player which requests many small overlapping ranges of the same video, ranges are read
+with `get_stream` like `Range` requests to a raw video are.
+
+Usage::
+
+    python benchmarks/fs_storage_get_range.py --file-size 268435456 --requests 2000
+"""
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from videoserver.app import get_app
+from videoserver.lib.storage.file_system_storage import FileSystemStorage
+
+RANGE_SIZES = (4 * 1024, 64 * 1024, 512 * 1024, 2 * 1024 * 1024, 8 * 1024 * 1024)
+
+
+def bench(storage, storage_id, file_size, range_size, requests, seed):
+    rnd = random.Random(seed)
+    # ranges overlap like the ones sent by a player while scrubbing
+    offsets = [rnd.randrange(0, file_size - range_size) for _ in range(requests)]
+
+    started = time.perf_counter()
+    for offset in offsets:
+        # consume the whole range like a response does, so every page of a map is faulted in
+        digest = hashlib.sha1()
+        for chunk in storage.get_stream(storage_id, start=offset, length=range_size):
+            digest.update(chunk)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file-size', type=int, default=256 * 1024 * 1024, help='size of a test file in bytes')
+    parser.add_argument('--requests', type=int, default=1000, help='number of range requests per range size')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    media_path = tempfile.mkdtemp(prefix='videoserver-bench-')
+    app = get_app({'FS_MEDIA_STORAGE_PATH': media_path})
+    storage = FileSystemStorage()
+
+    try:
+        with app.app_context():
+            storage_id = storage.put(os.urandom(args.file_size), 'bench.mp4', project_id='bench')
+
+            print(f'{"range":>10} {"seek+read ms":>14} {"mmap ms":>10} {"speedup":>8}')
+            for range_size in RANGE_SIZES:
+                results = {}
+                for use_mmap in (False, True):
+                    app.config['FS_MEDIA_STORAGE_MMAP'] = use_mmap
+                    # warm up page cache and a map table
+                    bench(storage, storage_id, args.file_size, range_size, 10, args.seed)
+                    results[use_mmap] = bench(storage, storage_id, args.file_size, range_size, args.requests,
+                                              args.seed)
+                print(f'{range_size // 1024:>8}KB {results[False] * 1000:>14.1f} {results[True] * 1000:>10.1f} '
+                      f'{results[False] / results[True]:>7.2f}x')
+    finally:
+        shutil.rmtree(media_path)
+
+
+if __name__ == '__main__':
+    main()
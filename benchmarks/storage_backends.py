@@ -0,0 +1,347 @@
+"""
+Measure throughput and latency of a media storage: `put`, `get`, `get_range` (random and sequential),
+`replace`, `delete_dir` and concurrent range readers, for every file size.
+
+Results are written as JSON lines, one record per operation and file size, so runs of different backends,
+cache wrappers, layouts or releases can be compared. A human readable summary is printed to stderr.
+
+Filesystem storage runs in a temporary directory. Amazon storage needs an S3 compatible server,
+i.e. a local MinIO set by `AWS_S3_ENDPOINT_URL`, `AWS_ACCESS_KEY_ID` and `AWS_SECRET_ACCESS_KEY` env variables.
+Files bigger than `--in-memory-limit` are written with `put_stream` and read with `get_stream`,
+so multi-GB files don't have to fit into memory. Reads are served from a warm page cache.
+
+Usage::
+
+    python benchmarks/storage_backends.py --sizes 10K,1M,64M --output fs.jsonl
+    python benchmarks/storage_backends.py --sizes 10K,2G --iterations 1 --layout hash --volumes 2
+    python benchmarks/storage_backends.py --cache --memory-cache --set FS_MEDIA_STORAGE_FSYNC='"none"'
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from videoserver.app import get_app
+from videoserver.lib.storage import StorageWrapper, get_media_storage, unwrap_storage
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+#: random data is repeated, generating gigabytes of random bytes would take longer than a benchmark itself
+BLOCK_SIZE = 1024 * 1024
+
+
+def parse_size(value):
+    value = value.strip().upper()
+    if value[-1:] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f'{size // SIZE_UNITS[unit]}{unit}'
+    return str(size)
+
+
+class RandomStream:
+    """
+    File-like object which returns `size` bytes of repeated random data.
+    """
+
+    def __init__(self, block, size):
+        self.block = block
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = bytearray()
+        while len(data) < size:
+            offset = (self.position + len(data)) % len(self.block)
+            data += self.block[offset:offset + size - len(data)]
+        self.position += size
+        return bytes(data)
+
+
+def make_content(block, size):
+    return (block * (size // len(block) + 1))[:size]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def make_record(op, size, latencies, total_bytes, seconds=None, **extra):
+    """
+    Build a result record, `seconds` is a wall time for concurrent operations, sum of latencies otherwise.
+    """
+
+    if seconds is None:
+        seconds = sum(latencies)
+    record = {
+        'op': op,
+        'size': size,
+        'ops': len(latencies),
+        'bytes': total_bytes,
+        'seconds': round(seconds, 6),
+        'ops_per_sec': round(len(latencies) / seconds, 2) if seconds else None,
+        'mb_per_sec': round(total_bytes / seconds / 1024 / 1024, 2) if seconds else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0,
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p95': round(percentile(latencies, 95) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'max': round(max(latencies, default=0) * 1000, 3),
+        },
+    }
+    record.update(extra)
+    return record
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+def consume(chunks):
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+    return size
+
+
+def read_range(storage, storage_id, start, length):
+    chunk = storage.get_range(storage_id, start, length)
+    # touch the data, a response has to access it anyway
+    chunk[-1]
+    return len(chunk)
+
+
+def bench_size(storage, size, args, block, rnd):
+    """
+    Run all operations for files of `size` bytes.
+    :return: result records
+    :rtype: list
+    """
+
+    records = []
+    in_memory = size <= args.in_memory_limit
+    content = make_content(block, size) if in_memory else None
+    range_size = min(args.range_size, size)
+
+    # put
+    latencies = []
+    storage_ids = []
+    for i in range(args.iterations):
+        project_id = f'bench-{format_size(size)}-{i}-{rnd.getrandbits(32):x}'
+        if in_memory:
+            seconds, storage_id = timed(storage.put, content, 'bench.mp4', project_id=project_id)
+        else:
+            seconds, storage_id = timed(storage.put_stream, RandomStream(block, size), 'bench.mp4',
+                                        project_id=project_id)
+        latencies.append(seconds)
+        storage_ids.append(storage_id)
+    records.append(make_record('put' if in_memory else 'put_stream', size, latencies, size * len(latencies)))
+
+    # whole file reads
+    latencies = []
+    for storage_id in storage_ids:
+        if in_memory:
+            seconds, _ = timed(storage.get, storage_id)
+        else:
+            seconds, _ = timed(lambda: consume(storage.get_stream(storage_id)))
+        latencies.append(seconds)
+    records.append(make_record('get' if in_memory else 'get_stream', size, latencies, size * len(latencies)))
+
+    # random ranges, like the ones sent by a player while scrubbing
+    latencies = []
+    total_bytes = 0
+    for _ in range(args.ranges):
+        storage_id = rnd.choice(storage_ids)
+        seconds, length = timed(read_range, storage, storage_id, rnd.randrange(0, size - range_size + 1), range_size)
+        latencies.append(seconds)
+        total_bytes += length
+    records.append(make_record('get_range_random', size, latencies, total_bytes, range_size=range_size))
+
+    # sequential ranges, like the ones sent by a player during a playback
+    latencies = []
+    total_bytes = 0
+    start = 0
+    for _ in range(args.ranges):
+        if start + range_size > size:
+            start = 0
+        seconds, length = timed(read_range, storage, storage_ids[0], start, range_size)
+        latencies.append(seconds)
+        total_bytes += length
+        start += range_size
+    records.append(make_record('get_range_sequential', size, latencies, total_bytes, range_size=range_size))
+
+    # concurrent readers of random ranges
+    for readers in args.readers:
+        records.append(bench_readers(storage, storage_ids, size, range_size, readers, args))
+
+    # replace
+    if in_memory:
+        latencies = [timed(storage.replace, content, storage_id)[0] for storage_id in storage_ids]
+        records.append(make_record('replace', size, latencies, size * len(latencies)))
+
+    # delete project directories
+    latencies = [timed(storage.delete_dir, storage_id)[0] for storage_id in storage_ids]
+    records.append(make_record('delete_dir', size, latencies, 0))
+
+    return records
+
+
+def bench_readers(storage, storage_ids, size, range_size, readers, args):
+    """
+    Read random ranges from `readers` threads at once.
+    :return: result record, `seconds` is a wall time
+    :rtype: dict
+    """
+
+    flask_app = args.app
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(readers + 1)
+
+    def reader(seed):
+        rnd = random.Random(seed)
+        thread_latencies = []
+        with flask_app.app_context():
+            barrier.wait()
+            for _ in range(args.ranges):
+                storage_id = rnd.choice(storage_ids)
+                seconds, _ = timed(read_range, storage, storage_id, rnd.randrange(0, size - range_size + 1),
+                                   range_size)
+                thread_latencies.append(seconds)
+        with lock:
+            latencies.extend(thread_latencies)
+
+    threads = [threading.Thread(target=reader, args=(args.seed + i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    return make_record('get_range_concurrent', size, latencies, range_size * len(latencies), seconds=seconds,
+                       range_size=range_size, readers=readers)
+
+
+def get_run_info(args, storage):
+    wrappers = []
+    wrapped = storage
+    while isinstance(wrapped, StorageWrapper):
+        wrappers.append(wrapped.__class__.__name__)
+        wrapped = wrapped.storage
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'storage': args.storage,
+        'backend': unwrap_storage(storage).__class__.__name__,
+        'wrappers': wrappers,
+        'layout': args.layout,
+        'volumes': args.volumes,
+        'config': dict(args.set),
+    }
+
+
+def parse_setting(value):
+    key, _, raw = value.partition('=')
+    try:
+        return key, json.loads(raw)
+    except ValueError:
+        return key, raw
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--storage', choices=['filesystem', 'amazon'], default='filesystem')
+    parser.add_argument('--cache', action='store_true', help='wrap a storage with a local disk cache')
+    parser.add_argument('--memory-cache', action='store_true', help='wrap a storage with an in-process cache')
+    parser.add_argument('--layout', choices=['date', 'hash'], default='date', help='layout of project directories')
+    parser.add_argument('--volumes', type=int, default=0, help='number of filesystem volumes to spread files over')
+    parser.add_argument('--set', type=parse_setting, action='append', default=[], metavar='KEY=JSON',
+                        help='override a setting, i.e. FS_MEDIA_STORAGE_MMAP=false')
+    parser.add_argument('--sizes', type=lambda v: [parse_size(s) for s in v.split(',')],
+                        default='10K,256K,4M,64M', help='comma separated file sizes, i.e. 10K,64M,2G')
+    parser.add_argument('--iterations', type=int, default=5, help='number of files of every size')
+    parser.add_argument('--ranges', type=int, default=200, help='number of range reads per reader')
+    parser.add_argument('--range-size', type=parse_size, default='512K', help='size of a range read')
+    parser.add_argument('--readers', type=lambda v: [int(r) for r in v.split(',')], default='4,16',
+                        help='comma separated numbers of concurrent readers')
+    parser.add_argument('--in-memory-limit', type=parse_size, default='256M',
+                        help='bigger files are written and read as streams')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='file to append JSON lines to, stdout if not set')
+    args = parser.parse_args()
+
+    tmp_path = tempfile.mkdtemp(prefix='videoserver-bench-')
+    config = {
+        'FS_MEDIA_STORAGE_PATH': os.path.join(tmp_path, 'projects'),
+        'MEDIA_STORAGE_CACHE_PATH': os.path.join(tmp_path, 'cache'),
+        'MEDIA_STORAGE_LAYOUT': args.layout,
+        'FS_MEDIA_STORAGE_VOLUMES': [
+            (f'vol{i}', os.path.join(tmp_path, f'vol{i}')) for i in range(args.volumes)
+        ],
+    }
+    for _, path in config['FS_MEDIA_STORAGE_VOLUMES']:
+        os.makedirs(path)
+    config.update(args.set)
+    app = get_app(config)
+    args.app = app
+    # storages log every file operation
+    logging.disable(logging.INFO)
+    storage = get_media_storage(args.storage, cache=args.cache, memory_cache=args.memory_cache)
+
+    rnd = random.Random(args.seed)
+    block = bytes(rnd.getrandbits(8) for _ in range(BLOCK_SIZE))
+    output = open(args.output, 'a') if args.output else sys.stdout
+
+    try:
+        with app.app_context():
+            run = get_run_info(args, storage)
+            print(f'{"op":<22} {"size":>6} {"readers":>7} {"ops/s":>10} {"MB/s":>10} {"p50 ms":>9} {"p99 ms":>9}',
+                  file=sys.stderr)
+            for size in args.sizes:
+                for record in bench_size(storage, size, args, block, rnd):
+                    output.write(json.dumps(dict(record, run=run)) + '\n')
+                    output.flush()
+                    print(f'{record["op"]:<22} {format_size(size):>6} {record.get("readers", 1):>7} '
+                          f'{record["ops_per_sec"] or 0:>10.1f} {record["mb_per_sec"] or 0:>10.1f} '
+                          f'{record["latency_ms"]["p50"]:>9.3f} {record["latency_ms"]["p99"]:>9.3f}', file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        shutil.rmtree(tmp_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Measure `edit_video` trims at the start, the middle and the end of a long video:
+- `input` - full re-encode with input seeking (`-ss` before `-i`), see `FFMPEG_TRIM_SEEK`
+- `output` - full re-encode with output seeking (`-ss` after `-i`)
+- `smart` - re-encode of partial GOPs at both ends and stream copy of the rest, see `FFMPEG_SMART_TRIM`
+
+Frames of every trim are compared with frames of an output seeking trim (`framemd5` of decoded frames),
+`frames_match` is `false` if a trim returned different frames, `timestamps_match` is `false` if frames
+have different timestamps. Smart trim copies frames which are re-encoded by other modes, so only its
+timestamps are expected to match.
+
+A fixture is generated with ffmpeg's `testsrc2` and `sine` sources unless `--fixture` is set. Results are written
+as JSON lines, one record per seek mode and trim position. A human readable summary is printed to stderr.
+
+Usage::
+
+    python benchmarks/trim.py --duration 7200 --output trim.jsonl
+    python benchmarks/trim.py --fixture /path/to/recording.mp4 --trim-length 60 --iterations 1
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from videoserver.app import get_app
+from videoserver.lib.video_editor.ffmpeg import FFMPEGVideoEditor
+
+#: settings of every measured mode
+MODES = {
+    'input': {'FFMPEG_TRIM_SEEK': 'input', 'FFMPEG_SMART_TRIM': False},
+    'output': {'FFMPEG_TRIM_SEEK': 'output', 'FFMPEG_SMART_TRIM': False},
+    'smart': {'FFMPEG_TRIM_SEEK': 'input', 'FFMPEG_SMART_TRIM': True},
+}
+
+
+def make_fixture(path, duration, size, fps, gop):
+    subprocess.run([
+        'ffmpeg', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={fps}:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(gop), '-c:a', 'aac', '-shortest', path,
+    ], check=True)
+
+
+def get_frame_hashes(content, ext, tmp_path):
+    """
+    Return pts and md5 of every decoded video frame.
+    """
+
+    path = os.path.join(tmp_path, f'trimmed.{ext}')
+    with open(path, 'wb') as f:
+        f.write(content)
+    output = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', path, '-map', '0:v', '-f', 'framemd5', '-'],
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    os.remove(path)
+    # columns are stream index, dts, pts, duration, size, hash
+    frames = [line.split(',') for line in output.splitlines() if line and not line.startswith('#')]
+    return [(int(frame[2]), frame[5].strip()) for frame in frames]
+
+
+def get_run_info(args, metadata):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        ffmpeg = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout.split('\n', 1)[0]
+    except OSError:
+        ffmpeg = None
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'ffmpeg': ffmpeg,
+        'fixture': {key: metadata.get(key) for key in ('codec_name', 'width', 'height', 'duration', 'size')},
+        'config': dict(args.set),
+    }
+
+
+def parse_setting(value):
+    key, _, raw = value.partition('=')
+    try:
+        return key, json.loads(raw)
+    except ValueError:
+        return key, raw
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixture', help='video to trim, a fixture is generated if not set')
+    parser.add_argument('--duration', type=int, default=3600, help='duration of a generated fixture (seconds)')
+    parser.add_argument('--resolution', default='1280x720', help='resolution of a generated fixture')
+    parser.add_argument('--fps', type=int, default=25, help='frame rate of a generated fixture')
+    parser.add_argument('--gop', type=int, default=250, help='keyframe interval of a generated fixture (frames)')
+    parser.add_argument('--trim-length', type=float, default=10, help='length of a trimmed part (seconds)')
+    parser.add_argument('--iterations', type=int, default=3, help='number of trims for every position and mode')
+    parser.add_argument('--set', type=parse_setting, action='append', default=[], metavar='KEY=JSON',
+                        help='override a setting, i.e. FFMPEG_PRESET=\'"ultrafast"\'')
+    parser.add_argument('--output', help='file to append JSON lines to, stdout if not set')
+    args = parser.parse_args()
+
+    tmp_path = tempfile.mkdtemp(prefix='videoserver-bench-')
+    config = {'SCRATCH_PATH': os.path.join(tmp_path, 'scratch')}
+    config.update(args.set)
+    app = get_app(config)
+    logging.disable(logging.INFO)
+    editor = FFMPEGVideoEditor()
+    output = open(args.output, 'a') if args.output else sys.stdout
+
+    try:
+        fixture = args.fixture
+        if not fixture:
+            fixture = os.path.join(tmp_path, 'fixture.mp4')
+            print(f'Generating a {args.duration}s fixture...', file=sys.stderr)
+            make_fixture(fixture, args.duration, args.resolution, args.fps, args.gop)
+        ext = fixture.rsplit('.', 1)[-1]
+
+        with app.app_context():
+            metadata = editor.get_meta(file_path=fixture)
+            run = get_run_info(args, metadata)
+            duration = metadata['duration']
+            length = min(args.trim_length, duration)
+            positions = {
+                'start': 0,
+                'middle': round((duration - length) / 2, 3),
+                # the last second is avoided, the last frames might be null
+                'end': round(max(duration - length - 1, 0), 3),
+            }
+
+            print(f'{"position":<8} {"start":>10} {"mode":<7} {"mean s":>9} {"min s":>9} {"frames":>7} '
+                  f'{"same frames":>11} {"same pts":>8}', file=sys.stderr)
+            for name, start in positions.items():
+                trim = {'start': start, 'end': start + length}
+                hashes = {}
+                latencies = {}
+                for mode, settings in MODES.items():
+                    app.config.update(settings)
+                    latencies[mode] = []
+                    for _ in range(args.iterations):
+                        started = time.perf_counter()
+                        content, _ = editor.edit_video(None, os.path.basename(fixture), trim=trim, file_path=fixture)
+                        latencies[mode].append(time.perf_counter() - started)
+                    hashes[mode] = get_frame_hashes(content, ext, tmp_path)
+
+                for mode in MODES:
+                    frames_match = hashes[mode] == hashes['output']
+                    timestamps_match = [pts for pts, _ in hashes[mode]] == [pts for pts, _ in hashes['output']]
+                    record = {
+                        'op': 'trim',
+                        'mode': mode,
+                        'position': name,
+                        'start': start,
+                        'length': length,
+                        'iterations': len(latencies[mode]),
+                        'seconds': {
+                            'mean': round(sum(latencies[mode]) / len(latencies[mode]), 3),
+                            'min': round(min(latencies[mode]), 3),
+                            'max': round(max(latencies[mode]), 3),
+                        },
+                        'frames': len(hashes[mode]),
+                        'frames_match': frames_match,
+                        'timestamps_match': timestamps_match,
+                        'run': run,
+                    }
+                    output.write(json.dumps(record) + '\n')
+                    output.flush()
+                    print(f'{name:<8} {start:>10} {mode:<7} {record["seconds"]["mean"]:>9.3f} '
+                          f'{record["seconds"]["min"]:>9.3f} {record["frames"]:>7} {str(frames_match):>11} '
+                          f'{str(timestamps_match):>8}', file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        shutil.rmtree(tmp_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,10 @@ requirements = (
     'PyYAML==5.1'
 )
 
+s3_requirements = (
+    'boto3>=1.9',
+)
+
 dev_requirements = (
     'flake8',
     'flake8-docstrings',
@@ -23,7 +27,9 @@ dev_requirements = (
     'pytest-cov==2.7.1',
     'pytest-pythonpath==0.7.3',
     'tox==3.13.2',
-    'tox-pyenv==1.1.0'
+    'tox-pyenv==1.1.0',
+    'moto>=1.3.8',
+    *s3_requirements
 )
 
 setup(
@@ -50,6 +56,7 @@ setup(
     license='GPLv3',
     install_requires=requirements,
     extras_require={
+        's3': s3_requirements,
         'dev': dev_requirements
     },
     packages=find_packages('src'),
@@ -51,7 +51,12 @@ def get_app(config=None):
     app.config.update(config)
 
     #: init storage
-    media_storage = get_media_storage(app.config.get('MEDIA_STORAGE'))
+    media_storage = get_media_storage(
+        app.config.get('MEDIA_STORAGE'),
+        cache=app.config.get('MEDIA_STORAGE_CACHE'),
+        memory_cache=app.config.get('MEDIA_STORAGE_MEMORY_CACHE'),
+        instrument=app.config.get('MEDIA_STORAGE_INSTRUMENTATION'),
+    )
     app.fs = media_storage
 
     installed = set()
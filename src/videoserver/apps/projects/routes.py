@@ -1,21 +1,23 @@
 import copy
 import logging
 import os
-import re
-from datetime import datetime
+from datetime import datetime, timezone
+from time import time
 
 import bson
+from flask import Response
 from flask import current_app as app
 from flask import request
 from pymongo import ReturnDocument
 from pymongo.errors import ServerSelectionTimeoutError
 from werkzeug.exceptions import BadRequest, Conflict, InternalServerError, NotFound
+from werkzeug.http import http_date, is_resource_modified, quote_etag
 
-from videoserver.lib.video_editor import get_video_editor
+from videoserver.lib.video_editor import SEEK_MODES, get_video_editor
 from videoserver.lib.views import MethodView
 from videoserver.lib.utils import (
-    add_urls, create_file_name, get_request_address, json_response, paginate, save_activity_log, storage2response,
-    validate_document, coerce_crop_str_to_dict, coerce_trim_str_to_dict
+    FileChangedError, add_urls, create_file_name, get_request_address, json_response, paginate, save_activity_log,
+    storage2response, validate_document, coerce_crop_str_to_dict, coerce_trim_str_to_dict
 )
 
 from . import bp
@@ -141,18 +143,12 @@ class ListUploadProject(MethodView):
             raise BadRequest({"file": ["required field"]})
         document = validate_document(request.files, self.SCHEMA_UPLOAD)
 
-        # validate codec
-        file_stream = document['file'].stream.read()
-        metadata = get_video_editor().get_meta(file_stream)
-        if metadata.get('codec_name') not in app.config.get('CODEC_SUPPORT_VIDEO'):
-            raise BadRequest({'file': [f"Codec: '{metadata.get('codec_name')}' is not supported."]})
-
         # add record to database
         project = {
             '_id': bson.ObjectId(),
             'filename': create_file_name(ext=document['file'].filename.rsplit('.')[-1]),
             'storage_id': None,
-            'metadata': metadata,
+            'metadata': None,
             'create_time': datetime.utcnow(),
             'mime_type': document['file'].mimetype,
             'request_address': get_request_address(request.headers.environ),
@@ -170,9 +166,9 @@ class ListUploadProject(MethodView):
             }
         }
 
-        # put file stream into storage
-        storage_id = app.fs.put(
-            content=file_stream,
+        # copy uploaded file stream into storage by chunks
+        storage_id = app.fs.put_stream(
+            stream=document['file'].stream,
             filename=project['filename'],
             project_id=project['_id'],
             content_type=document['file'].mimetype
@@ -180,6 +176,17 @@ class ListUploadProject(MethodView):
         # set 'storage_id' for project
         project['storage_id'] = storage_id
 
+        # validate codec of just stored file
+        try:
+            metadata = self._get_stored_file_meta(storage_id)
+        except Exception:
+            app.fs.delete_dir(storage_id)
+            raise
+        if metadata.get('codec_name') not in app.config.get('CODEC_SUPPORT_VIDEO'):
+            app.fs.delete_dir(storage_id)
+            raise BadRequest({'file': [f"Codec: '{metadata.get('codec_name')}' is not supported."]})
+        project['metadata'] = metadata
+
         try:
             # save project
             app.mongo.db.projects.insert_one(project)
@@ -194,6 +201,20 @@ class ListUploadProject(MethodView):
 
         return json_response(project, status=201)
 
+    @staticmethod
+    def _get_stored_file_meta(storage_id):
+        """
+        Get metadata of a file which is already in a storage.
+        File is probed in place if storage keeps it locally, otherwise it's fetched first.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: metadata
+        :rtype: dict
+        """
+
+        with app.fs.open_local(storage_id) as file_path:
+            return get_video_editor().get_meta(file_path=file_path)
+
     def get(self):
         """
         List of projects
@@ -759,11 +780,11 @@ class DuplicateProject(MethodView):
         }
         app.mongo.db.projects.insert_one(child_project)
 
-        # put a video file stream into storage
+        # copy a video file inside a storage
         try:
-            storage_id = app.fs.put(
-                content=app.fs.get(self.project['storage_id']),
-                filename=child_project['filename'],
+            storage_id = app.fs.copy(
+                src_storage_id=self.project['storage_id'],
+                dst_filename=child_project['filename'],
                 project_id=child_project['_id'],
                 content_type=child_project['mime_type']
             )
@@ -782,9 +803,9 @@ class DuplicateProject(MethodView):
 
             # save preview thumbnail
             if self.project['thumbnails']['preview']:
-                storage_id = app.fs.put(
-                    content=app.fs.get(self.project['thumbnails']['preview']['storage_id']),
-                    filename=self.project['thumbnails']['preview']['filename'],
+                storage_id = app.fs.copy(
+                    src_storage_id=self.project['thumbnails']['preview']['storage_id'],
+                    dst_filename=self.project['thumbnails']['preview']['filename'],
                     project_id=None,
                     asset_type='thumbnails',
                     storage_id=child_project['storage_id'],
@@ -803,23 +824,30 @@ class DuplicateProject(MethodView):
 
             # save timeline thumbnails
             timeline_thumbnails = []
+            # packed thumbnails share a single file, it's copied once
+            copied_storage_ids = {}
             for thumbnail in self.project['thumbnails']['timeline']:
-                storage_id = app.fs.put(
-                    content=app.fs.get(thumbnail['storage_id']),
-                    filename=thumbnail['filename'],
-                    project_id=None,
-                    asset_type='thumbnails',
-                    storage_id=child_project['storage_id'],
-                    content_type=thumbnail['mimetype']
-                )
-                timeline_thumbnails.append({
+                if thumbnail['storage_id'] not in copied_storage_ids:
+                    copied_storage_ids[thumbnail['storage_id']] = app.fs.copy(
+                        src_storage_id=thumbnail['storage_id'],
+                        dst_filename=os.path.basename(thumbnail['storage_id']),
+                        project_id=None,
+                        asset_type='thumbnails',
+                        storage_id=child_project['storage_id'],
+                        content_type=thumbnail['mimetype'] if 'offset' not in thumbnail else 'application/octet-stream'
+                    )
+                storage_id = copied_storage_ids[thumbnail['storage_id']]
+                timeline_thumbnail = {
                     'filename': thumbnail['filename'],
                     'storage_id': storage_id,
                     'mimetype': thumbnail['mimetype'],
                     'width': thumbnail['width'],
                     'height': thumbnail['height'],
                     'size': thumbnail['size']
-                })
+                }
+                if 'offset' in thumbnail:
+                    timeline_thumbnail.update({'offset': thumbnail['offset'], 'length': thumbnail['length']})
+                timeline_thumbnails.append(timeline_thumbnail)
             if timeline_thumbnails:
                 child_project = app.mongo.db.projects.find_one_and_update(
                     {'_id': child_project['_id']},
@@ -861,12 +889,12 @@ class RetrieveOrCreateThumbnails(MethodView):
                     {
                         'allowed': ['timeline'],
                         'dependencies': ['amount'],
-                        'excludes': ['position', 'crop', 'rotate'],
+                        'excludes': ['position', 'crop', 'rotate', 'seek_mode'],
                     },
                     {
                         # make `amount` optional
                         'allowed': ['timeline'],
-                        'excludes': ['position', 'crop', 'rotate'],
+                        'excludes': ['position', 'crop', 'rotate', 'seek_mode'],
                     },
                     {
                         'allowed': ['preview'],
@@ -879,6 +907,7 @@ class RetrieveOrCreateThumbnails(MethodView):
                 'type': 'integer',
                 'coerce': int,
                 'min': 1,
+                'max': app.config.get('MAX_TOTAL_TIMELINE_THUMBNAILS'),
             },
             'position': {
                 'type': 'float',
@@ -896,6 +925,11 @@ class RetrieveOrCreateThumbnails(MethodView):
                 'required': False,
                 'coerce': int,
                 'allowed': [-270, -180, -90, 90, 180, 270]
+            },
+            'seek_mode': {
+                'type': 'string',
+                'required': False,
+                'allowed': list(SEEK_MODES)
             }
         }
 
@@ -919,6 +953,7 @@ class RetrieveOrCreateThumbnails(MethodView):
           in: query
           type: integer
           description: Amount of thumbnails to generate for a timeline. Used only when `type` is `timeline`.
+                       Not more than `MAX_TOTAL_TIMELINE_THUMBNAILS`.
         - name: position
           in: query
           type: float
@@ -934,6 +969,16 @@ class RetrieveOrCreateThumbnails(MethodView):
           type: integer
           description: Number of degrees rotate preview thumbnail. Used only when `type` is `preview`.
           enum: [-270, -180, -90, 90, 180, 270]
+        - name: seek_mode
+          in: query
+          type: string
+          description: How to find a frame at `position`. `accurate` returns the exact frame, `fast` returns the exact
+                       frame decoding a video from the closest keyframe, `keyframe` returns the closest keyframe
+                       before `position` right away, use it for approximate previews while scrubbing.
+                       `fast` and `keyframe` frames are returned as png images right away, project's preview
+                       thumbnail is not changed. Used only when `type` is `preview`.
+          enum: [accurate, fast, keyframe]
+          default: accurate
         responses:
           200:
             description: Timeline/preview thumbnails information
@@ -990,7 +1035,10 @@ class RetrieveOrCreateThumbnails(MethodView):
                 amount=document.get('amount', app.config.get('DEFAULT_TOTAL_TIMELINE_THUMBNAILS'))
             )
 
-        return self._get_preview_thumbnail(document['position'], document.get('crop'), document.get('rotate', 0))
+        return self._get_preview_thumbnail(
+            document['position'], document.get('crop'), document.get('rotate', 0),
+            document.get('seek_mode', 'accurate')
+        )
 
     def post(self, project_id):
         """
@@ -1066,8 +1114,10 @@ class RetrieveOrCreateThumbnails(MethodView):
             raise Conflict({"processing": ["Task get preview thumbnails is still processing"]})
 
         # save to fs
-        thumbnail_filename = "{filename}_preview-custom.{original_ext}".format(
+        # unique filename, so other processes never serve an old thumbnail from an in-process cache
+        thumbnail_filename = "{filename}_preview-custom_{_id}.{original_ext}".format(
             filename=os.path.splitext(self.project['filename'])[0],
+            _id=round(time() * 1000),
             original_ext=request.files['file'].filename.rsplit('.', 1)[-1].lower()
         )
         mimetype = app.config.get('CODEC_MIMETYPE_MAP')[metadata.get('codec_name')]
@@ -1134,15 +1184,19 @@ class RetrieveOrCreateThumbnails(MethodView):
             )
             return json_response({"processing": True}, status=202)
 
-    def _get_preview_thumbnail(self, position, crop, rotate):
+    def _get_preview_thumbnail(self, position, crop, rotate, seek_mode='accurate'):
         """
-        Get or create thumbnail for preview
+        Get or create thumbnail for preview.
+        Frames captured with `fast` or `keyframe` seek mode are scrubbing previews, they are returned as images
+        and project's preview thumbnail is kept.
         :param position: video position to capture a frame
         :type position: int
         :param crop: crop editing rules
         :type crop: dict
         :param rotate: rotate degree
         :type rotate: int
+        :param seek_mode: seek mode, see `FFMPEGVideoEditor.capture_thumbnail`
+        :type seek_mode: str
         :return: json response
         :rtype: flask.wrappers.Response
         """
@@ -1160,6 +1214,19 @@ class RetrieveOrCreateThumbnails(MethodView):
         if self.project['metadata']['duration'] < position:
             position = self.project['metadata']['duration']
             logger.info(f"Postition greater than video duration, Update it equal duration, ID: {self.project['_id']}")
+        if seek_mode != 'accurate':
+            with app.fs.open_local(self.project['storage_id']) as file_path:
+                content, metadata = get_video_editor().capture_thumbnail(
+                    stream_file=None,
+                    filename=self.project['filename'],
+                    duration=self.project['metadata']['duration'],
+                    position=position,
+                    crop=crop,
+                    rotate=rotate,
+                    file_path=file_path,
+                    seek_mode=seek_mode,
+                )
+            return Response(content, mimetype=metadata['mimetype'])
         # resource is busy
         if self.project['processing']['thumbnail_preview']:
             raise Conflict({"processing": ["Task get preview thumbnails video is still processing"]})
@@ -1176,15 +1243,21 @@ class RetrieveOrCreateThumbnails(MethodView):
                 position,
                 crop,
                 rotate,
+                seek_mode,
             )
             return json_response({"processing": True}, status=202)
 
 
 class GetRawVideo(MethodView):
+    # times a video is opened again if it's replaced between reading its size and opening it
+    OPEN_ATTEMPTS = 3
+
     def get(self, project_id):
         """
         Get video stream.
         If `HTTP_RANGE` header is specified - return chunked video stream, else full file.
+        `ETag` and `Last-Modified` headers are returned if storage supports them, so conditional requests
+        (`If-None-Match`, `If-Modified-Since`, `If-Range`) are supported.
         ---
         parameters:
         - in: path
@@ -1208,6 +1281,8 @@ class GetRawVideo(MethodView):
                 schema:
                   type: string
                   format: binary
+          304:
+            description: Video was not modified since `If-None-Match`/`If-Modified-Since`
           409:
             description: Timeline/preview task is still processing
             schema:
@@ -1217,42 +1292,88 @@ class GetRawVideo(MethodView):
                   type: array
                   example:
                     - Task edit video is still processing
+          416:
+            description: Requested range starts after the end of a video
         """
 
         # video is processing
         if self.project['processing']['video']:
             raise Conflict({"processing": ["Task edit video is still processing"]})
 
-        # get stream file for video
-        video_range = request.headers.environ.get('HTTP_RANGE')
-        length = self.project['metadata'].get('size')
-        if video_range:
-            start = int(re.split('[= | -]', video_range)[1])
-            # TODO doublecheck streaming range
-            end = length - 1
-            chunksize = end - start + 1
+        storage_id = self.project['storage_id']
+        for _ in range(self.OPEN_ATTEMPTS):
+            try:
+                return self._get_video(storage_id)
+            except FileChangedError:
+                # video was replaced (i.e. by an edit) after its size was read, headers must be built again
+                logger.info(f'GetRawVideo:{storage_id}: video was replaced while it was opened, retrying')
+        raise Conflict({"processing": ["Video is being replaced"]})
+
+    def _get_video(self, storage_id):
+        """
+        Build a response from video's stat, etag is checked again once a video is opened.
+        """
+
+        try:
+            stat = app.fs.stat(storage_id)
+        except FileNotFoundError:
+            raise NotFound()
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Type': self.project.get("mime_type"),
+        }
+        if stat:
+            # storage knows an exact size, metadata may be stale right after an edit
+            length = stat['size']
+            headers['ETag'] = quote_etag(stat['etag'])
+            headers['Last-Modified'] = http_date(stat['mtime'])
+            if not is_resource_modified(request.environ, etag=stat['etag'], last_modified=stat['mtime']):
+                return Response(headers=headers), 304
+        else:
+            length = self.project['metadata'].get('size')
 
+        # get stream file for video
+        video_range = request.range
+        if video_range and len(video_range.ranges) == 1 and self._if_range_matches(stat):
+            byte_range = video_range.range_for_length(length)
+            if byte_range is None:
+                headers['Content-Range'] = f'bytes */{length}'
+                return Response(headers=headers), 416
+
+            start, stop = byte_range
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+            headers['Content-Length'] = stop - start
             return storage2response(
-                storage_id=self.project['storage_id'],
-                headers={
-                    'Content-Range': f'bytes {start}-{end}/{length}',
-                    'Accept-Ranges': 'bytes',
-                    'Content-Length': chunksize,
-                    'Content-Type': self.project.get("mime_type"),
-                },
+                storage_id=storage_id,
+                headers=headers,
                 status=206,
                 start=start,
-                length=chunksize
+                length=stop - start,
+                etag=stat['etag'] if stat else None
             )
 
+        headers['Content-Length'] = length
         return storage2response(
-            storage_id=self.project.get('storage_id'),
-            headers={
-                'Content-Length': length,
-                'Content-Type': self.project.get("mime_type"),
-            }
+            storage_id=storage_id,
+            headers=headers,
+            etag=stat['etag'] if stat else None
         )
 
+    @staticmethod
+    def _if_range_matches(stat):
+        """
+        Check `If-Range` header, range must be ignored if a file was changed since a client got its first part.
+        """
+
+        if_range = request.if_range
+        if not stat or not (if_range.etag or if_range.date):
+            return True
+        if if_range.etag:
+            return if_range.etag == stat['etag']
+        date = if_range.date if if_range.date.tzinfo else if_range.date.replace(tzinfo=timezone.utc)
+        return stat['mtime'].replace(microsecond=0) <= date
+
 
 class GetRawPreviewThumbnail(MethodView):
 
@@ -1321,6 +1442,11 @@ class GetRawTimelineThumbnail(MethodView):
         except IndexError:
             raise NotFound()
 
+        if 'offset' in thumbnail:
+            # thumbnail is a part of a pack, delivery by a web server or a redirect would send a whole pack
+            content = app.fs.get_range(thumbnail['storage_id'], thumbnail['offset'], thumbnail['length'])
+            return Response(content, headers={'Content-Type': thumbnail['mimetype']})
+
         return storage2response(
             storage_id=thumbnail['storage_id'],
             headers={'Content-Type': thumbnail['mimetype']}
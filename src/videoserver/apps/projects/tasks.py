@@ -7,6 +7,7 @@ from flask import current_app as app
 from pymongo import ReturnDocument
 
 from videoserver.celery_app import celery
+from videoserver.lib.utils import get_thumbnails_storage_ids
 from videoserver.lib.video_editor import get_video_editor
 
 logger = logging.getLogger(__name__)
@@ -24,11 +25,13 @@ def edit_video(self, project, changes):
 
     try:
         # Use tool for editing video
-        edited_video_stream, metadata = video_editor.edit_video(
-            stream_file=app.fs.get(project['storage_id']),
-            filename=project['filename'],
-            **changes
-        )
+        with app.fs.open_local(project['storage_id']) as file_path:
+            edited_video_stream, metadata = video_editor.edit_video(
+                stream_file=None,
+                filename=project['filename'],
+                file_path=file_path,
+                **changes
+            )
 
         app.fs.replace(
             edited_video_stream,
@@ -52,9 +55,8 @@ def edit_video(self, project, changes):
     else:
         # delete old timeline thumbnails
         old_timeline_thumbnails = project['thumbnails'].get('timeline', [])
-        for old_thumbnail in old_timeline_thumbnails:
-            app.fs.delete(old_thumbnail.get('storage_id'))
-        logger.info(f"Removed {len(old_timeline_thumbnails)} old thumbnails from {app.fs.__class__.__name__} "
+        results = app.fs.delete_many(get_thumbnails_storage_ids(old_timeline_thumbnails))
+        logger.info(f"Removed {sum(results.values())} old thumbnails from {app.fs.__class__.__name__} "
                     f"in project {project.get('_id')}")
 
         # update project record
@@ -75,43 +77,67 @@ def edit_video(self, project, changes):
 def generate_timeline_thumbnails(self, project, amount):
     timeline_thumbnails = []
     video_editor = get_video_editor()
+    # thumbnails of every run are saved under new storage ids, so processes which keep
+    # old thumbnails in an in-process cache never serve them instead of new ones
+    _id = round(time() * 1000)
 
     try:
-        thumbnails_generator = video_editor.capture_timeline_thumbnails(
-            stream_file=app.fs.get(project['storage_id']),
-            filename=project['filename'],
-            duration=project['metadata']['duration'],
-            thumbnails_amount=amount)
-
-        for count, (stream, meta) in enumerate(thumbnails_generator, 1):
-            ext = app.config.get('CODEC_EXTENSION_MAP')[meta.get('codec_name')]
-            filename = f"{project['filename'].rsplit('.', 1)[0]}_timeline_{count}-{amount}.{ext}"
-            # save to storage
-            storage_id = app.fs.put(
-                content=stream,
-                filename=filename,
-                project_id=None,
-                asset_type='thumbnails',
-                storage_id=project['storage_id'],
-                content_type=meta.get('mimetype')
-            )
-            timeline_thumbnails.append(
-                {
+        with app.fs.open_local(project['storage_id']) as file_path:
+            thumbnails_generator = video_editor.capture_timeline_thumbnails(
+                stream_file=None,
+                filename=project['filename'],
+                duration=project['metadata']['duration'],
+                thumbnails_amount=amount,
+                file_path=file_path)
+
+            pack = app.config.get('TIMELINE_THUMBNAILS_PACK')
+            pack_content = []
+            offset = 0
+            for count, (stream, meta) in enumerate(thumbnails_generator, 1):
+                ext = app.config.get('CODEC_EXTENSION_MAP')[meta.get('codec_name')]
+                filename = f"{project['filename'].rsplit('.', 1)[0]}_timeline_{count}-{amount}_{_id}.{ext}"
+                thumbnail = {
                     'filename': filename,
-                    'storage_id': storage_id,
                     'mimetype': meta.get('mimetype'),
                     'width': meta.get('width'),
                     'height': meta.get('height'),
                     'size': meta.get('size')
                 }
-            )
+                if pack:
+                    # thumbnail is saved later as a part of a pack
+                    pack_content.append(stream)
+                    thumbnail.update({'offset': offset, 'length': len(stream)})
+                    offset += len(stream)
+                    timeline_thumbnails.append(thumbnail)
+                    continue
+                # save to storage
+                thumbnail['storage_id'] = app.fs.put(
+                    content=stream,
+                    filename=filename,
+                    project_id=None,
+                    asset_type='thumbnails',
+                    storage_id=project['storage_id'],
+                    content_type=meta.get('mimetype')
+                )
+                timeline_thumbnails.append(thumbnail)
+
+            if pack and timeline_thumbnails:
+                storage_id = app.fs.put(
+                    content=b''.join(pack_content),
+                    filename=f"{project['filename'].rsplit('.', 1)[0]}_timeline-{amount}_{_id}.pack",
+                    project_id=None,
+                    asset_type='thumbnails',
+                    storage_id=project['storage_id'],
+                    content_type='application/octet-stream'
+                )
+                for thumbnail in timeline_thumbnails:
+                    thumbnail['storage_id'] = storage_id
         logger.info(f"Created and saved {len(timeline_thumbnails)} thumbnails to {app.fs.__class__.__name__} "
                     f"in project {project.get('_id')}.")
     except Exception as e:
         # delete just saved files
-        for thumbnail in timeline_thumbnails:
-            app.fs.delete(thumbnail.get('storage_id'))
-        logger.info(f"Due to exception, {len(timeline_thumbnails)} just created thumbnails were removed from "
+        results = app.fs.delete_many(get_thumbnails_storage_ids(timeline_thumbnails))
+        logger.info(f"Due to exception, {sum(results.values())} just created thumbnails were removed from "
                     f"{app.fs.__class__.__name__} in project {project.get('_id')}")
         logger.exception(e)
 
@@ -128,9 +154,8 @@ def generate_timeline_thumbnails(self, project, amount):
     else:
         # remove an old thumbnails from a storage only if new thumbnails were created succesfully
         old_timeline_thumbnails = project['thumbnails'].get('timeline', [])
-        for old_thumbnail in old_timeline_thumbnails:
-            app.fs.delete(old_thumbnail.get('storage_id'))
-        logger.info(f"Removed {len(old_timeline_thumbnails)} old thumbnails from {app.fs.__class__.__name__} "
+        results = app.fs.delete_many(get_thumbnails_storage_ids(old_timeline_thumbnails))
+        logger.info(f"Removed {sum(results.values())} old thumbnails from {app.fs.__class__.__name__} "
                     f"in project {project.get('_id')}")
 
         # replace thumbnails in db
@@ -146,19 +171,22 @@ def generate_timeline_thumbnails(self, project, amount):
 
 
 @celery.task(bind=True, default_retry_delay=10)
-def generate_preview_thumbnail(self, project, position, crop, rotate):
+def generate_preview_thumbnail(self, project, position, crop, rotate, seek_mode='accurate'):
     video_editor = get_video_editor()
     preview_thumbnail = None
 
     try:
-        stream, meta = video_editor.capture_thumbnail(
-            stream_file=app.fs.get(project['storage_id']),
-            filename=project['filename'],
-            duration=project['metadata']['duration'],
-            position=position,
-            crop=crop,
-            rotate=rotate,
-        )
+        with app.fs.open_local(project['storage_id']) as file_path:
+            stream, meta = video_editor.capture_thumbnail(
+                stream_file=None,
+                filename=project['filename'],
+                duration=project['metadata']['duration'],
+                position=position,
+                crop=crop,
+                rotate=rotate,
+                file_path=file_path,
+                seek_mode=seek_mode,
+            )
         # Generate _id to ensure filename is unique, avoid fs.put raises error,
         # use of fs.replace will lead to lost original thumbnail if an error is occured
         _id = round(time() * 1000)
@@ -0,0 +1,12 @@
+from flask import Blueprint
+from flask.cli import AppGroup
+
+bp = Blueprint('storage', __name__)
+cli = AppGroup('storage', help='Media storage maintenance commands.')
+
+from . import commands, routes # noqa
+
+
+def init_app(app):
+    app.register_blueprint(bp, url_prefix='/storage')
+    app.cli.add_command(cli)
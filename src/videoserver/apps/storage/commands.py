@@ -0,0 +1,309 @@
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from time import time
+
+import click
+from flask import current_app as app
+
+from videoserver.lib.storage import FileSystemStorage, unwrap_storage
+
+from . import cli
+
+logger = logging.getLogger(__name__)
+
+
+def _move_storage_id(storage_id, src_dir, dst_dir):
+    if storage_id and storage_id.startswith(f'{src_dir}/'):
+        return dst_dir + storage_id[len(src_dir):]
+    return storage_id
+
+
+def _migrate_project(flask_app, storage, project, dst_dir):
+    """
+    Move project's directory and update storage ids of a project and its thumbnails in db.
+    If the project was changed or removed while its directory was moved, the directory is moved back and
+    the project is reported as failed.
+    Runs in a thread pool, so it pushes its own app context.
+    """
+
+    with flask_app.app_context():
+        src_dir = os.path.dirname(project['storage_id'])
+        storage.move_dir(src_dir, dst_dir)
+
+        updates = {'storage_id': _move_storage_id(project['storage_id'], src_dir, dst_dir)}
+        preview = project['thumbnails'].get('preview')
+        if preview:
+            updates['thumbnails.preview.storage_id'] = _move_storage_id(preview['storage_id'], src_dir, dst_dir)
+        for index, thumbnail in enumerate(project['thumbnails'].get('timeline', [])):
+            updates[f'thumbnails.timeline.{index}.storage_id'] = _move_storage_id(
+                thumbnail['storage_id'], src_dir, dst_dir
+            )
+        result = flask_app.mongo.db.projects.update_one(
+            {'_id': project['_id'], 'storage_id': project['storage_id']},
+            {'$set': updates}
+        )
+        if not result.matched_count:
+            # storage ids in db still point to `src_dir`
+            if os.path.exists(storage.get_local_path(src_dir)):
+                # files were written to `src_dir` meanwhile, moving back would replace them
+                raise RuntimeError(f'project was changed while it was moved, its files were left in "{dst_dir}"')
+            storage.move_dir(dst_dir, src_dir)
+            raise RuntimeError('project was changed while it was moved, its files were moved back')
+
+
+def _get_fs_storage():
+    storage = unwrap_storage(app.fs)
+    if not isinstance(storage, FileSystemStorage):
+        raise click.ClickException('Only filesystem storage is supported, ids of other storages keep resolving.')
+    return storage
+
+
+def _move_projects(storage, get_dst_dir, workers, dry_run):
+    """
+    Move directories of projects to directories returned by `get_dst_dir` in a thread pool.
+    Projects which are being processed are skipped. Projects without a file (i.e. a duplicate which is being
+    copied or a failed upload) have nothing to move and are not listed.
+    :return: number of moved, failed and skipped projects
+    :rtype: tuple
+    """
+
+    migrations = []
+    skipped = 0
+    projection = {'storage_id': 1, 'create_time': 1, 'processing': 1, 'thumbnails': 1}
+    for project in app.mongo.db.projects.find({'storage_id': {'$type': 'string'}}, projection):
+        src_dir = os.path.dirname(project['storage_id'])
+        dst_dir = get_dst_dir(project, src_dir)
+        if src_dir == dst_dir:
+            continue
+        if any(project['processing'].values()):
+            click.echo(f"Project {project['_id']} is being processed, skipped.")
+            skipped += 1
+            continue
+        migrations.append((project, dst_dir))
+
+    if dry_run:
+        for project, dst_dir in migrations:
+            click.echo(f"{os.path.dirname(project['storage_id'])} -> {dst_dir}")
+        return len(migrations), 0, skipped
+
+    moved = failed = 0
+    flask_app = app._get_current_object()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {
+            executor.submit(_migrate_project, flask_app, storage, project, dst_dir): project
+            for project, dst_dir in migrations
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"storage:{futures[future]['_id']}: {e}")
+                click.echo(f"Project {futures[future]['_id']} was not moved: {e}", err=True)
+                failed += 1
+            else:
+                moved += 1
+    return moved, failed, skipped
+
+
+def _report(moved, failed, skipped, target, dry_run):
+    if dry_run:
+        click.echo(f'{moved} projects would be moved to {target}, {skipped} skipped.')
+        return
+    click.echo(f'{moved} projects were moved to {target}, {failed} failed, {skipped} skipped.')
+    if failed:
+        raise click.ClickException('Some projects were not moved, see errors above.')
+
+
+@cli.command('migrate-layout')
+@click.option('--layout', type=click.Choice(['date', 'hash']), default=None,
+              help='Target layout, `MEDIA_STORAGE_LAYOUT` is used if not set.')
+@click.option('--workers', type=int, default=8, show_default=True, help='Number of projects moved in parallel.')
+@click.option('--dry-run', is_flag=True, help='Only report which projects would be moved.')
+def migrate_layout(layout, workers, dry_run):
+    """
+    Move directories of existing projects to a new storage layout.
+
+    Projects which are being processed are skipped, run a command again when they are finished.
+    It's safe to run a command again after it was interrupted.
+    """
+
+    storage = _get_fs_storage()
+    if not layout:
+        layout = app.config.get('MEDIA_STORAGE_LAYOUT')
+
+    def get_dst_dir(project, src_dir):
+        # project stays on its volume
+        return storage.generate_project_dir(
+            project['_id'],
+            layout=layout,
+            date=project.get('create_time'),
+            volume=storage.get_volume(project['storage_id'])
+        )
+
+    moved, failed, skipped = _move_projects(storage, get_dst_dir, workers, dry_run)
+    _report(moved, failed, skipped, f'"{layout}" layout', dry_run)
+
+
+@cli.command('rebalance')
+@click.option('--workers', type=int, default=8, show_default=True, help='Number of projects moved in parallel.')
+@click.option('--dry-run', is_flag=True, help='Only report which projects would be moved.')
+def rebalance(workers, dry_run):
+    """
+    Move projects between `FS_MEDIA_STORAGE_VOLUMES` volumes according to consistent hashing,
+    i.e. after a volume was added or its weight was changed.
+
+    Projects which are being processed are skipped, run a command again when they are finished.
+    It's safe to run a command again after it was interrupted.
+    """
+
+    storage = _get_fs_storage()
+    if not app.config.get('FS_MEDIA_STORAGE_VOLUMES'):
+        raise click.ClickException('FS_MEDIA_STORAGE_VOLUMES is not set.')
+
+    def get_dst_dir(project, src_dir):
+        volume = storage.choose_volume(project['_id'])
+        if storage.get_volume(src_dir) is None:
+            return f'{volume}/{src_dir}'
+        return f'{volume}/{src_dir.split("/", 1)[1]}'
+
+    moved, failed, skipped = _move_projects(storage, get_dst_dir, workers, dry_run)
+    _report(moved, failed, skipped, 'volumes', dry_run)
+
+
+def _scan_dir(root, volume, dir_path, cutoff, excluded):
+    """
+    List files in `dir_path` which were modified or linked before `cutoff`, and its subdirectories.
+    Hidden directories (i.e. blobs) and paths from `excluded` are skipped, hidden files are skipped
+    except for leftovers of interrupted writes.
+    :return: list of (storage id, size) and list of subdirectories
+    :rtype: tuple
+    """
+
+    files = []
+    dirs = []
+    try:
+        entries = list(os.scandir(dir_path))
+    except FileNotFoundError:
+        return files, dirs
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith('.') and os.path.abspath(entry.path) not in excluded:
+                    dirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                if entry.name.startswith('.') and not entry.name.endswith('.tmp'):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                # deduplicated file is a hard link to an old blob and inherits its mtime,
+                # creation of a link updates ctime only
+                if max(stat.st_mtime, stat.st_ctime) < cutoff:
+                    storage_id = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                    files.append((f'{volume}/{storage_id}' if volume else storage_id, stat.st_size))
+        except FileNotFoundError:
+            continue
+    return files, dirs
+
+
+def _walk_storage(storage, cutoff, workers):
+    """
+    Walk all roots of a storage scanning directories in a thread pool.
+    :return: list of (storage id, size) of files modified or linked before `cutoff`
+    :rtype: list
+    """
+
+    roots = storage.get_roots()
+    # roots or a cache may be nested in each other, every file must be listed once with its own storage id
+    excluded = {os.path.abspath(path) for path in roots.values()}
+    excluded.add(os.path.abspath(app.config.get('MEDIA_STORAGE_CACHE_PATH')))
+
+    files = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pending = {
+            executor.submit(_scan_dir, root, volume, root, cutoff, excluded - {os.path.abspath(root)}): (volume, root)
+            for volume, root in roots.items()
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                volume, root = pending.pop(future)
+                dir_files, dirs = future.result()
+                files.extend(dir_files)
+                for dir_path in dirs:
+                    future = executor.submit(
+                        _scan_dir, root, volume, dir_path, cutoff, excluded - {os.path.abspath(root)}
+                    )
+                    pending[future] = (volume, root)
+    return files
+
+
+def _get_referenced_storage_ids():
+    """
+    Return storage ids of all videos and thumbnails referenced by projects.
+    :rtype: set
+    """
+
+    referenced = set()
+    projection = {'storage_id': 1, 'thumbnails.preview.storage_id': 1, 'thumbnails.timeline.storage_id': 1}
+    for project in app.mongo.db.projects.find({}, projection):
+        referenced.add(project.get('storage_id'))
+        thumbnails = project.get('thumbnails') or {}
+        if thumbnails.get('preview'):
+            referenced.add(thumbnails['preview'].get('storage_id'))
+        for thumbnail in thumbnails.get('timeline') or []:
+            referenced.add(thumbnail.get('storage_id'))
+    referenced.discard(None)
+    return referenced
+
+
+@cli.command('gc')
+@click.option('--grace-period', type=float, default=24, show_default=True,
+              help='Files modified or linked less than that many hours ago are kept.')
+@click.option('--workers', type=int, default=8, show_default=True, help='Number of directories scanned in parallel.')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Number of files deleted at once.')
+@click.option('--dry-run', is_flag=True, help='Only report which files would be removed.')
+def gc(grace_period, workers, batch_size, dry_run):
+    """
+    Remove files which no project references, i.e. left by failed uploads, duplications or tasks.
+
+    Only files older than a grace period are removed, so files of uploads and tasks which are running now are kept.
+    """
+
+    storage = _get_fs_storage()
+    cutoff = time() - grace_period * 3600
+    files = _walk_storage(storage, cutoff, workers)
+    # db is read after a storage is scanned, so files referenced while scanning are kept
+    referenced = _get_referenced_storage_ids()
+    if files and not referenced:
+        raise click.ClickException('No projects were found in db, check db settings. Nothing was removed.')
+
+    orphans = [(storage_id, size) for storage_id, size in sorted(files) if storage_id not in referenced]
+    total_size = sum(size for _, size in orphans)
+
+    if dry_run:
+        for storage_id, size in orphans:
+            click.echo(f'{storage_id} {size}')
+        click.echo(f'{len(orphans)} orphan files ({total_size} bytes) would be removed, '
+                   f'{len(files)} files were checked.')
+        return
+
+    batch_size = max(batch_size, 1)
+    removed = removed_size = failed = 0
+    for i in range(0, len(orphans), batch_size):
+        batch = orphans[i:i + batch_size]
+        # deleted through app's storage, so caches are invalidated as well
+        results = app.fs.delete_many([storage_id for storage_id, _ in batch])
+        for storage_id, size in batch:
+            if results.get(storage_id):
+                removed += 1
+                removed_size += size
+            else:
+                click.echo(f'File {storage_id} was not removed.', err=True)
+                failed += 1
+        storage.remove_empty_dirs([storage_id for storage_id, _ in batch if results.get(storage_id)])
+
+    click.echo(f'{removed} orphan files ({removed_size} bytes) were removed, {failed} failed, '
+               f'{len(files)} files were checked.')
+    if failed:
+        raise click.ClickException('Some files were not removed, see errors above.')
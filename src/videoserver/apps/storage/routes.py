@@ -0,0 +1,43 @@
+from flask import Response
+from flask import current_app as app
+from werkzeug.exceptions import NotFound
+
+from videoserver.lib.storage import CachingStorage, InstrumentedStorage, MemoryCachingStorage, find_storage
+from videoserver.lib.views import MethodView
+
+from . import bp
+
+
+class StorageMetrics(MethodView):
+
+    def get(self):
+        """
+        Get storage metrics of a process which handles a request in prometheus text format.
+        Available if `MEDIA_STORAGE_INSTRUMENTATION`, `MEDIA_STORAGE_CACHE` or `MEDIA_STORAGE_MEMORY_CACHE`
+        is enabled.
+        ---
+        produces:
+          - text/plain
+        responses:
+          200:
+            description: Call counts, transferred bytes and latency histograms per storage method and asset type,
+                         hits, misses and size of storage caches
+          404:
+            description: Storage instrumentation and caches are disabled
+        """
+
+        metrics = []
+        for storage_class in (InstrumentedStorage, CachingStorage, MemoryCachingStorage):
+            storage = find_storage(app.fs, storage_class)
+            if storage is not None:
+                metrics.append(storage.export_prometheus())
+        if not metrics:
+            raise NotFound('Storage instrumentation and caches are disabled')
+        return Response(''.join(metrics), mimetype='text/plain; version=0.0.4')
+
+
+# register all urls
+bp.add_url_rule(
+    '/metrics',
+    view_func=StorageMetrics.as_view('storage_metrics')
+)
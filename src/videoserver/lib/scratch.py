@@ -0,0 +1,243 @@
+import logging
+import os
+import shutil
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import current_app as app
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+#: file inside a task directory with a number of bytes reserved by a task
+RESERVATION_FILENAME = '.reserved'
+#: lock file inside `SCRATCH_PATH` which serializes reservations of all processes
+LOCK_FILENAME = '.lock'
+#: seconds between checks of a free scratch space while a task waits for it
+QUOTA_POLL_INTERVAL = 1
+
+
+class ScratchSpaceError(Exception):
+    """
+    Raised when there is no room in a scratch space for a task.
+    """
+    pass
+
+
+class ScratchDir:
+    """
+    Directory for intermediate files of a single task.
+    Files are kept in `SCRATCH_PATH`, files which are known to be not bigger than `SCRATCH_TMPFS_THRESHOLD`
+    are kept in `SCRATCH_TMPFS_PATH` if it's set.
+    """
+
+    def __init__(self, name, reserved=0):
+        self.name = name
+        self.reserved = reserved
+        self.path = os.path.join(app.config.get('SCRATCH_PATH'), name)
+        tmpfs_root = app.config.get('SCRATCH_TMPFS_PATH')
+        self.tmpfs_path = os.path.join(tmpfs_root, name) if tmpfs_root else None
+
+    def get_path(self, filename, size=None):
+        """
+        Return a path for a new file in a scratch directory.
+        :param filename: file name, keep an extension since ffmpeg chooses a format by it
+        :type filename: str
+        :param size: expected max size of a file in bytes, small files are placed on tmpfs
+        :type size: int
+        :return: file path
+        :rtype: str
+        """
+
+        filename = os.path.basename(filename)
+        if self.tmpfs_path and size is not None and size <= app.config.get('SCRATCH_TMPFS_THRESHOLD'):
+            try:
+                os.makedirs(self.tmpfs_path, exist_ok=True)
+                if shutil.disk_usage(self.tmpfs_path).free > size:
+                    return os.path.join(self.tmpfs_path, filename)
+            except OSError as e:
+                logger.warning(f'ScratchDir:get_path:{self.tmpfs_path}: {e}')
+        return os.path.join(self.path, filename)
+
+    def write(self, filename, content):
+        """
+        Save `content` into a scratch directory.
+        :param filename: file name
+        :type filename: str
+        :param content: file content
+        :type content: bytes
+        :return: file path
+        :rtype: str
+        """
+
+        path = self.get_path(filename, len(content))
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def cleanup(self):
+        for path in (self.path, self.tmpfs_path):
+            if path:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def _lock_root(root):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, LOCK_FILENAME), 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _get_reserved(root):
+    """
+    Return a number of bytes reserved by all task directories in `root`.
+    Directories of dead processes of this host (i.e. a killed celery worker) are removed, so their reservations
+    don't hold a quota until `sweep_scratch` runs at the next start.
+    """
+
+    hostname = socket.gethostname()
+    tmpfs_root = app.config.get('SCRATCH_TMPFS_PATH')
+    reserved = 0
+    for entry in os.scandir(root):
+        if entry.name.startswith('.'):
+            continue
+        if _is_dead_local(entry.name, hostname):
+            logger.warning(f'Removed scratch directory {entry.name} of a dead process')
+            shutil.rmtree(entry.path, ignore_errors=True)
+            if tmpfs_root:
+                shutil.rmtree(os.path.join(tmpfs_root, entry.name), ignore_errors=True)
+            continue
+        try:
+            with open(os.path.join(entry.path, RESERVATION_FILENAME)) as f:
+                reserved += int(f.read() or 0)
+        except (OSError, ValueError):
+            continue
+    return reserved
+
+
+def _create_dir(name, reserve):
+    """
+    Create a task directory once `reserve` bytes fit into `SCRATCH_QUOTA` and a free disk space.
+    Waits up to `SCRATCH_QUOTA_TIMEOUT` seconds for other tasks to release a space.
+    """
+
+    root = app.config.get('SCRATCH_PATH')
+    quota = app.config.get('SCRATCH_QUOTA')
+    if quota and reserve > quota:
+        raise ScratchSpaceError(f'Task needs {reserve} bytes of scratch space, quota is {quota} bytes.')
+
+    deadline = time.monotonic() + app.config.get('SCRATCH_QUOTA_TIMEOUT')
+    while True:
+        with _lock_root(root):
+            reserved = _get_reserved(root)
+            free = shutil.disk_usage(root).free
+            if (not quota or reserved + reserve <= quota) and reserve <= free:
+                path = os.path.join(root, name)
+                os.makedirs(path)
+                with open(os.path.join(path, RESERVATION_FILENAME), 'w') as f:
+                    f.write(str(reserve))
+                return
+        if time.monotonic() >= deadline:
+            raise ScratchSpaceError(f'Scratch space is full: {reserved} of {quota} bytes are reserved, '
+                                    f'{free} bytes are free, task needs {reserve} bytes.')
+        time.sleep(QUOTA_POLL_INTERVAL)
+
+
+@contextmanager
+def scratch_dir(reserve=0):
+    """
+    Create a directory for intermediate files of a task, directory with all its files is removed on exit.
+    :param reserve: number of bytes a task expects to write, counted against `SCRATCH_QUOTA`
+    :type reserve: int
+    :return: scratch directory
+    :rtype: ScratchDir
+    :raise ScratchSpaceError: if space was not released by other tasks within `SCRATCH_QUOTA_TIMEOUT`
+    """
+
+    # host and pid let `sweep_scratch` find directories of dead processes
+    name = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:12]}'
+    _create_dir(name, reserve)
+    scratch = ScratchDir(name, reserve)
+    try:
+        yield scratch
+    finally:
+        scratch.cleanup()
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _parse_dir_name(name):
+    """
+    Return host and pid of a process which created a task directory `name`.
+    :raise ValueError: if `name` is not a name of a task directory
+    """
+
+    host, pid, _ = name.rsplit('-', 2)
+    return host, int(pid)
+
+
+def _is_dead_local(name, hostname):
+    """
+    Check if a task directory `name` was created by a process of `hostname` which is not running anymore.
+    """
+
+    try:
+        host, pid = _parse_dir_name(name)
+    except ValueError:
+        return False
+    return host == hostname and not _is_alive(pid)
+
+
+def sweep_scratch():
+    """
+    Remove task directories left by processes of this host which are not running anymore,
+    and directories of any host which are older than `SCRATCH_STALE_AGE`.
+    :return: number of removed directories
+    :rtype: int
+    """
+
+    hostname = socket.gethostname()
+    cutoff = time.time() - app.config.get('SCRATCH_STALE_AGE')
+    removed = 0
+    for root in (app.config.get('SCRATCH_PATH'), app.config.get('SCRATCH_TMPFS_PATH')):
+        if not root or not os.path.isdir(root):
+            continue
+        for entry in os.scandir(root):
+            try:
+                host, pid = _parse_dir_name(entry.name)
+            except ValueError:
+                # not a task directory
+                continue
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if (host != hostname or _is_alive(pid)) and entry.stat().st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+
+    if removed:
+        logger.info(f'Removed {removed} stale scratch directories')
+    return removed
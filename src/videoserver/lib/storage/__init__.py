@@ -1,12 +1,34 @@
+from .amazon_s3_storage import AmazonS3Storage
+from .caching_storage import CachingStorage
 from .file_system_storage import FileSystemStorage
+from .instrumented_storage import InstrumentedStorage
+from .memory_caching_storage import MemoryCachingStorage
+from .wrapper import StorageWrapper, find_storage, unwrap_storage
 
 
-def get_media_storage(name):
+def get_media_storage(name, cache=False, memory_cache=False, instrument=False):
     """
     Instantinate and return madia storage instance depending on `name`.
+    :param name: storage name. Options: 'filesystem', 'amazon'
+    :type name: str
+    :param cache: wrap storage with a local disk read-through cache
+    :type cache: bool
+    :param memory_cache: keep small files (i.e. thumbnails) in an in-process LRU cache
+    :type memory_cache: bool
+    :param instrument: collect call counts, bytes and latencies of a storage backend, caches are not instrumented
+    :type instrument: bool
     """
     if str.lower(name) == 'filesystem':
-        return FileSystemStorage()
-    if str.lower(name) == 'amazon':
+        storage = FileSystemStorage()
+    elif str.lower(name) == 'amazon':
+        storage = AmazonS3Storage()
+    else:
         return None
-    return None
+
+    if instrument:
+        storage = InstrumentedStorage(storage)
+    if cache:
+        storage = CachingStorage(storage)
+    if memory_cache:
+        storage = MemoryCachingStorage(storage)
+    return storage
@@ -0,0 +1,403 @@
+import io
+import logging
+
+from flask import current_app as app
+
+from .interface import MediaStorageInterface
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+#: max number of keys S3 accepts in one DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+
+class AmazonS3Storage(MediaStorageInterface):
+    """
+    Amazon S3 storage.
+    Works with any S3 compatible object storage (MinIO, Ceph...), use `AWS_S3_ENDPOINT_URL` to point to it.
+    Storage ids are object keys in `AWS_S3_BUCKET` bucket, built the same way as fs storage paths.
+    """
+
+    def __init__(self):
+        if boto3 is None:
+            raise RuntimeError("'boto3' package is required for Amazon S3 storage, install 'videoserver[s3]'.")
+        self._client = None
+
+    @property
+    def client(self):
+        """
+        S3 client, created once per storage instance.
+        Client keeps a pool of `AWS_S3_MAX_POOL_CONNECTIONS` http connections which is reused between requests.
+        :return: s3 client
+        :rtype: botocore.client.S3
+        """
+
+        if self._client is None:
+            self._client = boto3.session.Session().client(
+                's3',
+                endpoint_url=app.config.get('AWS_S3_ENDPOINT_URL') or None,
+                region_name=app.config.get('AWS_S3_REGION'),
+                aws_access_key_id=app.config.get('AWS_ACCESS_KEY_ID') or None,
+                aws_secret_access_key=app.config.get('AWS_SECRET_ACCESS_KEY') or None,
+                config=Config(
+                    max_pool_connections=app.config.get('AWS_S3_MAX_POOL_CONNECTIONS'),
+                    retries={'max_attempts': app.config.get('MAX_RETRIES')},
+                    s3={'addressing_style': app.config.get('AWS_S3_ADDRESSING_STYLE')},
+                )
+            )
+        return self._client
+
+    @property
+    def bucket(self):
+        return app.config.get('AWS_S3_BUCKET')
+
+    @staticmethod
+    def _get_transfer_config():
+        return TransferConfig(
+            multipart_threshold=app.config.get('AWS_S3_MULTIPART_THRESHOLD'),
+            multipart_chunksize=app.config.get('AWS_S3_MULTIPART_CHUNK_SIZE'),
+        )
+
+    def get(self, storage_id):
+        """
+        Read and return a file based on `storage_id`
+        :param storage_id: unique starage id
+        :type storage_id: str
+        :return: file
+        :rtype: bytes
+        """
+
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=storage_id)['Body'].read()
+        except ClientError as e:
+            logger.error(f'AmazonS3Storage:get:{storage_id}: {e}')
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(storage_id) from e
+            raise e
+
+    def get_range(self, storage_id, start, length):
+        """
+        Read and return a file's chunks based on `storage_id` using ranged GET request
+        :param storage_id: unique starage id
+        :type storage_id: str
+        :param start: start file's position to read
+        :param length: the number of bytes to be read from the file
+        :return: file
+        :rtype: bytes
+        """
+
+        if not length:
+            return b''
+        try:
+            return self._get_object(storage_id, start, length)['Body'].read()
+        except ClientError as e:
+            # range starts after the end of a file
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return b''
+            logger.error(f'AmazonS3Storage:get_range:{storage_id}: {e}')
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(storage_id) from e
+            raise e
+
+    def get_stream(self, storage_id, start=None, length=None, chunk_size=None):
+        """
+        Return an iterator over a file's chunks based on `storage_id`.
+        Object is requested right away, so a missing file raises before the first chunk is requested.
+        :param storage_id: unique starage id
+        :type storage_id: str
+        :param start: start file's position to read, read from the beginning if not set
+        :type start: int
+        :param length: the number of bytes to be read from the file, read until the end if not set
+        :type length: int
+        :param chunk_size: max size of a single chunk, `MEDIA_STORAGE_CHUNK_SIZE` is used if not set
+        :type chunk_size: int
+        :return: file chunks
+        :rtype: generator
+        """
+
+        if not chunk_size:
+            chunk_size = app.config.get('MEDIA_STORAGE_CHUNK_SIZE')
+        if length == 0:
+            return iter(())
+
+        try:
+            body = self._get_object(storage_id, start, length)['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return iter(())
+            logger.error(f'AmazonS3Storage:get_stream:{storage_id}: {e}')
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(storage_id) from e
+            raise e
+
+        return self._iter_body(body, chunk_size)
+
+    @staticmethod
+    def _iter_body(body, chunk_size):
+        """
+        Read a response body by chunks and release a connection back to a pool when it's done.
+        :param body: response body
+        :type body: botocore.response.StreamingBody
+        :param chunk_size: max size of a single chunk
+        :type chunk_size: int
+        :return: file chunks
+        :rtype: generator
+        """
+
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    def _get_object(self, storage_id, start=None, length=None):
+        """
+        GET an object, use `Range` header if `start` or `length` is set.
+        """
+
+        kwargs = {'Bucket': self.bucket, 'Key': storage_id}
+        if start or length is not None:
+            start = start or 0
+            end = start + length - 1 if length is not None else ''
+            kwargs['Range'] = f'bytes={start}-{end}'
+        return self.client.get_object(**kwargs)
+
+    def put(self, content, filename, project_id=None, asset_type='project', storage_id=None, content_type=None,
+            override=True):
+        """
+        Save file into a s3 storage.
+        Files bigger than `AWS_S3_MULTIPART_THRESHOLD` are uploaded using multipart upload.
+        :param content: file to save
+        :type content: bytes
+        :param filename: name which will be used when store a file
+        :type filename: str
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param asset_type: asset type
+        :type asset_type: str
+        :param storage_id: unique starage id of file
+        :type storage_id: str
+        :param content_type: content type of file
+        :type content_type: str
+        :return: storage id of just saved file
+        :rtype: str
+        """
+
+        return self.put_stream(io.BytesIO(content), filename, project_id, asset_type, storage_id, content_type,
+                               override)
+
+    def put_stream(self, stream, filename, project_id=None, asset_type='project', storage_id=None,
+                   content_type=None, override=True):
+        """
+        Save file-like object into a s3 storage chunk by chunk.
+        Files bigger than `AWS_S3_MULTIPART_THRESHOLD` are uploaded using multipart upload,
+        parts are uploaded concurrently through pooled connections.
+        :param stream: file-like object to read a file from
+        :type stream: io.RawIOBase
+        :param filename: name which will be used when store a file
+        :type filename: str
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param asset_type: asset type
+        :type asset_type: str
+        :param storage_id: unique starage id of file
+        :type storage_id: str
+        :param content_type: content type of file
+        :type content_type: str
+        :return: storage id of just saved file
+        :rtype: str
+        """
+
+        storage_id = self._generate_storage_id(filename, project_id, asset_type, storage_id)
+        if not override and self._exists(storage_id):
+            raise Exception(f'File {storage_id} already exists, use "replace" method instead.')
+
+        self._upload(stream, storage_id, content_type)
+        logger.info(f"Saved file '{storage_id}' to s3 storage")
+        return storage_id
+
+    def _upload(self, stream, storage_id, content_type=None):
+        """
+        Upload file-like object, `upload_fileobj` switches to multipart upload for big files
+        and aborts it if something goes wrong.
+        """
+
+        extra_args = {'ContentType': content_type} if content_type else None
+        try:
+            self.client.upload_fileobj(stream, self.bucket, storage_id, ExtraArgs=extra_args,
+                                       Config=self._get_transfer_config())
+        except Exception as e:
+            logger.error(f'AmazonS3Storage:upload:{storage_id}: {e}')
+            raise e
+
+    def stat(self, storage_id):
+        """
+        Return size, modification time and etag of an object, using HEAD request.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: dict with `size`, `mtime` and `etag`
+        :rtype: dict
+        """
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=storage_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(storage_id) from e
+            logger.error(f'AmazonS3Storage:stat:{storage_id}: {e}')
+            raise e
+        return {
+            'size': head['ContentLength'],
+            'mtime': head['LastModified'],
+            'etag': head['ETag'].strip('"'),
+        }
+
+    def _exists(self, storage_id):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=storage_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise e
+        return True
+
+    def copy(self, src_storage_id, dst_filename, project_id=None, asset_type='project', storage_id=None,
+             content_type=None):
+        """
+        Copy a file inside a s3 storage, data is not transferred through a video server.
+        Big objects are copied using multipart copy.
+        :param src_storage_id: storage id of a file to copy
+        :type src_storage_id: str
+        :param dst_filename: name which will be used when store a copy
+        :type dst_filename: str
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param asset_type: asset type
+        :type asset_type: str
+        :param storage_id: unique starage id of file
+        :type storage_id: str
+        :param content_type: content type of file
+        :type content_type: str
+        :return: storage id of a copy
+        :rtype: str
+        """
+
+        storage_id = self._generate_storage_id(dst_filename, project_id, asset_type, storage_id)
+        try:
+            self.client.copy(
+                {'Bucket': self.bucket, 'Key': src_storage_id},
+                self.bucket,
+                storage_id,
+                Config=self._get_transfer_config()
+            )
+        except Exception as e:
+            logger.error(f'AmazonS3Storage:copy:{src_storage_id}:{storage_id}: {e}')
+            raise e
+
+        logger.info(f"Copied file '{src_storage_id}' to '{storage_id}' in s3 storage")
+        return storage_id
+
+    def replace(self, content, storage_id, content_type=None):
+        """
+        Replace a file in the storage, object is replaced atomically by S3.
+        :param content: file to replace with
+        :type content: bytes
+        :param storage_id: starage id of file for replacement
+        :type storage_id: str
+        :param content_type: content type of file
+        :type content_type: str
+        """
+
+        self._upload(io.BytesIO(content), storage_id, content_type)
+        logger.info(f'Replaced file "{storage_id}" in s3 storage')
+
+    def delete(self, storage_id):
+        """
+        Delete a file from the storage
+        :param storage_id: starage id of file to remove
+        :type storage_id: str
+        """
+
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=storage_id)
+        except Exception as e:
+            logger.error(f'AmazonS3Storage:delete:{storage_id}: {e}')
+            raise e
+        logger.info(f"Removed '{storage_id}' from s3 storage")
+
+    def delete_many(self, storage_ids):
+        """
+        Delete several objects from the storage by batches of `DELETE_BATCH_SIZE` keys,
+        one request per batch.
+        :param storage_ids: storage ids of files to remove
+        :type storage_ids: list
+        :return: `True` for every storage id which was removed or didn't exist, `False` if removal failed
+        :rtype: dict
+        """
+
+        storage_ids = list(storage_ids)
+        results = {storage_id: True for storage_id in storage_ids}
+        for i in range(0, len(storage_ids), DELETE_BATCH_SIZE):
+            keys = [{'Key': storage_id} for storage_id in storage_ids[i:i + DELETE_BATCH_SIZE]]
+            try:
+                resp = self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys, 'Quiet': True})
+            except Exception as e:
+                logger.error(f'AmazonS3Storage:delete_many: {e}')
+                results.update((key['Key'], False) for key in keys)
+                continue
+            for error in resp.get('Errors', []):
+                logger.error(f"AmazonS3Storage:delete_many:{error['Key']}: {error.get('Message')}")
+                results[error['Key']] = False
+
+        logger.info(f"Removed {sum(results.values())} objects from s3 storage")
+        return results
+
+    def delete_dir(self, storage_id):
+        """
+        Delete all objects with the same prefix as `storage_id` has.
+        Objects are listed and deleted in batches of `DELETE_BATCH_SIZE` keys.
+        :param storage_id: unique storage
+        :type storage_id: str
+        """
+
+        prefix = storage_id.rsplit('/', 1)[0] + '/'
+        removed = 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix,
+                                       PaginationConfig={'PageSize': DELETE_BATCH_SIZE}):
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if not keys:
+                continue
+            resp = self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys, 'Quiet': True})
+            for error in resp.get('Errors', []):
+                logger.error(f"AmazonS3Storage:delete_dir:{error['Key']}: {error.get('Message')}")
+            removed += len(keys) - len(resp.get('Errors', []))
+
+        if removed:
+            logger.info(f"Removed {removed} objects with prefix '{prefix}' from s3 storage")
+        else:
+            logger.warning(f"Prefix '{prefix}' was not found in s3 storage.")
+
+    def get_url(self, storage_id):
+        """
+        Return presigned url which lets a client to read a file directly from S3
+        during `AWS_S3_PRESIGNED_URL_EXPIRES` seconds.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: url
+        :rtype: str
+        """
+
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': storage_id},
+            ExpiresIn=app.config.get('AWS_S3_PRESIGNED_URL_EXPIRES')
+        )
@@ -0,0 +1,561 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app as app
+
+from videoserver.lib.scratch import scratch_dir
+from .wrapper import StorageWrapper
+
+logger = logging.getLogger(__name__)
+
+#: file name of a whole cached object inside object's cache directory
+OBJECT_FILENAME = 'object'
+#: file name prefix of cached blocks of an object which is not cached whole
+BLOCK_FILENAME = 'block'
+
+
+class CachingStorage(StorageWrapper):
+    """
+    Read-through cache which keeps objects of a (remote) storage on a local disk.
+
+    Cache layout mirrors storage ids: <MEDIA_STORAGE_CACHE_PATH>/<storage_id>/object-<version> for whole objects
+    and <MEDIA_STORAGE_CACHE_PATH>/<storage_id>/block-<version>-<number> for ranges, so every process on
+    a host (web workers and celery workers) shares the same cache and `delete_dir` drops a whole project at once.
+    Ranges are cached by blocks of `MEDIA_STORAGE_CACHE_BLOCK_SIZE` bytes aligned to a block size, so random
+    ranges requested by a player reuse the same files.
+
+    <version> is built from an etag returned by wrapped storage's `stat`, which is called on every read,
+    so an object replaced (i.e. by `edit_video`) or removed on another host is never served from a stale cache.
+    Files of older versions are removed when a new version is cached.
+
+    Cache size is bounded by `MEDIA_STORAGE_CACHE_SIZE` bytes, least recently used files are evicted first.
+    Every process keeps its own LRU index in memory, it's loaded from a disk on the first write. When the limit
+    is exceeded the index is merged with a disk (files' mtime is updated on every hit), so files written by other
+    processes are taken into account. Disk is scanned outside of a lock, so hits are never blocked by it.
+    """
+
+    def __init__(self, storage):
+        super().__init__(storage)
+        self._index = None
+        self._index_size = 0
+        self._evicting = False
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'hit_bytes': 0, 'miss_bytes': 0, 'evictions': 0, 'stale': 0}
+
+    @staticmethod
+    def _get_cache_dir(storage_id):
+        return os.path.join(app.config.get('MEDIA_STORAGE_CACHE_PATH'), storage_id)
+
+    @staticmethod
+    def _versioned(name, version):
+        return f'{name}-{version}' if version else name
+
+    def _get_object_path(self, storage_id, version=''):
+        return os.path.join(self._get_cache_dir(storage_id), self._versioned(OBJECT_FILENAME, version))
+
+    def _get_block_path(self, storage_id, version, number):
+        return os.path.join(self._get_cache_dir(storage_id), f'{self._versioned(BLOCK_FILENAME, version)}-{number}')
+
+    def _get_version(self, storage_id):
+        """
+        Return a version of an object in a wrapped storage, it's a part of names of cached files.
+        :return: version or empty string if wrapped storage doesn't support `stat`
+        :rtype: str
+        :raise FileNotFoundError: if file doesn't exist
+        """
+
+        stat = self.storage.stat(storage_id)
+        if not stat or not stat.get('etag'):
+            return ''
+        # etag may contain characters which are not allowed in file names
+        return hashlib.sha1(stat['etag'].encode()).hexdigest()[:16]
+
+    def get_stats(self):
+        """
+        Return cache hit/miss counters of the current process.
+        :return: stats
+        :rtype: dict
+        """
+
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = self._index_size
+            stats['files'] = len(self._index or {})
+        return stats
+
+    def export_prometheus(self, prefix='videoserver_storage_cache'):
+        """
+        Return cache counters of the current process in prometheus text exposition format.
+        `size_bytes` and `files` are known only after a process has added a file to a cache.
+        :param prefix: prefix of metric names
+        :type prefix: str
+        :return: metrics
+        :rtype: str
+        """
+
+        stats = self.get_stats()
+        lines = []
+        for name in ('hits', 'misses', 'hit_bytes', 'miss_bytes', 'evictions', 'stale'):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {stats[name]}')
+        for name, key in (('size_bytes', 'size'), ('files', 'files')):
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {stats[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def get(self, storage_id):
+        """
+        Read and return a file based on `storage_id`, whole object is cached on a local disk.
+        """
+
+        version = self._get_version(storage_id)
+        object_path = self._get_object_path(storage_id, version)
+        content = self._read_cached(object_path)
+        if content is None:
+            self._download(storage_id, version)
+            content = self._read_cached(object_path, count_hit=False)
+            if content is None:
+                # file was evicted right away, cache is smaller than a file
+                content = self.storage.get(storage_id)
+        return content
+
+    def get_range(self, storage_id, start, length):
+        """
+        Read and return a file's chunks based on `storage_id`.
+        Range is read from a whole cached object if there is one, otherwise blocks which cover a range are cached.
+        """
+
+        version = self._get_version(storage_id)
+        content = self._read_cached(self._get_object_path(storage_id, version), start, length)
+        if content is not None:
+            return content
+
+        block_size = app.config.get('MEDIA_STORAGE_CACHE_BLOCK_SIZE')
+        first = start // block_size
+        blocks = []
+        missed = None
+        for number in range(first, (start + length - 1) // block_size + 1):
+            block_path = self._get_block_path(storage_id, version, number)
+            block = self._read_cached(block_path, count_hit=False)
+            if block is None:
+                if missed is None:
+                    self._remove_stale(storage_id, version)
+                    missed = 0
+                block = self.storage.get_range(storage_id, number * block_size, block_size)
+                missed += len(block)
+                self._write_cached(block_path, lambda f: f.write(block))
+            blocks.append(block)
+            if len(block) < block_size:
+                # the last block of an object
+                break
+
+        offset = start - first * block_size
+        content = b''.join(blocks)[offset:offset + length]
+        if missed is None:
+            self._count_hit(len(content))
+        else:
+            self._count_miss(missed)
+        return content
+
+    def get_stream(self, storage_id, start=None, length=None, chunk_size=None):
+        """
+        Return an iterator over a file's chunks based on `storage_id`.
+        Cached object is streamed from a local disk. A whole object which is not cached yet is saved to
+        a cache while it's streamed to a caller. Ranges of not cached objects are passed through.
+        """
+
+        if not chunk_size:
+            chunk_size = app.config.get('MEDIA_STORAGE_CHUNK_SIZE')
+
+        version = self._get_version(storage_id)
+        object_path = self._get_object_path(storage_id, version)
+        try:
+            rb = open(object_path, 'rb')
+        except FileNotFoundError:
+            pass
+        else:
+            self._touch(object_path)
+            self._count_hit(max(os.fstat(rb.fileno()).st_size - (start or 0), 0) if length is None else length)
+            if start:
+                rb.seek(start)
+            return self._iter_file(rb, length, chunk_size)
+
+        chunks = self.storage.get_stream(storage_id, start=start, length=length, chunk_size=chunk_size)
+        if start or length is not None:
+            self._count_miss(length or 0)
+            return chunks
+        self._remove_stale(storage_id, version)
+        return self._iter_and_cache(chunks, object_path)
+
+    @staticmethod
+    def _iter_file(rb, length, chunk_size):
+        with rb:
+            remaining = length
+            while remaining is None or remaining > 0:
+                chunk = rb.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def _iter_and_cache(self, chunks, object_path):
+        """
+        Yield chunks and write them into a cache, file is added to a cache only if all chunks were read.
+        """
+
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = self._get_tmp_path(object_path)
+        size = 0
+        try:
+            with open(tmp_path, 'xb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            os.replace(tmp_path, object_path)
+            self._count_miss(size)
+            self._add_to_index(object_path, size)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @contextmanager
+    def open_local(self, storage_id):
+        """
+        Provide a file as a path on a local file system, a whole cached object is used if storage doesn't
+        keep files locally. Object is downloaded into a cache if it's not cached yet.
+        Cached object is hard linked into a scratch directory, so it can be opened any number of times
+        while the context is active, even if it's evicted by another process meanwhile. It's copied if
+        a scratch directory is on another file system.
+        """
+
+        if self.storage.get_local_path(storage_id):
+            with self.storage.open_local(storage_id) as file_path:
+                yield file_path
+            return
+
+        version = self._get_version(storage_id)
+        object_path = self._get_object_path(storage_id, version)
+        if not os.path.exists(object_path):
+            self._download(storage_id, version)
+        else:
+            self._count_hit(os.path.getsize(object_path))
+        with self._pin(storage_id, object_path) as file_path:
+            if file_path:
+                # the most recently used object is the last to be evicted
+                self._touch(object_path)
+                yield file_path
+                return
+
+        # file was evicted right away, cache is smaller than a file
+        with self.storage.open_local(storage_id) as file_path:
+            yield file_path
+
+    @contextmanager
+    def _pin(self, storage_id, object_path):
+        """
+        Hard link a cached object into a scratch directory, a link is removed on exit.
+        Object is copied if a scratch directory is on another file system.
+        :return: context manager which yields a file path or `None` if object is not cached anymore
+        :rtype: contextlib.AbstractContextManager
+        """
+
+        scratch_root = app.config.get('SCRATCH_PATH')
+        os.makedirs(scratch_root, exist_ok=True)
+        try:
+            stat = os.stat(object_path)
+        except FileNotFoundError:
+            yield None
+            return
+
+        same_device = os.stat(scratch_root).st_dev == stat.st_dev
+        with scratch_dir(reserve=0 if same_device else stat.st_size) as scratch:
+            # extension is kept, ffmpeg chooses a format by it
+            file_path = scratch.get_path(os.path.basename(storage_id))
+            try:
+                if same_device:
+                    os.link(object_path, file_path)
+                else:
+                    shutil.copyfile(object_path, file_path)
+            except FileNotFoundError:
+                # evicted by another process
+                file_path = None
+            yield file_path
+
+    def put(self, content, filename, project_id=None, asset_type='project', storage_id=None, content_type=None,
+            **kwargs):
+        """
+        Save file into a wrapped storage and into a cache.
+        """
+
+        storage_id = super().put(content, filename, project_id=project_id, asset_type=asset_type,
+                                 storage_id=storage_id, content_type=content_type, **kwargs)
+        self._invalidate(storage_id)
+        self._cache_written(storage_id, content)
+        return storage_id
+
+    def put_stream(self, stream, filename, project_id=None, asset_type='project', storage_id=None,
+                   content_type=None, **kwargs):
+        storage_id = super().put_stream(stream, filename, project_id=project_id, asset_type=asset_type,
+                                        storage_id=storage_id, content_type=content_type, **kwargs)
+        self._invalidate(storage_id)
+        return storage_id
+
+    def copy(self, src_storage_id, dst_filename, project_id=None, asset_type='project', storage_id=None,
+             content_type=None):
+        storage_id = super().copy(src_storage_id, dst_filename, project_id=project_id, asset_type=asset_type,
+                                  storage_id=storage_id, content_type=content_type)
+        self._invalidate(storage_id)
+        return storage_id
+
+    def replace(self, content, storage_id, content_type=None):
+        """
+        Replace a file in a wrapped storage, new content is written into a cache as well,
+        so tasks which run right after an edit read a video from a local disk.
+        """
+
+        self._invalidate(storage_id)
+        super().replace(content, storage_id, content_type=content_type)
+        self._invalidate(storage_id)
+        self._cache_written(storage_id, content)
+
+    def delete(self, storage_id):
+        super().delete(storage_id)
+        self._invalidate(storage_id)
+
+    def delete_dir(self, storage_id):
+        super().delete_dir(storage_id)
+        self._invalidate(os.path.dirname(storage_id))
+
+    def delete_many(self, storage_ids):
+        storage_ids = list(storage_ids)
+        results = super().delete_many(storage_ids)
+        for storage_id in storage_ids:
+            self._invalidate(storage_id)
+        return results
+
+    def _download(self, storage_id, version):
+        """
+        Save a whole object into a cache.
+        """
+
+        self._remove_stale(storage_id, version)
+        for _ in self._iter_and_cache(self.storage.get_stream(storage_id), self._get_object_path(storage_id, version)):
+            pass
+
+    def _cache_written(self, storage_id, content):
+        """
+        Save just written content into a cache under its new version.
+        """
+
+        try:
+            version = self._get_version(storage_id)
+        except FileNotFoundError:
+            # removed by someone else already
+            return
+        self._write_cached(self._get_object_path(storage_id, version), lambda f: f.write(content))
+
+    def _remove_stale(self, storage_id, version):
+        """
+        Remove cached object and blocks of versions other than `version`.
+        """
+
+        if not version:
+            return
+        cache_dir = self._get_cache_dir(storage_id)
+        try:
+            names = os.listdir(cache_dir)
+        except FileNotFoundError:
+            return
+
+        current = (self._versioned(OBJECT_FILENAME, version), self._versioned(BLOCK_FILENAME, version) + '-')
+        removed = []
+        for name in names:
+            path = os.path.join(cache_dir, name)
+            if name.endswith('.tmp') or name == current[0] or name.startswith(current[1]) or not os.path.isfile(path):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed.append(path)
+
+        if removed:
+            logger.info(f"Removed stale versions of '{storage_id}' from storage cache")
+            with self._lock:
+                self.stats['stale'] += len(removed)
+                if self._index:
+                    for path in removed:
+                        self._index_size -= self._index.pop(path, 0)
+
+    def _read_cached(self, path, start=None, length=None, count_hit=True):
+        """
+        Read a cached file or its part.
+        :return: content or `None` if file is not cached
+        :rtype: bytes
+        """
+
+        try:
+            with open(path, 'rb') as rb:
+                if start:
+                    rb.seek(start)
+                content = rb.read() if length is None else rb.read(length)
+        except FileNotFoundError:
+            return None
+
+        self._touch(path)
+        if count_hit:
+            self._count_hit(len(content))
+        return content
+
+    def _write_cached(self, path, write):
+        """
+        Atomically add a file to a cache.
+        """
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = self._get_tmp_path(path)
+            try:
+                with open(tmp_path, 'xb') as f:
+                    write(f)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        except OSError as e:
+            # cache is an optimisation, storage operation must not fail because of it
+            logger.warning(f'CachingStorage:write:{path}: {e}')
+            return
+        self._add_to_index(path, os.path.getsize(path))
+
+    @staticmethod
+    def _get_tmp_path(path):
+        return os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.{uuid.uuid4().hex}.tmp')
+
+    def _invalidate(self, storage_id_or_dir):
+        """
+        Remove cached object with all its blocks, or all cached objects in a directory.
+        """
+
+        cache_dir = self._get_cache_dir(storage_id_or_dir)
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            logger.info(f"Invalidated '{storage_id_or_dir}' in storage cache")
+
+        prefix = os.path.join(cache_dir, '')
+        with self._lock:
+            if self._index:
+                for path in [p for p in self._index if p.startswith(prefix)]:
+                    self._index_size -= self._index.pop(path)
+
+    def _touch(self, path):
+        """
+        Mark a file as recently used, both in an index and on a disk for other processes.
+        """
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if self._index is not None and path in self._index:
+                self._index.move_to_end(path)
+
+    def _add_to_index(self, path, size):
+        """
+        Add a file to an LRU index and evict least recently used files if a cache is too big.
+        Only one thread of a process evicts files at a time.
+        """
+
+        if self._index is None:
+            self._load_index()
+        with self._lock:
+            self._index_size -= self._index.pop(path, 0)
+            self._index[path] = size
+            self._index_size += size
+            if self._evicting or self._index_size <= app.config.get('MEDIA_STORAGE_CACHE_SIZE'):
+                return
+            self._evicting = True
+        try:
+            self._evict()
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def _load_index(self):
+        """
+        Build LRU index from files in a cache directory, unless another thread has built it meanwhile.
+        """
+
+        files = self._scan()
+        with self._lock:
+            if self._index is None:
+                self._index = OrderedDict(files)
+                self._index_size = sum(self._index.values())
+
+    @staticmethod
+    def _scan():
+        """
+        Return (path, size) of all files in a cache directory ordered by mtime, the least recently used first.
+        :rtype: list
+        """
+
+        files = []
+        for root, _, filenames in os.walk(app.config.get('MEDIA_STORAGE_CACHE_PATH')):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime_ns, path, stat.st_size))
+        return [(path, size) for _, path, size in sorted(files)]
+
+    def _evict(self):
+        """
+        Remove least recently used files until cache size is below 90% of `MEDIA_STORAGE_CACHE_SIZE`.
+        """
+
+        # other processes may have added or used files since the index was loaded
+        files = self._scan()
+        limit = app.config.get('MEDIA_STORAGE_CACHE_SIZE') * 0.9
+        evicted = []
+        with self._lock:
+            index = OrderedDict(files)
+            # files added by this process while a disk was scanned are the most recent ones
+            for path, size in self._index.items():
+                if path not in index:
+                    index[path] = size
+            self._index = index
+            self._index_size = sum(index.values())
+            while self._index and self._index_size > limit:
+                path, size = self._index.popitem(last=False)
+                self._index_size -= size
+                evicted.append(path)
+            self.stats['evictions'] += len(evicted)
+
+        for path in evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _count_hit(self, size):
+        with self._lock:
+            self.stats['hits'] += 1
+            self.stats['hit_bytes'] += size
+
+    def _count_miss(self, size):
+        with self._lock:
+            self.stats['misses'] += 1
+            self.stats['miss_bytes'] += size
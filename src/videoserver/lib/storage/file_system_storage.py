@@ -1,14 +1,50 @@
+import bisect
+import errno
+import hashlib
+import mmap
 import os
+import re
 import shutil
 import logging
-from datetime import datetime
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 from flask import current_app as app
+from pymongo import ReturnDocument
 
 from .interface import MediaStorageInterface
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
+#: ioctl request to share file's extents with another file (linux, btrfs/xfs/overlayfs...)
+FICLONE = 0x40049409
+#: number of points on a consistent hashing ring per unit of volume's weight
+VOLUME_RING_POINTS = 128
+
+
+class _HashingWriter:
+    """
+    File object wrapper which calculates sha256 of everything written through it.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
 
 class FileSystemStorage(MediaStorageInterface):
     """
@@ -16,8 +52,72 @@ class FileSystemStorage(MediaStorageInterface):
     Use file system to store files.
     """
 
+    #: per-process table of opened memory maps used by range reads, path -> (file signature, mmap)
+    _mmaps = OrderedDict()
+    _mmaps_lock = threading.Lock()
+
+    def __init__(self):
+        self._volumes = None
+        self._volumes_config = None
+        self._ring = []
+
+    def _get_volumes(self):
+        """
+        Parse `FS_MEDIA_STORAGE_VOLUMES` and build a consistent hashing ring for them.
+        Result is cached until the setting is changed.
+        :return: volume name -> {'path': root path, 'weight': weight}
+        :rtype: collections.OrderedDict
+        """
+
+        config = app.config.get('FS_MEDIA_STORAGE_VOLUMES')
+        if self._volumes is not None and config == self._volumes_config:
+            return self._volumes
+
+        if isinstance(config, str):
+            config = [item.strip().split(':') for item in config.split(',') if item.strip()]
+
+        volumes = OrderedDict()
+        for item in config or []:
+            name, path, weight = (list(item) + [1])[:3]
+            if not name or re.fullmatch(r'[0-9a-f]{2}|\d+|\..*', name):
+                # volume names must not clash with directories of 'date' or 'hash' layouts
+                raise ValueError(f"Invalid volume name '{name}' in FS_MEDIA_STORAGE_VOLUMES")
+            volumes[name] = {'path': path, 'weight': float(weight)}
+        if volumes and app.config.get('FS_MEDIA_STORAGE_DEDUPLICATE'):
+            raise ValueError("FS_MEDIA_STORAGE_DEDUPLICATE can't be used with FS_MEDIA_STORAGE_VOLUMES, "
+                             "hard links can't cross file systems")
+
+        ring = []
+        for name, volume in volumes.items():
+            for i in range(max(int(volume['weight'] * VOLUME_RING_POINTS), 1)):
+                ring.append((self._hash_key(f'{name}#{i}'), name))
+        ring.sort()
+
+        self._volumes, self._volumes_config, self._ring = volumes, app.config.get('FS_MEDIA_STORAGE_VOLUMES'), ring
+        return volumes
+
     @staticmethod
-    def _get_file_path(storage_id):
+    def _hash_key(key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def _split_volume(self, storage_id):
+        """
+        Split `storage_id` into a root path of its volume and a path relative to it.
+        Storage ids without a volume prefix (or when there are no volumes) are located in `FS_MEDIA_STORAGE_PATH`.
+        :param storage_id: unique starage id
+        :type storage_id: str
+        :return: volume name (`None` for `FS_MEDIA_STORAGE_PATH`), root path, relative path
+        :rtype: tuple
+        """
+
+        volumes = self._get_volumes()
+        if volumes:
+            name, _, path = storage_id.partition('/')
+            if name in volumes:
+                return name, volumes[name]['path'], path
+        return None, app.config.get('FS_MEDIA_STORAGE_PATH'), storage_id
+
+    def _get_file_path(self, storage_id):
         """
         Build and return full file path based on `storage_id`.
         :param storage_id: unique starage id
@@ -26,7 +126,116 @@ class FileSystemStorage(MediaStorageInterface):
         :rtype: str
         """
 
-        return os.path.join(app.config.get('FS_MEDIA_STORAGE_PATH'), storage_id)
+        _, root, path = self._split_volume(storage_id)
+        return os.path.join(root, path)
+
+    def get_volume(self, storage_id):
+        """
+        Return a name of a volume where `storage_id` is located.
+        :param storage_id: unique starage id
+        :type storage_id: str
+        :return: volume name or `None` if file is located in `FS_MEDIA_STORAGE_PATH`
+        :rtype: str
+        """
+
+        return self._split_volume(storage_id)[0]
+
+    def get_roots(self):
+        """
+        Return root paths where files are kept: `FS_MEDIA_STORAGE_PATH` and a path of every volume.
+        :return: volume name (`None` for `FS_MEDIA_STORAGE_PATH`) -> root path
+        :rtype: collections.OrderedDict
+        """
+
+        roots = OrderedDict([(None, app.config.get('FS_MEDIA_STORAGE_PATH'))])
+        for name, volume in self._get_volumes().items():
+            roots[name] = volume['path']
+        return roots
+
+    def choose_volume(self, project_id):
+        """
+        Choose a volume for a project using consistent hashing of a project id on a ring of weighted volumes,
+        so adding a volume moves only a share of projects proportional to its weight.
+        If a volume has less than `FS_MEDIA_STORAGE_VOLUME_MIN_FREE` bytes free, the next volume on a ring is used.
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :return: volume name or `None` if there are no volumes
+        :rtype: str
+        """
+
+        volumes = self._get_volumes()
+        if not volumes:
+            return None
+
+        candidates = []
+        start = bisect.bisect(self._ring, (self._hash_key(str(project_id)),))
+        for i in range(len(self._ring)):
+            name = self._ring[(start + i) % len(self._ring)][1]
+            if name not in candidates:
+                candidates.append(name)
+                if len(candidates) == len(volumes):
+                    break
+
+        min_free = app.config.get('FS_MEDIA_STORAGE_VOLUME_MIN_FREE')
+        for name in candidates:
+            try:
+                if shutil.disk_usage(volumes[name]['path']).free >= min_free:
+                    return name
+            except FileNotFoundError:
+                pass
+            logger.warning(f"Volume '{name}' is full or not available, project {project_id} is placed elsewhere")
+        # every volume is full, let a write fail on the preferred one
+        return candidates[0]
+
+    def generate_project_dir(self, project_id, layout=None, date=None, volume=None):
+        """
+        Build a directory part of storage ids for a new project.
+        When `FS_MEDIA_STORAGE_VOLUMES` are set, directory is prefixed with a name of a volume chosen by
+        `choose_volume`, so a volume is known from a storage id without any lookups.
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param layout: layout name, `MEDIA_STORAGE_LAYOUT` is used if not set
+        :type layout: str
+        :param date: project creation date used by 'date' layout, current date is used if not set
+        :type date: datetime.datetime
+        :param volume: volume name, chosen by `choose_volume` if not set
+        :type volume: str
+        :return: directory
+        :rtype: str
+        """
+
+        project_dir = super().generate_project_dir(project_id, layout=layout, date=date)
+        if not self._get_volumes():
+            return project_dir
+        return f'{volume or self.choose_volume(project_id)}/{project_dir}'
+
+    def get_local_path(self, storage_id):
+        """
+        Return a path to a file in a fs storage.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: absolute file path
+        :rtype: str
+        """
+
+        return os.path.abspath(self._get_file_path(storage_id))
+
+    def stat(self, storage_id):
+        """
+        Return size, modification time and version of a file.
+        Files are always replaced with a new inode, so inode, mtime and size identify file's content.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: dict with `size`, `mtime` and `etag`
+        :rtype: dict
+        """
+
+        stat = os.stat(self._get_file_path(storage_id))
+        return {
+            'size': stat.st_size,
+            'mtime': datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+            'etag': f'{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}',
+        }
 
     def get(self, storage_id):
         """
@@ -48,7 +257,8 @@ class FileSystemStorage(MediaStorageInterface):
 
     def get_range(self, storage_id, start, length):
         """
-        Read and return a file's chunks based on `storage_id`
+        Read and return a file's chunks based on `storage_id`.
+        If `FS_MEDIA_STORAGE_MMAP` is enabled, a range is copied from a memory map of a file.
         :param storage_id: unique starage id
         :type storage_id: str
         :param start: start file's position to read
@@ -58,6 +268,11 @@ class FileSystemStorage(MediaStorageInterface):
         """
 
         try:
+            if app.config.get('FS_MEDIA_STORAGE_MMAP'):
+                media_map = self._get_mmap(self._get_file_path(storage_id))
+                if media_map is not None:
+                    return media_map[start:start + length]
+
             with open(self._get_file_path(storage_id), 'rb') as rb:
                 rb.seek(start)
                 media_file = rb.read(length)
@@ -67,6 +282,148 @@ class FileSystemStorage(MediaStorageInterface):
 
         return media_file
 
+    @classmethod
+    def _get_mmap(cls, file_path):
+        """
+        Return a read-only memory map of a file, reuse already opened map if a file was not changed since.
+        Map is validated against file's inode, mtime and size, so a file replaced by another process is remapped.
+        Least recently used maps are evicted when there are more than `FS_MEDIA_STORAGE_MMAP_CACHE_SIZE` of them.
+        :param file_path: path to a file
+        :type file_path: str
+        :return: memory map or `None` if file is empty and can't be mapped
+        :rtype: mmap.mmap
+        """
+
+        stat = os.stat(file_path)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        with cls._mmaps_lock:
+            cached = cls._mmaps.get(file_path)
+            if cached and cached[0] == signature:
+                cls._mmaps.move_to_end(file_path)
+                return cached[1]
+
+        if not stat.st_size:
+            return None
+
+        with open(file_path, 'rb') as rb:
+            # file could be replaced after `os.stat`, signature must describe the mapped one
+            stat = os.fstat(rb.fileno())
+            if not stat.st_size:
+                return None
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            media_map = mmap.mmap(rb.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with cls._mmaps_lock:
+            cls._mmaps[file_path] = (signature, media_map)
+            cls._mmaps.move_to_end(file_path)
+            # evicted maps are not closed explicitly, streams returned by `get_stream` may still read them,
+            # a map is unmapped when the last stream is released
+            while len(cls._mmaps) > app.config.get('FS_MEDIA_STORAGE_MMAP_CACHE_SIZE'):
+                cls._mmaps.popitem(last=False)
+
+        return media_map
+
+    @classmethod
+    def _invalidate_mmap(cls, path, is_dir=False):
+        """
+        Forget memory maps of a file or of all files in a directory.
+        :param path: file or directory path
+        :type path: str
+        :param is_dir: `path` is a directory
+        :type is_dir: bool
+        """
+
+        with cls._mmaps_lock:
+            if is_dir:
+                dir_path = os.path.join(path, '')
+                for file_path in [p for p in cls._mmaps if p.startswith(dir_path)]:
+                    del cls._mmaps[file_path]
+            else:
+                cls._mmaps.pop(path, None)
+
+    def get_stream(self, storage_id, start=None, length=None, chunk_size=None):
+        """
+        Return an iterator over a file's chunks based on `storage_id`.
+        File is opened right away, so a missing file raises before the first chunk is requested.
+        If `FS_MEDIA_STORAGE_MMAP` is enabled, a range (i.e. player's `Range` request) is read from a memory map
+        of a file, so repeated requests to the same video don't open and seek it again.
+        :param storage_id: unique starage id
+        :type storage_id: str
+        :param start: start file's position to read, read from the beginning if not set
+        :type start: int
+        :param length: the number of bytes to be read from the file, read until the end if not set
+        :type length: int
+        :param chunk_size: max size of a single chunk, `MEDIA_STORAGE_CHUNK_SIZE` is used if not set
+        :type chunk_size: int
+        :return: file chunks
+        :rtype: generator
+        """
+
+        if not chunk_size:
+            chunk_size = app.config.get('MEDIA_STORAGE_CHUNK_SIZE')
+
+        try:
+            if app.config.get('FS_MEDIA_STORAGE_MMAP') and (start or length is not None):
+                media_map = self._get_mmap(self._get_file_path(storage_id))
+                if media_map is not None:
+                    return self._iter_mmap(media_map, start or 0, length, chunk_size)
+
+            rb = open(self._get_file_path(storage_id), 'rb')
+            if start:
+                rb.seek(start)
+        except Exception as e:
+            logger.error(f'FileSystemStorage:get_stream:{storage_id}: {e}')
+            raise e
+
+        return self._iter_file(rb, length, chunk_size)
+
+    @staticmethod
+    def _iter_file(rb, length, chunk_size):
+        """
+        Read an opened file by chunks and close it when reading is finished or generator is closed.
+        :param rb: file opened in binary mode
+        :type rb: io.BufferedReader
+        :param length: the number of bytes to be read from the file, read until the end if `None`
+        :type length: int
+        :param chunk_size: max size of a single chunk
+        :type chunk_size: int
+        :return: file chunks
+        :rtype: generator
+        """
+
+        with rb:
+            remaining = length
+            while remaining is None or remaining > 0:
+                chunk = rb.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    @staticmethod
+    def _iter_mmap(media_map, start, length, chunk_size):
+        """
+        Read a range of a memory mapped file by chunks.
+        Chunks are copied into bytes, since WSGI servers accept only bytes from a response iterator,
+        memoryview slices of a map would be rejected.
+        :param media_map: memory map of a file
+        :type media_map: mmap.mmap
+        :param start: start file's position to read
+        :type start: int
+        :param length: the number of bytes to be read from the file, read until the end if `None`
+        :type length: int
+        :param chunk_size: max size of a single chunk
+        :type chunk_size: int
+        :return: file chunks
+        :rtype: generator
+        """
+
+        end = len(media_map) if length is None else min(start + length, len(media_map))
+        for position in range(start, end, chunk_size):
+            yield media_map[position:min(position + chunk_size, end)]
+
     def put(self, content, filename, project_id=None, asset_type='project', storage_id=None, content_type=None,
             override=True):
         """
@@ -96,33 +453,14 @@ class FileSystemStorage(MediaStorageInterface):
         :rtype: str
         """
 
-        if asset_type == 'project':
-            if not project_id:
-                raise ValueError("Argument 'project_id' is required when 'asset_type' is 'project'")
-            # generate storage_id for project
-            utcnow = datetime.utcnow()
-            storage_id = f'{utcnow.year}/{utcnow.month}/{utcnow.day}/{project_id}/{filename}'
-        else:
-            if not storage_id:
-                raise ValueError("Argument 'storage_id' is required when 'asset_type' is not 'project'")
-            # generate storage_id
-            storage_id = f'{os.path.dirname(storage_id)}/{asset_type}/{filename}'
-
+        storage_id = self._generate_storage_id(filename, project_id, asset_type, storage_id)
         file_path = self._get_file_path(storage_id)
         # check if file exists
-        if os.path.exists(file_path):
-            if not override:
-                raise Exception(f'File {file_path} already exists, use "replace" method instead.')
-            self.replace(content, storage_id)
-
-        # check if dir exists, if not create it
-        file_dir = os.path.dirname(file_path)
-        if not os.path.exists(file_dir):
-            os.makedirs(file_dir)
+        if os.path.exists(file_path) and not override:
+            raise Exception(f'File {file_path} already exists, use "replace" method instead.')
         # write stream to file
         try:
-            with open(file_path, "wb") as f:
-                f.write(content)
+            self._write_file(storage_id, lambda f: f.write(content))
         except Exception as e:
             logger.error(f'FileSystemStorage:put:{storage_id}: {e}')
             raise e
@@ -130,6 +468,149 @@ class FileSystemStorage(MediaStorageInterface):
         logger.info(f"Saved file '{storage_id}' to fs storage")
         return storage_id
 
+    def put_stream(self, stream, filename, project_id=None, asset_type='project', storage_id=None,
+                   content_type=None, override=True):
+        """
+        Save file-like object into a fs storage chunk by chunk.
+        Paths are built the same way as in `put`.
+        :param stream: file-like object to read a file from
+        :type stream: io.RawIOBase
+        :param filename: name which will be used when store a file
+        :type filename: str
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param asset_type: asset type
+        :type asset_type: str
+        :param storage_id: unique starage id of file
+        :type storage_id: str
+        :param content_type: content type of file
+        :type content_type: str
+        :return: storage id of just saved file
+        :rtype: str
+        """
+
+        storage_id = self._generate_storage_id(filename, project_id, asset_type, storage_id)
+        file_path = self._get_file_path(storage_id)
+        if os.path.exists(file_path) and not override:
+            raise Exception(f'File {file_path} already exists, use "replace" method instead.')
+        # copy stream to file
+        chunk_size = app.config.get('MEDIA_STORAGE_CHUNK_SIZE')
+        try:
+            self._write_file(storage_id, lambda f: shutil.copyfileobj(stream, f, chunk_size))
+        except Exception as e:
+            logger.error(f'FileSystemStorage:put_stream:{storage_id}: {e}')
+            raise e
+
+        logger.info(f"Saved file '{storage_id}' to fs storage")
+        return storage_id
+
+    def copy(self, src_storage_id, dst_filename, project_id=None, asset_type='project', storage_id=None,
+             content_type=None):
+        """
+        Copy a file inside a fs storage without reading it into memory.
+        The cheapest available way is used:
+         - a new link to the same blob if `FS_MEDIA_STORAGE_DEDUPLICATE` is enabled
+         - reflink (FICLONE), blocks are shared until one of files is changed
+         - `os.copy_file_range`, data is copied inside a kernel or by a file system
+         - chunked copy
+        Paths are built the same way as in `put`.
+        :param src_storage_id: storage id of a file to copy
+        :type src_storage_id: str
+        :param dst_filename: name which will be used when store a copy
+        :type dst_filename: str
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param asset_type: asset type
+        :type asset_type: str
+        :param storage_id: unique starage id of file
+        :type storage_id: str
+        :param content_type: content type of file
+        :type content_type: str
+        :return: storage id of a copy
+        :rtype: str
+        """
+
+        storage_id = self._generate_storage_id(dst_filename, project_id, asset_type, storage_id)
+        src_path = self._get_file_path(src_storage_id)
+        try:
+            blob_link = None
+            if app.config.get('FS_MEDIA_STORAGE_DEDUPLICATE'):
+                blob_link = app.mongo.db.media_blob_links.find_one({'_id': src_storage_id})
+
+            if blob_link:
+                file_path = self._get_file_path(storage_id)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                tmp_path = self._get_tmp_path(file_path)
+                try:
+                    os.link(src_path, tmp_path)
+                except OSError as e:
+                    if e.errno != errno.EMLINK:
+                        raise
+                    # blob has reached a hard link limit, data is copied
+                    blob_link = None
+
+            if blob_link:
+                try:
+                    self._link_blob(storage_id, tmp_path, blob_link['blob'], os.path.getsize(tmp_path))
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                self._invalidate_mmap(file_path)
+                method = 'blob link'
+            else:
+                methods = []
+                self._write_file(storage_id, lambda f: methods.append(self._copy_file_data(src_path, f)))
+                method = methods[0]
+        except Exception as e:
+            logger.error(f'FileSystemStorage:copy:{src_storage_id}:{storage_id}: {e}')
+            raise e
+
+        logger.info(f"Copied file '{src_storage_id}' to '{storage_id}' in fs storage using {method}")
+        return storage_id
+
+    @staticmethod
+    def _copy_file_data(src_path, dst):
+        """
+        Copy file's data into an opened file using the cheapest available method.
+        :param src_path: path to a file to copy
+        :type src_path: str
+        :param dst: empty file opened for writing
+        :type dst: io.BufferedWriter
+        :return: name of used method
+        :rtype: str
+        """
+
+        with open(src_path, 'rb') as src:
+            # `dst` is wrapped when a content has to be hashed, copy data via python in that case
+            if hasattr(dst, 'fileno'):
+                if fcntl:
+                    try:
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                        return 'reflink'
+                    except OSError:
+                        pass
+
+                if hasattr(os, 'copy_file_range'):
+                    size = os.fstat(src.fileno()).st_size
+                    copied = 0
+                    try:
+                        while copied < size:
+                            sent = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+                            if not sent:
+                                break
+                            copied += sent
+                        if copied == size:
+                            return 'copy_file_range'
+                    except OSError as e:
+                        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) or copied:
+                            raise
+                    # some file systems copy a part only, the rest is copied via python
+                    src.seek(copied)
+                    dst.seek(copied)
+
+            shutil.copyfileobj(src, dst, app.config.get('MEDIA_STORAGE_CHUNK_SIZE'))
+            return 'chunked copy'
+
     def replace(self, content, storage_id, content_type=None):
         """
         Replace a file in the storage
@@ -142,20 +623,223 @@ class FileSystemStorage(MediaStorageInterface):
         """
 
         file_path = self._get_file_path(storage_id)
-        # check if dir exists, if not create it
-        file_dir = os.path.dirname(file_path)
-        if not os.path.exists(file_dir):
-            os.makedirs(file_dir)
         # write stream to file
         try:
-            with open(file_path, "wb") as f:
-                f.write(content)
+            self._write_file(storage_id, lambda f: f.write(content))
         except Exception as e:
             logger.error(f'FileSystemStorage:replace:{storage_id}: {e}')
             raise e
         else:
             logger.info(f'Replaced file "{storage_id}" in fs storage')
 
+    def _write_file(self, storage_id, write):
+        """
+        Atomically create or replace a file.
+        Content is written into a temporary file in the same directory which is renamed to a file path then,
+        so readers always see either a complete old file or a complete new one.
+        Data is flushed to a disk according to `FS_MEDIA_STORAGE_FSYNC` policy:
+         - 'none': rely on OS to flush data
+         - 'file': fsync a file before it's renamed
+         - 'full': fsync a file and its directory, so rename itself survives a crash
+        If `FS_MEDIA_STORAGE_DEDUPLICATE` is enabled, content is stored as a blob, see `_link_blob`.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :param write: callable which receives a file object opened for writing and writes content into it
+        :type write: callable
+        """
+
+        file_path = self._get_file_path(storage_id)
+        file_dir = os.path.dirname(file_path)
+        # check if dir exists, if not create it
+        if not os.path.exists(file_dir):
+            os.makedirs(file_dir, exist_ok=True)
+
+        fsync = app.config.get('FS_MEDIA_STORAGE_FSYNC')
+        deduplicate = app.config.get('FS_MEDIA_STORAGE_DEDUPLICATE')
+        tmp_path = self._get_tmp_path(file_path)
+        try:
+            with open(tmp_path, 'xb') as f:
+                writer = _HashingWriter(f) if deduplicate else f
+                write(writer)
+                if fsync in ('file', 'full'):
+                    f.flush()
+                    os.fsync(f.fileno())
+            if deduplicate:
+                self._link_blob(storage_id, tmp_path, writer.sha256.hexdigest(), writer.size)
+            else:
+                os.replace(tmp_path, file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if fsync == 'full':
+            self._fsync_dir(file_dir)
+        self._invalidate_mmap(file_path)
+
+    @staticmethod
+    def _get_tmp_path(file_path):
+        """
+        Build a unique path for a temporary file next to `file_path`.
+        :param file_path: path to a file
+        :type file_path: str
+        :return: temporary file path
+        :rtype: str
+        """
+
+        return os.path.join(os.path.dirname(file_path), f'.{os.path.basename(file_path)}.{uuid.uuid4().hex}.tmp')
+
+    @staticmethod
+    def _fsync_dir(dir_path):
+        """
+        Flush directory entries to a disk.
+        :param dir_path: directory path
+        :type dir_path: str
+        """
+
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _get_blob_path(self, digest):
+        """
+        Build a path to a content addressed blob: <FS_MEDIA_STORAGE_BLOBS_DIR>/<ab>/<cd>/<sha256>
+        :param digest: sha256 hex digest of a content
+        :type digest: str
+        :return: blob path
+        :rtype: str
+        """
+
+        return self._get_file_path(os.path.join(app.config.get('FS_MEDIA_STORAGE_BLOBS_DIR'),
+                                                digest[:2], digest[2:4], digest))
+
+    def _link_blob(self, storage_id, tmp_path, digest, size):
+        """
+        Store just written temporary file as a blob and make `storage_id` point to it.
+
+        Blob is kept once per unique content, `storage_id` file is a hard link to a blob, so reading doesn't
+        depend on a blob index at all.
+        Number of storage ids which point to a blob is counted in `media_blobs` collection,
+        storage id -> blob mapping is saved in `media_blob_links` collection.
+        Reference is released if linking fails. A blob removed by a concurrent `_release_blob` is created again
+        from a temporary file. If a blob has as many hard links as a file system allows, temporary file becomes
+        a private copy of `storage_id` which is not tracked in a blob index.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :param tmp_path: temporary file with a content
+        :type tmp_path: str
+        :param digest: sha256 hex digest of a content
+        :type digest: str
+        :param size: content size
+        :type size: int
+        """
+
+        db = app.mongo.db
+        blob_path = self._get_blob_path(digest)
+        file_path = self._get_file_path(storage_id)
+        link_path = self._get_tmp_path(file_path)
+
+        # reference is taken before a blob is linked, so `_release_blob` which starts later keeps a blob
+        db.media_blobs.update_one(
+            {'_id': digest},
+            {'$inc': {'refs': 1}, '$setOnInsert': {'size': size}},
+            upsert=True
+        )
+        linked = True
+        try:
+            try:
+                # link to a blob is created under a temporary name and renamed, so replacement is atomic
+                os.link(blob_path, link_path)
+            except FileNotFoundError:
+                # there is no blob yet or it was just removed by `_release_blob` of the last previous reference,
+                # content becomes a blob, temporary file is kept until it's renamed, so content can't vanish
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                try:
+                    os.link(tmp_path, blob_path)
+                except FileExistsError:
+                    # same content was stored concurrently, file keeps its own copy
+                    pass
+                os.replace(tmp_path, file_path)
+            except OSError as e:
+                if e.errno != errno.EMLINK:
+                    raise
+                # popular blob has reached a hard link limit, file keeps its own copy
+                logger.warning(f"Blob '{digest}' has too many links, '{storage_id}' is stored as a separate file")
+                os.replace(tmp_path, file_path)
+                linked = False
+            else:
+                # same content is already stored
+                os.remove(tmp_path)
+                os.replace(link_path, file_path)
+                logger.info(f"Content of '{storage_id}' is deduplicated with blob '{digest}'")
+
+            if linked:
+                old_link = db.media_blob_links.find_one_and_update(
+                    {'_id': storage_id},
+                    {'$set': {'blob': digest}},
+                    upsert=True,
+                    return_document=ReturnDocument.BEFORE
+                )
+            else:
+                old_link = db.media_blob_links.find_one_and_delete({'_id': storage_id})
+        except BaseException:
+            if os.path.exists(link_path):
+                os.remove(link_path)
+            self._release_blob(digest)
+            raise
+
+        if not linked:
+            self._release_blob(digest)
+        if old_link:
+            self._release_blob(old_link['blob'])
+
+    def _release_blob(self, digest):
+        """
+        Decrement blob's reference counter and remove a blob when nothing points to it anymore.
+        :param digest: sha256 hex digest of a content
+        :type digest: str
+        """
+
+        db = app.mongo.db
+        blob = db.media_blobs.find_one_and_update(
+            {'_id': digest},
+            {'$inc': {'refs': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob and blob['refs'] <= 0 and db.media_blobs.delete_one({'_id': digest, 'refs': {'$lte': 0}}).deleted_count:
+            blob_path = self._get_blob_path(digest)
+            if os.path.exists(blob_path):
+                os.remove(blob_path)
+            logger.info(f"Removed blob '{digest}' from fs storage")
+
+    def _unlink_blobs(self, storage_id=None, dir_storage_id=None, storage_ids=None):
+        """
+        Release blobs which `storage_id`, `storage_ids` or all storage ids in `dir_storage_id` directory point to.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :param dir_storage_id: directory part of storage ids
+        :type dir_storage_id: str
+        :param storage_ids: list of unique storage ids
+        :type storage_ids: list
+        """
+
+        db = app.mongo.db
+        if storage_id:
+            links = [db.media_blob_links.find_one_and_delete({'_id': storage_id})]
+        else:
+            if storage_ids is not None:
+                query = {'_id': {'$in': list(storage_ids)}}
+            else:
+                query = {'_id': {'$regex': f'^{re.escape(dir_storage_id)}/'}}
+            links = list(db.media_blob_links.find(query))
+            db.media_blob_links.delete_many({'_id': {'$in': [link['_id'] for link in links]}})
+
+        for link in links:
+            if link:
+                self._release_blob(link['blob'])
+
     def delete(self, storage_id):
         """
         Delete a file from the storage
@@ -167,10 +851,65 @@ class FileSystemStorage(MediaStorageInterface):
 
         if os.path.exists(file_path):
             os.remove(file_path)
+            self._invalidate_mmap(file_path)
             logger.info(f"Removed '{file_path}' from fs storage")
         else:
             logger.warning(f"File '{file_path}' was not found in fs storage.")
 
+        if app.config.get('FS_MEDIA_STORAGE_DEDUPLICATE'):
+            self._unlink_blobs(storage_id=storage_id)
+
+    def delete_many(self, storage_ids):
+        """
+        Delete several files from the storage in parallel, using `FS_MEDIA_STORAGE_DELETE_WORKERS` threads.
+        :param storage_ids: storage ids of files to remove
+        :type storage_ids: list
+        :return: `True` for every storage id which was removed or didn't exist, `False` if removal failed
+        :rtype: dict
+        """
+
+        storage_ids = list(storage_ids)
+        if not storage_ids:
+            return {}
+
+        file_paths = [self._get_file_path(storage_id) for storage_id in storage_ids]
+        workers = min(app.config.get('FS_MEDIA_STORAGE_DELETE_WORKERS'), len(file_paths))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                errors = list(executor.map(self._remove_file, file_paths))
+        else:
+            errors = [self._remove_file(file_path) for file_path in file_paths]
+
+        results = {}
+        removed = 0
+        for storage_id, file_path, error in zip(storage_ids, file_paths, errors):
+            if error is None:
+                self._invalidate_mmap(file_path)
+                removed += 1
+            elif isinstance(error, FileNotFoundError):
+                logger.warning(f"File '{file_path}' was not found in fs storage.")
+            else:
+                logger.error(f'FileSystemStorage:delete_many:{storage_id}: {error}')
+            results[storage_id] = error is None or isinstance(error, FileNotFoundError)
+
+        if app.config.get('FS_MEDIA_STORAGE_DEDUPLICATE'):
+            self._unlink_blobs(storage_ids=[storage_id for storage_id, ok in results.items() if ok])
+
+        logger.info(f"Removed {removed} files from fs storage")
+        return results
+
+    @staticmethod
+    def _remove_file(file_path):
+        """
+        Remove a file, return an exception instead of raising it, so it can be run in a thread pool.
+        """
+
+        try:
+            os.remove(file_path)
+        except OSError as e:
+            return e
+        return None
+
     def delete_dir(self, storage_id):
         """
         Delete an entire folder where `storage_id` is located
@@ -182,6 +921,84 @@ class FileSystemStorage(MediaStorageInterface):
 
         if os.path.isdir(dir_path):
             shutil.rmtree(dir_path)
+            self._invalidate_mmap(dir_path, is_dir=True)
             logger.info(f"Removed '{dir_path}' from fs storage")
         else:
             logger.warning(f"Directory '{dir_path}' was not found in fs storage.")
+
+        if app.config.get('FS_MEDIA_STORAGE_DEDUPLICATE'):
+            self._unlink_blobs(dir_storage_id=os.path.dirname(storage_id))
+
+    def remove_empty_dirs(self, storage_ids):
+        """
+        Remove directories of files which were deleted, i.e. by `delete_many`, and their parents while they are
+        empty. Roots of a storage and its volumes are never removed.
+        :param storage_ids: storage ids of deleted files
+        :type storage_ids: list
+        """
+
+        for dir_storage_id in {os.path.dirname(storage_id) for storage_id in storage_ids}:
+            _, root, _ = self._split_volume(dir_storage_id)
+            self._remove_empty_dirs(self._get_file_path(dir_storage_id), root)
+
+    def move_dir(self, src_dir, dst_dir):
+        """
+        Move a directory with all its files, i.e. a project directory to a new storage layout.
+        Files' storage ids change from <src_dir>/<path> to <dst_dir>/<path>, updating references to them is up to
+        a caller. It's safe to call it again if a previous call was interrupted.
+        :param src_dir: directory part of storage ids to move
+        :type src_dir: str
+        :param dst_dir: new directory part of storage ids
+        :type dst_dir: str
+        """
+
+        _, src_root, _ = self._split_volume(src_dir)
+        src_path = self._get_file_path(src_dir)
+        dst_path = self._get_file_path(dst_dir)
+
+        if os.path.isdir(src_path):
+            if os.path.exists(dst_path):
+                # left by an interrupted move to another volume, `src_dir` is still the one in use
+                shutil.rmtree(dst_path)
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            try:
+                # rename is atomic and doesn't copy any data when both paths are on the same file system
+                os.rename(src_path, dst_path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # another volume, copy into a temporary directory first, so `dst_dir` appears complete
+                tmp_path = self._get_tmp_path(dst_path)
+                shutil.copytree(src_path, tmp_path)
+                os.rename(tmp_path, dst_path)
+                shutil.rmtree(src_path)
+            self._invalidate_mmap(src_path, is_dir=True)
+            self._remove_empty_dirs(os.path.dirname(src_path), src_root)
+            logger.info(f"Moved '{src_path}' to '{dst_path}' in fs storage")
+        elif not os.path.isdir(dst_path):
+            raise FileNotFoundError(f"Directory '{src_path}' was not found in fs storage.")
+
+        if app.config.get('FS_MEDIA_STORAGE_DEDUPLICATE'):
+            db = app.mongo.db
+            for link in db.media_blob_links.find({'_id': {'$regex': f'^{re.escape(src_dir)}/'}}):
+                db.media_blob_links.replace_one(
+                    {'_id': dst_dir + link['_id'][len(src_dir):]},
+                    {'blob': link['blob']},
+                    upsert=True
+                )
+                db.media_blob_links.delete_one({'_id': link['_id']})
+
+    @staticmethod
+    def _remove_empty_dirs(dir_path, root):
+        """
+        Remove `dir_path` and its parents while they are empty, `root` is never removed.
+        """
+
+        root = os.path.abspath(root)
+        dir_path = os.path.abspath(dir_path)
+        while dir_path.startswith(root + os.sep):
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                break
+            dir_path = os.path.dirname(dir_path)
@@ -0,0 +1,198 @@
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from .wrapper import StorageWrapper, unwrap_storage
+
+#: upper bounds of latency histogram buckets in seconds, the last implicit bucket is +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class InstrumentedStorage(StorageWrapper):
+    """
+    Collect call counts, errors, transferred bytes and latency histograms of a wrapped storage,
+    tagged by a method, an asset type ('video' or 'thumbnails') and a backend class.
+
+    Metrics are kept in memory of the current process, use `get_stats` or `export_prometheus` to export them.
+    Recording a call costs two `perf_counter` calls and a short locked update, streamed reads are timed only
+    while a wrapped storage produces a chunk, so time spent sending a chunk to a client is not counted.
+    """
+
+    def __init__(self, storage):
+        super().__init__(storage)
+        self.backend = unwrap_storage(storage).__class__.__name__
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_asset_type(storage_id):
+        return 'thumbnails' if '/thumbnails/' in storage_id else 'video'
+
+    def _record(self, method, asset_type, seconds, size=0, error=False):
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            metric = self._metrics.get((method, asset_type))
+            if metric is None:
+                metric = self._metrics[(method, asset_type)] = {
+                    'count': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0,
+                    'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+                }
+            metric['count'] += 1
+            metric['errors'] += error
+            metric['bytes'] += size
+            metric['seconds'] += seconds
+            metric['histogram'][bucket] += 1
+
+    def _call(self, method, asset_type, func, *args, **kwargs):
+        """
+        Call `func` and record its latency, size of returned bytes is recorded for read methods.
+        """
+
+        start = perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._record(method, asset_type, perf_counter() - start, error=True)
+            raise
+        size = len(result) if isinstance(result, bytes) else 0
+        self._record(method, asset_type, perf_counter() - start, size)
+        return result
+
+    def get_stats(self):
+        """
+        Return metrics collected by the current process.
+        `histogram` is a list of call counts per `buckets` upper bound (seconds), the last item counts slower calls.
+        :return: stats
+        :rtype: dict
+        """
+
+        with self._lock:
+            methods = {}
+            for (method, asset_type), metric in self._metrics.items():
+                methods.setdefault(method, {})[asset_type] = dict(metric, histogram=list(metric['histogram']))
+        return {'backend': self.backend, 'buckets': list(LATENCY_BUCKETS), 'methods': methods}
+
+    def export_prometheus(self, prefix='videoserver_storage'):
+        """
+        Return metrics collected by the current process in prometheus text exposition format.
+        :param prefix: prefix of metric names
+        :type prefix: str
+        :return: metrics
+        :rtype: str
+        """
+
+        stats = self.get_stats()
+        lines = [
+            f'# TYPE {prefix}_calls_total counter',
+            f'# TYPE {prefix}_errors_total counter',
+            f'# TYPE {prefix}_bytes_total counter',
+            f'# TYPE {prefix}_latency_seconds histogram',
+        ]
+        for method, asset_types in sorted(stats['methods'].items()):
+            for asset_type, metric in sorted(asset_types.items()):
+                labels = f'method="{method}",asset_type="{asset_type}",backend="{stats["backend"]}"'
+                lines.append(f'{prefix}_calls_total{{{labels}}} {metric["count"]}')
+                lines.append(f'{prefix}_errors_total{{{labels}}} {metric["errors"]}')
+                lines.append(f'{prefix}_bytes_total{{{labels}}} {metric["bytes"]}')
+                cumulative = 0
+                for bound, count in zip(stats['buckets'] + ['+Inf'], metric['histogram']):
+                    cumulative += count
+                    lines.append(f'{prefix}_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_latency_seconds_sum{{{labels}}} {metric["seconds"]}')
+                lines.append(f'{prefix}_latency_seconds_count{{{labels}}} {metric["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def get(self, storage_id):
+        return self._call('get', self._get_asset_type(storage_id), self.storage.get, storage_id)
+
+    def get_range(self, storage_id, start, length):
+        return self._call('get_range', self._get_asset_type(storage_id), self.storage.get_range,
+                          storage_id, start, length)
+
+    def get_stream(self, storage_id, start=None, length=None, chunk_size=None):
+        asset_type = self._get_asset_type(storage_id)
+        begin = perf_counter()
+        try:
+            chunks = self.storage.get_stream(storage_id, start=start, length=length, chunk_size=chunk_size)
+        except Exception:
+            self._record('get_stream', asset_type, perf_counter() - begin, error=True)
+            raise
+        return self._iter_and_record(chunks, asset_type, perf_counter() - begin)
+
+    def _iter_and_record(self, chunks, asset_type, seconds):
+        """
+        Yield chunks and record time spent on reading them once a stream is exhausted or closed.
+        """
+
+        size = 0
+        error = False
+        chunks = iter(chunks)
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    seconds += perf_counter() - start
+                    break
+                except Exception:
+                    seconds += perf_counter() - start
+                    error = True
+                    raise
+                seconds += perf_counter() - start
+                size += len(chunk)
+                yield chunk
+        finally:
+            self._record('get_stream', asset_type, seconds, size, error=error)
+
+    def put(self, content, filename, project_id=None, asset_type='project', storage_id=None, content_type=None,
+            **kwargs):
+        start = perf_counter()
+        tag = 'video' if asset_type == 'project' else asset_type
+        try:
+            storage_id = super().put(content, filename, project_id=project_id, asset_type=asset_type,
+                                     storage_id=storage_id, content_type=content_type, **kwargs)
+        except Exception:
+            self._record('put', tag, perf_counter() - start, error=True)
+            raise
+        self._record('put', tag, perf_counter() - start, len(content))
+        return storage_id
+
+    def put_stream(self, stream, filename, project_id=None, asset_type='project', storage_id=None,
+                   content_type=None, **kwargs):
+        # size of a stream is unknown until it's read by a wrapped storage, only latency is recorded
+        return self._call('put_stream', 'video' if asset_type == 'project' else asset_type, super().put_stream,
+                          stream, filename, project_id=project_id, asset_type=asset_type, storage_id=storage_id,
+                          content_type=content_type, **kwargs)
+
+    def copy(self, src_storage_id, dst_filename, project_id=None, asset_type='project', storage_id=None,
+             content_type=None):
+        return self._call('copy', self._get_asset_type(src_storage_id), super().copy,
+                          src_storage_id, dst_filename, project_id=project_id, asset_type=asset_type,
+                          storage_id=storage_id, content_type=content_type)
+
+    def replace(self, content, storage_id, content_type=None):
+        start = perf_counter()
+        asset_type = self._get_asset_type(storage_id)
+        try:
+            super().replace(content, storage_id, content_type=content_type)
+        except Exception:
+            self._record('replace', asset_type, perf_counter() - start, error=True)
+            raise
+        self._record('replace', asset_type, perf_counter() - start, len(content))
+
+    def delete(self, storage_id):
+        return self._call('delete', self._get_asset_type(storage_id), super().delete, storage_id)
+
+    def delete_dir(self, storage_id):
+        return self._call('delete_dir', self._get_asset_type(storage_id), super().delete_dir, storage_id)
+
+    def delete_many(self, storage_ids):
+        storage_ids = list(storage_ids)
+        if not storage_ids:
+            return super().delete_many(storage_ids)
+        # files deleted together are assets of the same type (i.e. timeline thumbnails)
+        return self._call('delete_many', self._get_asset_type(storage_ids[0]), super().delete_many, storage_ids)
+
+    def stat(self, storage_id):
+        return self._call('stat', self._get_asset_type(storage_id), super().stat, storage_id)
@@ -1,4 +1,15 @@
 import abc
+import hashlib
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app as app
+
+from videoserver.lib.scratch import scratch_dir
+
+logger = logging.getLogger(__name__)
 
 
 class MediaStorageInterface(metaclass=abc.ABCMeta):
@@ -14,6 +25,24 @@ class MediaStorageInterface(metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def get_stream(self, storage_id, start=None, length=None, chunk_size=None):
+        """
+        Return an iterator over a file's chunks based on `storage_id`.
+        Use it instead of `get`/`get_range` when a file should not be loaded into memory entirely.
+        :param storage_id: unique starage id
+        :type storage_id: str
+        :param start: start file's position to read, read from the beginning if not set
+        :type start: int
+        :param length: the number of bytes to be read from the file, read until the end if not set
+        :type length: int
+        :param chunk_size: max size of a single chunk, `MEDIA_STORAGE_CHUNK_SIZE` is used if not set
+        :type chunk_size: int
+        :return: file chunks
+        :rtype: generator
+        """
+        pass
+
     @abc.abstractmethod
     def put(self, content, filename, project_id, asset_type, storage_id=None, content_type=None):
         """
@@ -35,6 +64,57 @@ class MediaStorageInterface(metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def put_stream(self, stream, filename, project_id, asset_type, storage_id=None, content_type=None):
+        """
+        Save file-like object into a storage chunk by chunk.
+        :param stream: file-like object to read a file from
+        :type stream: io.RawIOBase
+        :param filename: name which will be used when store a file
+        :type filename: str
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param asset_type: asset type
+        :type asset_type: str
+        :param storage_id: unique starage id of file
+        :type storage_id: str
+        :param content_type: content type of file
+        :type content_type: str
+        :return: storage id of just saved file
+        :rtype: str
+        """
+        pass
+
+    def copy(self, src_storage_id, dst_filename, project_id=None, asset_type='project', storage_id=None,
+             content_type=None):
+        """
+        Copy a file inside a storage.
+        New storage id is built the same way as in `put`.
+        Default implementation reads a whole file and puts it back, backends should use cheaper server side copy.
+        :param src_storage_id: storage id of a file to copy
+        :type src_storage_id: str
+        :param dst_filename: name which will be used when store a copy
+        :type dst_filename: str
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param asset_type: asset type
+        :type asset_type: str
+        :param storage_id: unique starage id of file
+        :type storage_id: str
+        :param content_type: content type of file
+        :type content_type: str
+        :return: storage id of a copy
+        :rtype: str
+        """
+        return self.put(
+            content=self.get(src_storage_id),
+            filename=dst_filename,
+            project_id=project_id,
+            asset_type=asset_type,
+            storage_id=storage_id,
+            content_type=content_type
+        )
+
     @abc.abstractmethod
     def replace(self, content, storage_id, content_type=None):
         """
@@ -79,3 +159,147 @@ class MediaStorageInterface(metaclass=abc.ABCMeta):
         """
         # NOTE: meaning `directory` might be different for different storage backends
         pass
+
+    def delete_many(self, storage_ids):
+        """
+        Delete several files from the storage.
+        Default implementation deletes files one by one, storages override it to delete files in parallel
+        or by batches.
+        :param storage_ids: storage ids of files to remove
+        :type storage_ids: list
+        :return: `True` for every storage id which was removed or didn't exist, `False` if removal failed
+        :rtype: dict
+        """
+
+        results = {}
+        for storage_id in storage_ids:
+            try:
+                self.delete(storage_id)
+            except Exception as e:
+                logger.error(f'{self.__class__.__name__}:delete_many:{storage_id}: {e}')
+                results[storage_id] = False
+            else:
+                results[storage_id] = True
+        return results
+
+    def stat(self, storage_id):
+        """
+        Return size, modification time and version of a file without reading it.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: dict with `size` in bytes, `mtime` (aware utc datetime) and `etag` (opaque string which changes
+                 whenever file's content changes) or `None` if storage doesn't support it
+        :rtype: dict
+        :raise FileNotFoundError: if file doesn't exist
+        """
+        return None
+
+    def get_local_path(self, storage_id):
+        """
+        Return a path to a file on a local file system if storage keeps files there.
+        Used to hand a file over to a web server or a kernel instead of reading it with python.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: absolute file path or `None` if storage doesn't keep files locally
+        :rtype: str
+        """
+        return None
+
+    @contextmanager
+    def open_local(self, storage_id):
+        """
+        Provide a file as a path on a local file system, i.e. for ffmpeg.
+        File is used in place if storage keeps it locally, otherwise it's downloaded into a scratch directory
+        which is removed on exit. File must not be modified through a yielded path.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: context manager which yields a file path
+        :rtype: contextlib.AbstractContextManager
+        :raise FileNotFoundError: if file doesn't exist
+        """
+
+        file_path = self.get_local_path(storage_id)
+        if file_path:
+            if not os.path.isfile(file_path):
+                raise FileNotFoundError(f"File '{storage_id}' was not found in storage.")
+            yield file_path
+            return
+
+        stat = self.stat(storage_id)
+        with scratch_dir(reserve=stat['size'] if stat else 0) as scratch:
+            # extension is kept, ffmpeg chooses a format by it
+            file_path = scratch.get_path(os.path.basename(storage_id), size=stat['size'] if stat else None)
+            with open(file_path, 'wb') as f:
+                for chunk in self.get_stream(storage_id):
+                    f.write(chunk)
+            yield file_path
+
+    def get_url(self, storage_id):
+        """
+        Return an url which lets a client to read a file directly from a storage.
+        :param storage_id: unique storage id
+        :type storage_id: str
+        :return: url or `None` if storage doesn't support direct access
+        :rtype: str
+        """
+        return None
+
+    def generate_project_dir(self, project_id, layout=None, date=None):
+        """
+        Build a directory part of storage ids for a new project according to `MEDIA_STORAGE_LAYOUT`.
+        'date' layout is <year>/<month>/<day>/<project-id>, 'hash' layout is <xx>/<yy>/<project-id>
+        where <xx> and <yy> are the first two bytes of sha1 of a project id in hex, so projects are spread evenly
+        over 65536 directories instead of piling up in a single directory of a day.
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param layout: layout name, `MEDIA_STORAGE_LAYOUT` is used if not set
+        :type layout: str
+        :param date: project creation date used by 'date' layout, current date is used if not set
+        :type date: datetime.datetime
+        :return: directory
+        :rtype: str
+        """
+
+        if not layout:
+            layout = app.config.get('MEDIA_STORAGE_LAYOUT', 'date')
+
+        if layout == 'hash':
+            digest = hashlib.sha1(str(project_id).encode()).hexdigest()
+            return f'{digest[:2]}/{digest[2:4]}/{project_id}'
+        if layout == 'date':
+            if not date:
+                date = datetime.utcnow()
+            return f'{date.year}/{date.month}/{date.day}/{project_id}'
+        raise ValueError(f"Unknown storage layout '{layout}'")
+
+    def _generate_storage_id(self, filename, project_id=None, asset_type='project', storage_id=None):
+        """
+        Build storage id for a new file.
+        Use <project-dir>/<filename> if `asset_type` is 'project', `project_id` is required,
+        see `generate_project_dir` for <project-dir>.
+        Use <project-dir>/<asset_type>/<filename> if `asset_type` is not 'project', `storage_id`
+        is required.
+        Storage ids are paths relative to a storage root, so ids created with any layout keep resolving
+        when `MEDIA_STORAGE_LAYOUT` is changed.
+        :param filename: name which will be used when store a file
+        :type filename: str
+        :param project_id: unique project id
+        :type project_id: bson.objectid.ObjectId
+        :param asset_type: asset type
+        :type asset_type: str
+        :param storage_id: unique starage id of file
+        :type storage_id: str
+        :return: storage id
+        :rtype: str
+        """
+
+        if asset_type == 'project':
+            if not project_id:
+                raise ValueError("Argument 'project_id' is required when 'asset_type' is 'project'")
+            # generate storage_id for project
+            return f'{self.generate_project_dir(project_id)}/{filename}'
+
+        if not storage_id:
+            raise ValueError("Argument 'storage_id' is required when 'asset_type' is not 'project'")
+        # generate storage_id
+        return f'{os.path.dirname(storage_id)}/{asset_type}/{filename}'
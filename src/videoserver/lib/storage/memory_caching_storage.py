@@ -0,0 +1,206 @@
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app as app
+
+from .wrapper import StorageWrapper
+
+
+class MemoryCachingStorage(StorageWrapper):
+    """
+    In-process LRU cache for thumbnails, keyed by `storage_id`.
+
+    Only thumbnails not bigger than `MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE` are cached, total size of cached
+    files is bounded by `MEDIA_STORAGE_MEMORY_CACHE_SIZE` bytes. Files are cached when they are read (`get` or
+    a whole `get_stream`) or written (`put`), so serving of a cached file costs no disk or network I/O.
+
+    Cache is invalidated on every write or delete made through this storage. Other processes (i.e. celery
+    workers) can't invalidate it, so videos, which are replaced in place by an edit, are never cached.
+    Thumbnails are always written under a new `storage_id`.
+    """
+
+    def __init__(self, storage):
+        super().__init__(storage)
+        self._cache = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'hit_bytes': 0, 'evictions': 0}
+
+    def get_stats(self):
+        """
+        Return cache hit/miss counters of the current process.
+        :return: stats
+        :rtype: dict
+        """
+
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = self._size
+            stats['items'] = len(self._cache)
+        return stats
+
+    def export_prometheus(self, prefix='videoserver_storage_memory_cache'):
+        """
+        Return cache counters of the current process in prometheus text exposition format.
+        :param prefix: prefix of metric names
+        :type prefix: str
+        :return: metrics
+        :rtype: str
+        """
+
+        stats = self.get_stats()
+        lines = []
+        for name in ('hits', 'misses', 'hit_bytes', 'evictions'):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {stats[name]}')
+        for name, key in (('size_bytes', 'size'), ('items', 'items')):
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {stats[key]}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _is_cacheable(storage_id):
+        return '/thumbnails/' in storage_id
+
+    def get(self, storage_id):
+        if not self._is_cacheable(storage_id):
+            return self.storage.get(storage_id)
+        content = self._get_cached(storage_id)
+        if content is None:
+            content = self.storage.get(storage_id)
+            self._set_cached(storage_id, content)
+        return content
+
+    def get_range(self, storage_id, start, length):
+        if not self._is_cacheable(storage_id):
+            return self.storage.get_range(storage_id, start, length)
+        content = self._get_cached(storage_id, count_miss=False)
+        if content is None:
+            return self.storage.get_range(storage_id, start, length)
+        return content[start:start + length]
+
+    def get_stream(self, storage_id, start=None, length=None, chunk_size=None):
+        """
+        Return an iterator over a file's chunks based on `storage_id`.
+        Cached file is returned as a single chunk. Whole stream of a not cached thumbnail is cached
+        if it's small enough.
+        """
+
+        if not self._is_cacheable(storage_id):
+            return self.storage.get_stream(storage_id, start=start, length=length, chunk_size=chunk_size)
+        partial = bool(start) or length is not None
+        content = self._get_cached(storage_id, count_miss=not partial)
+        if content is not None:
+            start = start or 0
+            return iter((content[start:] if length is None else content[start:start + length],))
+
+        chunks = self.storage.get_stream(storage_id, start=start, length=length, chunk_size=chunk_size)
+        if partial:
+            return chunks
+        return self._iter_and_cache(chunks, storage_id)
+
+    def _iter_and_cache(self, chunks, storage_id):
+        """
+        Yield chunks and keep them in memory while file is not bigger than `MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE`.
+        """
+
+        max_item_size = app.config.get('MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE')
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            if buffer is not None:
+                size += len(chunk)
+                if size > max_item_size:
+                    buffer = None
+                else:
+                    buffer.append(chunk)
+            yield chunk
+
+        if buffer is not None:
+            self._set_cached(storage_id, b''.join(buffer))
+
+    def put(self, content, filename, project_id=None, asset_type='project', storage_id=None, content_type=None,
+            **kwargs):
+        storage_id = super().put(content, filename, project_id=project_id, asset_type=asset_type,
+                                 storage_id=storage_id, content_type=content_type, **kwargs)
+        self._invalidate(storage_id)
+        self._set_cached(storage_id, content)
+        return storage_id
+
+    def put_stream(self, stream, filename, project_id=None, asset_type='project', storage_id=None,
+                   content_type=None, **kwargs):
+        storage_id = super().put_stream(stream, filename, project_id=project_id, asset_type=asset_type,
+                                        storage_id=storage_id, content_type=content_type, **kwargs)
+        self._invalidate(storage_id)
+        return storage_id
+
+    def copy(self, src_storage_id, dst_filename, project_id=None, asset_type='project', storage_id=None,
+             content_type=None):
+        storage_id = super().copy(src_storage_id, dst_filename, project_id=project_id, asset_type=asset_type,
+                                  storage_id=storage_id, content_type=content_type)
+        self._invalidate(storage_id)
+        return storage_id
+
+    def replace(self, content, storage_id, content_type=None):
+        self._invalidate(storage_id)
+        super().replace(content, storage_id, content_type=content_type)
+        self._invalidate(storage_id)
+
+    def delete(self, storage_id):
+        super().delete(storage_id)
+        self._invalidate(storage_id)
+
+    def delete_dir(self, storage_id):
+        super().delete_dir(storage_id)
+        self._invalidate(storage_id, is_dir=True)
+
+    def delete_many(self, storage_ids):
+        storage_ids = list(storage_ids)
+        results = super().delete_many(storage_ids)
+        for storage_id in storage_ids:
+            self._invalidate(storage_id)
+        return results
+
+    def _get_cached(self, storage_id, count_miss=True):
+        with self._lock:
+            content = self._cache.get(storage_id)
+            if content is None:
+                if count_miss:
+                    self.stats['misses'] += 1
+                return None
+            self._cache.move_to_end(storage_id)
+            self.stats['hits'] += 1
+            self.stats['hit_bytes'] += len(content)
+        return content
+
+    def _set_cached(self, storage_id, content):
+        if not self._is_cacheable(storage_id):
+            return
+        size = len(content)
+        if size > app.config.get('MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE'):
+            return
+
+        limit = app.config.get('MEDIA_STORAGE_MEMORY_CACHE_SIZE')
+        with self._lock:
+            self._size -= len(self._cache.pop(storage_id, b''))
+            self._cache[storage_id] = bytes(content)
+            self._size += size
+            while self._cache and self._size > limit:
+                _, evicted = self._cache.popitem(last=False)
+                self._size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def _invalidate(self, storage_id, is_dir=False):
+        """
+        Remove a file or all files from a directory of `storage_id` from a cache.
+        """
+
+        with self._lock:
+            if is_dir:
+                prefix = os.path.join(os.path.dirname(storage_id), '')
+                keys = [key for key in self._cache if key.startswith(prefix)]
+            else:
+                keys = [storage_id] if storage_id in self._cache else []
+            for key in keys:
+                self._size -= len(self._cache.pop(key))
@@ -0,0 +1,92 @@
+from .interface import MediaStorageInterface
+
+
+class StorageWrapper(MediaStorageInterface):
+    """
+    Base class for storages which add a behaviour on top of another storage.
+    Every call is delegated to a wrapped storage, subclasses override only what they need.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get(self, storage_id):
+        return self.storage.get(storage_id)
+
+    def get_range(self, storage_id, start, length):
+        return self.storage.get_range(storage_id, start, length)
+
+    def get_stream(self, storage_id, start=None, length=None, chunk_size=None):
+        return self.storage.get_stream(storage_id, start=start, length=length, chunk_size=chunk_size)
+
+    def put(self, content, filename, project_id=None, asset_type='project', storage_id=None, content_type=None,
+            **kwargs):
+        return self.storage.put(content, filename, project_id=project_id, asset_type=asset_type,
+                                storage_id=storage_id, content_type=content_type, **kwargs)
+
+    def put_stream(self, stream, filename, project_id=None, asset_type='project', storage_id=None,
+                   content_type=None, **kwargs):
+        return self.storage.put_stream(stream, filename, project_id=project_id, asset_type=asset_type,
+                                       storage_id=storage_id, content_type=content_type, **kwargs)
+
+    def copy(self, src_storage_id, dst_filename, project_id=None, asset_type='project', storage_id=None,
+             content_type=None):
+        return self.storage.copy(src_storage_id, dst_filename, project_id=project_id, asset_type=asset_type,
+                                 storage_id=storage_id, content_type=content_type)
+
+    def replace(self, content, storage_id, content_type=None):
+        return self.storage.replace(content, storage_id, content_type=content_type)
+
+    def delete(self, storage_id):
+        return self.storage.delete(storage_id)
+
+    def delete_dir(self, storage_id):
+        return self.storage.delete_dir(storage_id)
+
+    def delete_many(self, storage_ids):
+        return self.storage.delete_many(storage_ids)
+
+    def stat(self, storage_id):
+        return self.storage.stat(storage_id)
+
+    def get_local_path(self, storage_id):
+        return self.storage.get_local_path(storage_id)
+
+    def open_local(self, storage_id):
+        return self.storage.open_local(storage_id)
+
+    def get_url(self, storage_id):
+        return self.storage.get_url(storage_id)
+
+
+def unwrap_storage(storage):
+    """
+    Return a backend storage hidden behind all wrappers (caches etc.).
+    :param storage: storage, possibly wrapped
+    :type storage: MediaStorageInterface
+    :return: backend storage
+    :rtype: MediaStorageInterface
+    """
+
+    while isinstance(storage, StorageWrapper):
+        storage = storage.storage
+    return storage
+
+
+def find_storage(storage, storage_class):
+    """
+    Return the first storage of `storage_class` in a chain of wrappers.
+    :param storage: storage, possibly wrapped
+    :type storage: MediaStorageInterface
+    :param storage_class: class of a storage to find
+    :type storage_class: type
+    :return: storage or `None` if there is no such storage in a chain
+    :rtype: MediaStorageInterface
+    """
+
+    while True:
+        if isinstance(storage, storage_class):
+            return storage
+        if not isinstance(storage, StorageWrapper):
+            return None
+        storage = storage.storage
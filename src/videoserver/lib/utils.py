@@ -1,20 +1,28 @@
 import json
+import os
 import uuid
 from datetime import datetime
-from tempfile import mkstemp
+from urllib.parse import quote
 import logging
 
 import bson
-from flask import Response, make_response
+from flask import Response
 from flask import current_app as app
-from flask import url_for
+from flask import abort, redirect, request, url_for
 from werkzeug.exceptions import BadRequest
+from werkzeug.wsgi import wrap_file
 
 from .validator import Validator
 
 logger = logging.getLogger(__name__)
 
 
+class FileChangedError(Exception):
+    """
+    File was replaced after response headers were built from its stat.
+    """
+
+
 def create_file_name(ext):
     """
     Generates a filename using uuid4
@@ -206,28 +214,26 @@ def get_request_address(request_headers):
     return request_headers.get('HTTP_X_FORWARDED_FOR') or request_headers.get('REMOTE_ADDR')
 
 
-def create_temp_file(file_stream, suffix=None):
+def _ensure_unchanged(storage_id, etag, close):
     """
-    Saves `file_stream` into /tmp directory
-    :param file_stream: file to save
-    :type file_stream: bytes
-    :param suffix: the file name will end with that suffix, otherwise there will be no suffix.
-    :type suffix: str
-    :return: file path
-    :rtype: str
+    Compare etag of a file after it was opened with the one headers were built for.
+    If a file was replaced in between, an opened stream is released and `FileChangedError` is raised.
     """
 
-    fd, path = mkstemp(suffix=suffix)
-
-    with open(fd, "wb") as f:
-        f.write(file_stream)
-
-    return path
+    try:
+        stat = app.fs.stat(storage_id)
+    except FileNotFoundError:
+        stat = None
+    if not stat or stat['etag'] != etag:
+        close()
+        raise FileChangedError(storage_id)
 
 
-def storage2response(storage_id, headers=None, status=200, start=None, length=None):
+def storage2response(storage_id, headers=None, status=200, start=None, length=None, etag=None):
     """
-    Fetch binary using `storage_id` and return http response.
+    Stream binary using `storage_id` and return http response.
+    File is sent to a client chunk by chunk, so memory usage per request doesn't depend on a file size.
+    File is delivered according to `MEDIA_DELIVERY` setting if storage supports it.
 
     :param storage_id: Unique storage id
     :type storage_id: str
@@ -239,18 +245,71 @@ def storage2response(storage_id, headers=None, status=200, start=None, length=No
     :type start: int
     :param length: the number of bytes to be read from the file
     :type length: int
+    :param etag: etag of a file `headers` were built for, checked again after a file is opened
+    :type etag: str
     :return: response
     :rtype: flask.wrappers.Response
+    :raise NotFound: if file doesn't exist in a storage
+    :raise FileChangedError: if file's etag is not `etag` anymore, i.e. `Content-Length` would be wrong
     """
 
     if not headers:
         headers = {}
 
-    if start is not None:
-        bytes = app.fs.get_range(storage_id, start, length)
-    else:
-        bytes = app.fs.get(storage_id)
-
-    resp = make_response(bytes)
-    resp.headers = headers
+    delivery = app.config.get('MEDIA_DELIVERY', 'stream')
+
+    if delivery == 'redirect':
+        url = app.fs.get_url(storage_id)
+        if url:
+            # client repeats a request with the same `Range` header
+            return redirect(url), 302
+
+    file_path = app.fs.get_local_path(storage_id) if delivery != 'stream' else None
+
+    if file_path and delivery in ('x-accel-redirect', 'x-sendfile'):
+        # web server sends a file and handles `Range` header by itself
+        headers = {k: v for k, v in headers.items() if k not in ('Content-Length', 'Content-Range')}
+        if delivery == 'x-accel-redirect':
+            prefix = app.config.get('MEDIA_DELIVERY_ACCEL_REDIRECT_PREFIX').rstrip('/')
+            headers['X-Accel-Redirect'] = f'{prefix}/{quote(storage_id)}'
+        else:
+            headers['X-Sendfile'] = file_path
+        return Response(headers=headers), 200
+
+    if file_path and delivery == 'sendfile':
+        try:
+            file = open(file_path, 'rb')
+        except FileNotFoundError:
+            abort(404)
+        if etag:
+            _ensure_unchanged(storage_id, etag, file.close)
+        # `wsgi.file_wrapper` sends a file until the end, so use it only if requested range ends there
+        if length is None or (start or 0) + length >= os.fstat(file.fileno()).st_size:
+            if start:
+                file.seek(start)
+            chunks = wrap_file(request.environ, file, app.config.get('MEDIA_STORAGE_CHUNK_SIZE'))
+            return Response(chunks, headers=headers, direct_passthrough=True), status
+        file.close()
+
+    try:
+        chunks = app.fs.get_stream(storage_id, start=start, length=length)
+    except FileNotFoundError:
+        abort(404)
+    if etag:
+        _ensure_unchanged(storage_id, etag, getattr(chunks, 'close', lambda: None))
+
+    resp = Response(chunks, headers=headers, direct_passthrough=True)
     return resp, status
+
+
+def get_thumbnails_storage_ids(thumbnails):
+    """
+    Return storage ids of thumbnails without repeats, packed timeline thumbnails share a single storage id.
+
+    :param thumbnails: thumbnails docs
+    :type thumbnails: list
+    :return: storage ids in original order
+    :rtype: list
+    """
+
+    return list(dict.fromkeys(thumbnail.get('storage_id') for thumbnail in thumbnails if thumbnail.get('storage_id')))
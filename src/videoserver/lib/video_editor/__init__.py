@@ -1,6 +1,7 @@
 from flask import current_app as app
 
 from .ffmpeg import FFMPEGVideoEditor
+from .interface import SEEK_MODES
 from .moviepy import MoviePyVideoEditor
 
 
@@ -2,15 +2,40 @@ import json
 import logging
 import os
 import shlex
+import struct
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 
 from flask import current_app as app
 
-from videoserver.lib.utils import create_temp_file
-from .interface import VideoEditorInterface
+from videoserver.lib.scratch import scratch_dir
+from .interface import SEEK_MODES, VideoEditorInterface
 
 logger = logging.getLogger(__name__)
 
+#: encoders used to re-encode partial GOPs of a smart trim, videos of other codecs are trimmed by a full re-encode
+SMART_TRIM_ENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+#: encoder profiles matching profiles reported by `ffprobe`, videos of other profiles are trimmed by a full re-encode
+SMART_TRIM_PROFILES = {
+    'h264': {
+        'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high',
+        'High 10': 'high10', 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444',
+    },
+    'hevc': {'Main': 'main', 'Main 10': 'main10', 'Main 12': 'main12'},
+}
+#: quality of re-encoded partial GOPs, visually lossless for both encoders
+SMART_TRIM_CRF = 18
+#: timestamps closer than that (seconds) are treated as equal, ffprobe rounds them to microseconds
+TIMESTAMP_TOLERANCE = 0.0001
+#: timeline thumbnails are scaled to 50px height keeping an aspect ratio
+TIMELINE_THUMBNAIL_FILTER = 'scale=-1:50'
+#: min number of timeline thumbnails captured by a single ffmpeg process when capture is parallel
+TIMELINE_THUMBNAILS_MIN_GROUP = 4
+#: max number of inputs opened by a single ffmpeg command when frames are captured by seeking, every input has
+# its own demuxer and decoder, so more frames are captured by several commands run one after another
+TIMELINE_THUMBNAILS_MAX_INPUTS = 8
+
 
 class FFMPEGVideoEditor(VideoEditorInterface):
     """
@@ -28,24 +53,24 @@ class FFMPEGVideoEditor(VideoEditorInterface):
       https://trac.ffmpeg.org/wiki/Scaling
     """
 
-    def get_meta(self, filestream, extension='tmp'):
+    def get_meta(self, filestream=None, extension='tmp', file_path=None):
         """
         Use ffmpeg tool for getting metadata of file
         :param filestream: file to get meta from
         :type filestream: bytes
+        :param file_path: path to a file to get meta from, used instead of `filestream` if set
+        :type file_path: str
         :return: metadata
         :rtype: dict
         """
 
-        file_temp_path = create_temp_file(filestream)
-        try:
-            metadata = self._get_meta(file_temp_path)
-        finally:
-            os.remove(file_temp_path)
+        if file_path:
+            return self._get_meta(file_path)
 
-        return metadata
+        with scratch_dir(reserve=len(filestream)) as scratch:
+            return self._get_meta(scratch.write(f'probe.{extension}', filestream))
 
-    def edit_video(self, stream_file, filename, trim=None, crop=None, rotate=None, scale=None):
+    def edit_video(self, stream_file, filename, trim=None, crop=None, rotate=None, scale=None, file_path=None):
         """
         Use ffmpeg tool for edit video
         :param stream_file: file to edit
@@ -60,75 +85,284 @@ class FFMPEGVideoEditor(VideoEditorInterface):
         :type video_rotate: int
         :param scale: width scale to
         :type scale: int
+        :param file_path: path to a file to edit, used instead of `stream_file` if set, file is not modified
+        :type file_path: str
         :return:
         """
 
-        # file extension is required by ffmpeg
-        path_input = create_temp_file(stream_file, suffix=f".{filename.rsplit('.', 1)[-1]}")
-        path_output = '{}_edit.{}'.format(*path_input.rsplit('.', 1))
+        size = os.path.getsize(file_path) if file_path else len(stream_file)
+        # edited output, a copy of an input unless it's edited in place, and parts of a smart trim
+        reserve = size
+        if not file_path:
+            reserve += size
+        if trim and app.config.get('FFMPEG_SMART_TRIM'):
+            reserve += size
+        with scratch_dir(reserve=reserve) as scratch:
+            # file extension is required by ffmpeg
+            ext = filename.rsplit('.', 1)[-1]
+            if not file_path:
+                file_path = scratch.write(f'input.{ext}', stream_file)
+            path_output = scratch.get_path(f'output.{ext}')
+            return self._edit_video(file_path, path_output, trim=trim, crop=crop, rotate=rotate, scale=scale)
+
+    def _edit_video(self, path_input, path_output, trim=None, crop=None, rotate=None, scale=None):
+        """
+        Edit video file `path_input` and save a result into `path_output`.
+        :return: edited file, metadata
+        :rtype: bytes, dict
+        """
+
         filter_string = ''
-        try:
-            # get option for trim
-            trim_option = (
-                '-ss', str(trim['start']),
-                '-t', str(trim['end'] - trim['start']),
-                '-qscale', '0',
-            ) if trim else tuple()
-            # crop
-            # https://ffmpeg.org/ffmpeg-filters.html#crop
-            if crop:
-                filter_string += f'crop={crop["width"]}:{crop["height"]}:{crop["x"]}:{crop["y"]}'
-            # scale
-            # http://ffmpeg.org/ffmpeg-filters.html#scale
-            # https://trac.ffmpeg.org/wiki/Scaling
-            if scale:
-                filter_string += ',' if filter_string != '' else ''
-                filter_string += f"scale={scale}:-2"
-            # rotate
-            # https://ffmpeg.org/ffmpeg-all.html#transpose
-            # 0 = 90CounterCLockwise and Vertical Flip (default)
-            # 1 = 90Clockwise
-            # 2 = 90CounterClockwise
-            # 3 = 90Clockwise and Vertical Flip
-            if rotate:
-                rotate_string = ''
-                if rotate == 90:
-                    rotate_string = 'transpose=1'
-                elif rotate == -90:
-                    rotate_string = 'transpose=2'
-                elif rotate == 180:
-                    rotate_string = 'transpose=1,transpose=1'
-                elif rotate == -180:
-                    rotate_string = 'transpose=2,transpose=2'
-                elif rotate == 270:
-                    rotate_string = 'transpose=1,transpose=1,transpose=1'
-                elif rotate == -270:
-                    rotate_string = 'transpose=2,transpose=2,transpose=2'
-                filter_string += ',' if filter_string != '' else ''
-                filter_string += rotate_string
-            # get option for filter
-            filter_option = ('-filter:v', filter_string) if filter_string else tuple()
-            # run ffmpeg
-            if filter_option or trim_option:
-                # combine trim and filter to run one time
-                self._run_ffmpeg(
-                    path_input=path_input,
-                    path_output=path_output,
-                    options=(
-                        *trim_option,
-                        *filter_option,
-                        '-threads', str(app.config.get('FFMPEG_THREADS')),
-                        '-preset', app.config.get('FFMPEG_PRESET')
-                    )
-                )
-            content = open(path_input, 'rb+').read()
-            metadata_edit_file = self._get_meta(path_input)
-        finally:
-            if path_input:
-                os.remove(path_input)
+        # get option for trim
+        trim_preoption = tuple()
+        trim_option = tuple()
+        if trim:
+            trim_option = ('-t', str(trim['end'] - trim['start']), '-qscale', '0')
+            if app.config.get('FFMPEG_TRIM_SEEK') == 'input':
+                # input seeking, a video is decoded from the closest keyframe before `start`,
+                # frames up to `start` are dropped and timestamps of the output start from 0
+                trim_preoption = ('-accurate_seek', '-ss', str(trim['start']))
+            else:
+                # output seeking, every frame before `start` is decoded
+                trim_option = ('-ss', str(trim['start']), *trim_option)
+        # crop
+        # https://ffmpeg.org/ffmpeg-filters.html#crop
+        if crop:
+            filter_string += f'crop={crop["width"]}:{crop["height"]}:{crop["x"]}:{crop["y"]}'
+        # scale
+        # http://ffmpeg.org/ffmpeg-filters.html#scale
+        # https://trac.ffmpeg.org/wiki/Scaling
+        if scale:
+            filter_string += ',' if filter_string != '' else ''
+            filter_string += f"scale={scale}:-2"
+        # rotate
+        # https://ffmpeg.org/ffmpeg-all.html#transpose
+        # 0 = 90CounterCLockwise and Vertical Flip (default)
+        # 1 = 90Clockwise
+        # 2 = 90CounterClockwise
+        # 3 = 90Clockwise and Vertical Flip
+        if rotate:
+            rotate_string = ''
+            if rotate == 90:
+                rotate_string = 'transpose=1'
+            elif rotate == -90:
+                rotate_string = 'transpose=2'
+            elif rotate == 180:
+                rotate_string = 'transpose=1,transpose=1'
+            elif rotate == -180:
+                rotate_string = 'transpose=2,transpose=2'
+            elif rotate == 270:
+                rotate_string = 'transpose=1,transpose=1,transpose=1'
+            elif rotate == -270:
+                rotate_string = 'transpose=2,transpose=2,transpose=2'
+            filter_string += ',' if filter_string != '' else ''
+            filter_string += rotate_string
+        # get option for filter
+        filter_option = ('-filter:v', filter_string) if filter_string else tuple()
+        # run ffmpeg
+        if trim and not filter_option and self._smart_trim(path_input, path_output, trim['start'], trim['end']):
+            # only partial GOPs at both ends were re-encoded
+            pass
+        elif filter_option or trim_option:
+            # combine trim and filter to run one time
+            self._run_ffmpeg(
+                path_input=path_input,
+                path_output=path_output,
+                preoptions=trim_preoption,
+                options=(
+                    *trim_option,
+                    *filter_option,
+                    '-threads', str(app.config.get('FFMPEG_THREADS')),
+                    '-preset', app.config.get('FFMPEG_PRESET')
+                ),
+                override=False,
+            )
+        else:
+            path_output = path_input
+        with open(path_output, 'rb') as f:
+            content = f.read()
+        metadata_edit_file = self._get_meta(path_output)
         return content, metadata_edit_file
 
-    def capture_thumbnail(self, stream_file, filename, duration, position, crop=None, rotate=0):
+    def _smart_trim(self, path_input, path_output, start, end):
+        """
+        Trim a video without re-encoding it entirely.
+        Part between the first and the last keyframe inside a trim is stream copied, only partial GOPs before
+        the first keyframe and after the last one are re-encoded, then all parts are concatenated. Audio is stream
+        copied. Copied part is cut by a number of packets, so it ends right before the last keyframe, re-encoded
+        parts are cut half a frame away from keyframes, so no frame is duplicated or dropped at joins.
+        Re-encoded parts use the profile and level of a source, since output keeps only parameter sets of
+        the first part in its sample entry. Result is kept only if its duration is accurate to a frame.
+        Used when `FFMPEG_SMART_TRIM` is enabled, a video codec is in `SMART_TRIM_ENCODERS`, a profile is in
+        `SMART_TRIM_PROFILES` and a video has no rotation, a constant frame rate and closed GOPs.
+        :param path_input: input file path
+        :type path_input: str
+        :param path_output: output file path, parts are saved next to it
+        :type path_output: str
+        :param start: trim start (seconds)
+        :type start: float
+        :param end: trim end (seconds)
+        :type end: float
+        :return: `True` if a video was trimmed, `False` if it must be trimmed by a full re-encode
+        :rtype: bool
+        """
+
+        if not app.config.get('FFMPEG_SMART_TRIM'):
+            return False
+
+        try:
+            stream = self._probe_video_stream(path_input)
+            codec = stream.get('codec_name')
+            encoder = SMART_TRIM_ENCODERS.get(codec)
+            profile = SMART_TRIM_PROFILES.get(codec, {}).get(stream.get('profile'))
+            if not encoder or not profile or not stream.get('pix_fmt') or (stream.get('level') or 0) <= 0:
+                return False
+            if stream['rotation']:
+                # re-encoded parts are rotated by autorotate, a copied part and mpeg-ts parts are not
+                return False
+            if Fraction(stream['avg_frame_rate']) != Fraction(stream['r_frame_rate']):
+                # cuts are placed half a frame away from keyframes, it requires a constant frame rate
+                return False
+            frame_duration = float(1 / Fraction(stream['r_frame_rate']))
+            # timestamps reported by ffprobe include a start time, seeking doesn't
+            offset = float(stream.get('start_time') or 0)
+            # packets are read a second past the end, so leading pictures of the last GOP are listed too
+            packets = [
+                (pts - offset, key) for pts, key in self._get_packets(path_input, start + offset, end + offset + 1)
+            ]
+            # frames from `start` (included) to `end` (excluded) are kept as by a full re-encode,
+            # timestamps are compared with a tolerance since ffprobe rounds them
+            keyframes = [
+                i for i, (pts, key) in enumerate(packets)
+                if key and start - TIMESTAMP_TOLERANCE <= pts <= end + TIMESTAMP_TOLERANCE
+            ]
+            if len(keyframes) < 2:
+                # there is no whole GOP to copy
+                return False
+            first, last = keyframes[0], keyframes[-1]
+            first_keyframe, last_keyframe = packets[first][0], packets[last][0]
+            if any(pts < packets[i][0] for i in (first, last) for pts, _ in packets[i + 1:]):
+                # open GOP, frames decoded after a keyframe are shown before it and can't be cut off
+                return False
+
+            if codec == 'h264':
+                # level is reported as level * 10
+                level_options = ('-level:v', f"{stream['level'] / 10:g}", '-refs', str(stream.get('refs') or 1))
+            else:
+                # level is reported as level * 30
+                level_options = ('-x265-params', f"level-idc={stream['level'] / 30:g}")
+            encode_options = (
+                '-map', '0:v:0', '-an',
+                '-c:v', encoder, '-pix_fmt', stream['pix_fmt'], '-crf', str(SMART_TRIM_CRF),
+                '-profile:v', profile, *level_options,
+                '-threads', str(app.config.get('FFMPEG_THREADS')),
+                '-preset', app.config.get('FFMPEG_PRESET'),
+                # mpeg-ts keeps parameter sets of every part in-band, so parts with different ones can be joined
+                '-f', 'mpegts',
+            )
+            parts = []
+            if any(start - TIMESTAMP_TOLERANCE <= pts < first_keyframe for pts, _ in packets):
+                # ends half a frame before a keyframe, so a rounded timestamp never includes a keyframe itself
+                parts.append((f'{path_output}.head.ts', ('-accurate_seek', '-ss', str(start)),
+                              ('-t', str(round(first_keyframe - start - frame_duration / 2, 6)), *encode_options)))
+            # seek a bit past a keyframe, so a rounded timestamp never lands on a previous keyframe,
+            # packets are copied in decode order up to the last keyframe exactly
+            parts.append((f'{path_output}.middle.ts', ('-ss', str(round(first_keyframe + frame_duration / 4, 6))),
+                          ('-frames:v', str(last - first), '-map', '0:v:0', '-an', '-c:v', 'copy', '-f', 'mpegts')))
+            if last_keyframe < end - TIMESTAMP_TOLERANCE:
+                # starts half a frame before a keyframe, so a rounded timestamp never skips a keyframe
+                tail_start = last_keyframe - frame_duration / 2
+                parts.append((f'{path_output}.tail.ts', ('-accurate_seek', '-ss', str(round(tail_start, 6))),
+                              ('-t', str(round(end - tail_start, 6)), *encode_options)))
+            for path_part, preoptions, options in parts:
+                self._run(('ffmpeg', '-loglevel', 'error', '-y', *preoptions, '-i', path_input, *options, path_part))
+                part = self._probe_video_stream(path_part)
+                if (part.get('profile'), part.get('level')) != (stream['profile'], stream['level']):
+                    # a decoder using a sample entry only would fail to decode a part
+                    raise RuntimeError(f"part {path_part} is {part.get('profile')} {part.get('level')}, "
+                                       f"expected {stream['profile']} {stream['level']}")
+
+            path_list = f'{path_output}.parts.txt'
+            with open(path_list, 'w') as f:
+                for path_part, _, _ in parts:
+                    f.write(f"file '{path_part}'\n")
+            # video is not cut again, only audio input is limited to a trim
+            self._run((
+                'ffmpeg', '-loglevel', 'error', '-y',
+                '-f', 'concat', '-safe', '0', '-i', path_list,
+                '-ss', str(start), '-t', str(round(end - start, 6)), '-i', path_input,
+                '-map', '0:v', '-map', '1:a?', '-c', 'copy',
+                path_output,
+            ))
+
+            duration = self._get_meta(path_output)['duration']
+            if abs(duration - (end - start)) >= frame_duration / 2:
+                raise RuntimeError(f'duration {duration} is not accurate, expected {end - start}')
+        except Exception as e:
+            logger.warning(f'FFMPEGVideoEditor:_smart_trim:{path_input}: {e}')
+            if os.path.exists(path_output):
+                os.remove(path_output)
+            return False
+        return True
+
+    def _probe_video_stream(self, file_path):
+        """
+        Return the first video stream of a file as reported by `ffprobe`, `start_time` is taken from a format.
+        `rotation` is a rotation in degrees set either by a display matrix or by a `rotate` tag, 0 if not set.
+        :rtype: dict
+        """
+
+        output = self._run((
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-print_format', 'json',
+            '-show_entries', 'stream=codec_name,profile,level,refs,pix_fmt,r_frame_rate,avg_frame_rate'
+                             ':stream_tags=rotate:stream_side_data=rotation:format=start_time',
+            file_path,
+        ))
+        data = json.loads(output.decode('utf-8'))
+        stream = data['streams'][0] if data.get('streams') else {}
+        stream['start_time'] = data.get('format', {}).get('start_time')
+        rotations = [side_data.get('rotation') for side_data in stream.get('side_data_list', [])]
+        rotations.append(stream.get('tags', {}).get('rotate'))
+        stream['rotation'] = next((int(float(r)) for r in rotations if r and int(float(r)) % 360), 0)
+        return stream
+
+    def _get_packets(self, file_path, start, end):
+        """
+        Return video packets between `start` and `end` in decode order, only packets are read, nothing is decoded.
+        Reading starts from a keyframe before `start`.
+        :return: list of (timestamp in seconds, `True` if packet is a keyframe)
+        :rtype: list
+        :raise RuntimeError: if a packet has no timestamp
+        """
+
+        output = self._run((
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-read_intervals', f'{start}%{end}',
+            '-show_entries', 'packet=pts_time,flags', '-print_format', 'csv=print_section=0', file_path,
+        ))
+        packets = []
+        for line in output.decode('utf-8').splitlines():
+            pts_time, _, flags = line.partition(',')
+            if pts_time in ('', 'N/A'):
+                raise RuntimeError(f'packet without a timestamp: {line}')
+            packets.append((float(pts_time), 'K' in flags))
+        return packets
+
+    @staticmethod
+    def _run(cmd):
+        """
+        Run `cmd` and return its stdout.
+        :raise RuntimeError: if `cmd` has failed
+        """
+
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+            (output, error) = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(f"Subprocess with command: '{cmd}' has failed: "
+                               f"{error.decode('utf-8', 'replace').strip()}")
+        return output
+
+    def capture_thumbnail(self, stream_file, filename, duration, position, crop=None, rotate=0, file_path=None,
+                          seek_mode='accurate'):
         """
         Use ffmpeg tool to capture video frame at a position.
         :param stream_file: video file
@@ -143,17 +377,27 @@ class FFMPEGVideoEditor(VideoEditorInterface):
         :type crop: dict
         :param rotate: rotate degree
         :type rotate: int
+        :param file_path: path to a video file, used instead of `stream_file` if set
+        :type file_path: str
+        :param seek_mode: 'accurate' decodes a video from the beginning up to a position,
+                          'fast' seeks to the closest keyframe before a position and decodes from there,
+                          'keyframe' returns the closest keyframe before a position, it's the fastest but approximate
+        :type seek_mode: str
         :return: file stream, metadata
         :rtype: bytes, dict
         """
 
-        path_video = create_temp_file(stream_file)
-        try:
+        if seek_mode not in SEEK_MODES:
+            raise ValueError(f"Unknown seek mode '{seek_mode}'")
+
+        reserve = (0 if file_path else len(stream_file)) + self._get_max_frame_size()
+        with scratch_dir(reserve=reserve) as scratch:
+            path_video = file_path or scratch.write(f"input.{filename.rsplit('.', 1)[-1]}", stream_file)
             # avoid the last frame, it is null
             if int(duration) <= int(position):
                 position = duration - 0.1
             # create output file path
-            output_file = f"{path_video}_preview_thumbnail.png"
+            output_file = scratch.get_path('preview_thumbnail.png', size=self._get_max_frame_size())
 
             vfilter = ''
             if crop:
@@ -163,34 +407,40 @@ class FFMPEGVideoEditor(VideoEditorInterface):
                 transpose = f'transpose=1' if rotate > 0 else f'transpose=2'
                 vfilter += ','.join([transpose] * abs(rotate // 90))
 
-            try:
-                # run ffmpeg command
-                self._run_ffmpeg(
-                    path_input=path_video,
-                    path_output=output_file,
-                    preoptions=('-y', '-accurate_seek'),
-                    options=(
-                        '-ss', str(position),
-                        '-vframes', '1',
-                        *shlex.split(vfilter),
-                    ),
-                    override=False,
-                )
-                # get metadata
-                thumbnail_metadata = self._get_meta(output_file)
-                thumbnail_metadata['mimetype'] = 'image/png'
-                # read binary
-                with open(output_file, "rb") as f:
-                    content = f.read()
-                return content, thumbnail_metadata
-            finally:
-                if os.path.exists(output_file):
-                    # delete temp thumbnail file
-                    os.remove(output_file)
-        finally:
-            os.remove(path_video)
+            if seek_mode == 'accurate':
+                # output seeking, every frame before a position is decoded
+                preoptions = ('-y', '-accurate_seek')
+                seek_options = ('-ss', str(position))
+            elif seek_mode == 'fast':
+                # input seeking, frames are decoded from the closest keyframe and dropped up to a position
+                preoptions = ('-y', '-accurate_seek', '-ss', str(position))
+                seek_options = tuple()
+            else:
+                # input seeking, keyframe itself is returned and no other frame is decoded
+                preoptions = ('-y', '-skip_frame', 'nokey', '-noaccurate_seek', '-ss', str(position))
+                seek_options = tuple()
+
+            # run ffmpeg command
+            self._run_ffmpeg(
+                path_input=path_video,
+                path_output=output_file,
+                preoptions=preoptions,
+                options=(
+                    *seek_options,
+                    '-vframes', '1',
+                    *shlex.split(vfilter),
+                ),
+                override=False,
+            )
+            # get metadata
+            thumbnail_metadata = self._get_meta(output_file)
+            thumbnail_metadata['mimetype'] = 'image/png'
+            # read binary
+            with open(output_file, "rb") as f:
+                content = f.read()
+            return content, thumbnail_metadata
 
-    def capture_timeline_thumbnails(self, stream_file, filename, duration, thumbnails_amount):
+    def capture_timeline_thumbnails(self, stream_file, filename, duration, thumbnails_amount, file_path=None):
         """
         Capture thumbnails for timeline.
         :param stream_file: video file
@@ -201,39 +451,209 @@ class FFMPEGVideoEditor(VideoEditorInterface):
         :type duration: int
         :param thumbnails_amount: total number of thumbnails to capture
         :type thumbnails_amount: int
+        :param file_path: path to a video file, used instead of `stream_file` if set
+        :type file_path: str
         :return: file stream, metadata generator
         :return: bytes, generator
         """
 
-        path_video = create_temp_file(stream_file)
-        try:
-            # time period between two frames
-            if thumbnails_amount == 1:
-                frame_per_second = (duration - 1)
-            else:
-                frame_per_second = (duration - 1) / (thumbnails_amount - 1)
-
-            # capture list frame via script capture_list_frames.sh
-            path_script = os.path.dirname(__file__) + '/script/capture_list_frames.sh'
-            # create output file path
-            output_file = f"{path_video}_"
-            # subprocess bash -> ffmpeg in the loop
-            subprocess.run([path_script, path_video, output_file, str(frame_per_second), str(thumbnails_amount)])
-            for i in range(0, thumbnails_amount):
-                thumbnail_path = f'{output_file}{i}.png'
+        # timeline thumbnails are scaled down to a few kilobytes, only a video needs a reservation
+        with scratch_dir(reserve=0 if file_path else len(stream_file)) as scratch:
+            path_video = file_path or scratch.write(f"input.{filename.rsplit('.', 1)[-1]}", stream_file)
+            positions = self._get_timeline_positions(duration, thumbnails_amount)
+            for thumbnail_path in self._capture_frames(path_video, scratch, positions, duration):
                 try:
-                    # get metadata
-                    thumbnail_metadata = self._get_meta(thumbnail_path)
-                    thumbnail_metadata['mimetype'] = 'image/png'
-                    # read binary
-                    with open(thumbnail_path, "rb") as f:
+                    with open(thumbnail_path, 'rb') as f:
                         content = f.read()
-                    yield content, thumbnail_metadata
+                    # png header has everything a timeline needs, so ffprobe is not started for every thumbnail
+                    width, height = self._get_png_size(content)
+                    yield content, {
+                        'codec_name': 'png',
+                        'mimetype': 'image/png',
+                        'width': width,
+                        'height': height,
+                        'size': len(content),
+                    }
                 finally:
-                    # delete temp thumbnail file
                     os.remove(thumbnail_path)
-        finally:
-            os.remove(path_video)
+
+    @staticmethod
+    def _get_timeline_positions(duration, thumbnails_amount):
+        """
+        Return positions (seconds) of `thumbnails_amount` frames spread evenly over a video,
+        the last second is skipped since the last frames might be null.
+        :rtype: list
+        """
+
+        if thumbnails_amount == 1:
+            return [0]
+        delta = max(duration - 1, 0) / (thumbnails_amount - 1)
+        return [round(delta * i, 3) for i in range(thumbnails_amount)]
+
+    def _capture_frames(self, path_video, scratch, positions, duration, prefix='timeline'):
+        """
+        Capture frames at `positions`.
+        Videos longer than `TIMELINE_THUMBNAILS_SEEK_DURATION` are seeked to every position, so only a few frames
+        around every position are decoded. Shorter videos are decoded once and frames are picked by `select` filter,
+        it's cheaper than seeking a video for every frame, unless positions are closer to each other than frames.
+        Seeking is split between several ffmpeg processes for long or high bitrate videos, see `_get_capture_workers`,
+        every process seeks to at most `TIMELINE_THUMBNAILS_MAX_INPUTS` positions at once.
+        :param path_video: video file path
+        :type path_video: str
+        :param scratch: scratch directory for captured frames
+        :type scratch: videoserver.lib.scratch.ScratchDir
+        :param positions: ascending positions (seconds) of frames
+        :type positions: list
+        :param duration: video's duration
+        :type duration: float
+        :param prefix: file name prefix of captured frames
+        :type prefix: str
+        :return: paths of captured frames in order of `positions`
+        :rtype: list
+        """
+
+        paths = [scratch.get_path(f'{prefix}_{i}.png', size=self._get_max_frame_size()) for i in range(len(positions))]
+
+        short = duration <= app.config.get('TIMELINE_THUMBNAILS_SEEK_DURATION')
+        if short and self._can_select_frames(path_video, positions):
+            try:
+                self._run_capture(self._get_select_frames_cmd(path_video, positions, paths), paths)
+                return paths
+            except RuntimeError as e:
+                # i.e. frames are sparser than positions in a part of a variable frame rate video,
+                # `select` skips a position rather than picking a frame twice
+                logger.warning(f'FFMPEGVideoEditor:_capture_frames:{path_video}: {e}')
+
+        workers, threads = self._get_capture_workers(path_video, len(positions), duration)
+        if workers == 1:
+            self._run_seek_capture(path_video, positions, paths, threads)
+            return paths
+
+        # contiguous groups, so paths of all groups are already in order of `positions`
+        group_size = -(-len(positions) // workers)
+        groups = [slice(i, i + group_size) for i in range(0, len(positions), group_size)]
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [
+                executor.submit(self._run_seek_capture, path_video, positions[group], paths[group], threads)
+                for group in groups
+            ]
+            for future in futures:
+                future.result()
+        return paths
+
+    def _can_select_frames(self, path_video, positions):
+        """
+        Check if positions are not closer to each other than frames of a video, `select` filter picks every
+        frame at most once, so it can't capture such positions.
+        :rtype: bool
+        """
+
+        if len(positions) < 2:
+            return True
+        stream = self._probe_video_stream(path_video)
+        try:
+            frame_rate = Fraction(stream.get('avg_frame_rate') or stream.get('r_frame_rate'))
+        except (TypeError, ValueError, ZeroDivisionError):
+            # frame rate is unknown, `select` fails if a position is skipped
+            return True
+        return not frame_rate or positions[1] - positions[0] >= 1 / frame_rate
+
+    @staticmethod
+    def _get_capture_workers(path_video, amount, duration):
+        """
+        Decide how many ffmpeg processes capture `amount` frames by seeking.
+        Every process decodes its frames sequentially, so several processes pay off only when decoding
+        is long: video is longer than `TIMELINE_THUMBNAILS_PARALLEL_DURATION` or its bitrate is higher than
+        `TIMELINE_THUMBNAILS_PARALLEL_BITRATE`, and there are more CPUs than one. Processes share
+        `FFMPEG_THREADS` threads (all CPUs if it's 0) and get at least `TIMELINE_THUMBNAILS_MIN_GROUP` frames each.
+        A single process decodes with a single thread, since all its inputs have decoders open at once.
+        :return: number of processes, decoding threads of every input
+        :rtype: int, int
+        """
+
+        cpus = int(app.config.get('FFMPEG_THREADS')) or os.cpu_count() or 1
+        max_workers = min(app.config.get('TIMELINE_THUMBNAILS_WORKERS') or cpus, cpus)
+        workers = min(max_workers, -(-amount // TIMELINE_THUMBNAILS_MIN_GROUP))
+        if workers <= 1:
+            return 1, 1
+
+        bit_rate = os.path.getsize(path_video) * 8 / duration if duration else 0
+        if duration < app.config.get('TIMELINE_THUMBNAILS_PARALLEL_DURATION') \
+                and bit_rate < app.config.get('TIMELINE_THUMBNAILS_PARALLEL_BITRATE'):
+            return 1, 1
+        return workers, max(cpus // workers, 1)
+
+    def _run_seek_capture(self, path_video, positions, paths, threads):
+        """
+        Capture frames at `positions` by seeking, by batches of `TIMELINE_THUMBNAILS_MAX_INPUTS` positions.
+        """
+
+        for i in range(0, len(positions), TIMELINE_THUMBNAILS_MAX_INPUTS):
+            batch = slice(i, i + TIMELINE_THUMBNAILS_MAX_INPUTS)
+            cmd = self._get_seek_frames_cmd(path_video, positions[batch], paths[batch], threads)
+            self._run_capture(cmd, paths[batch])
+
+    @staticmethod
+    def _get_seek_frames_cmd(path_video, positions, paths, threads):
+        # every position is a separate input with its own seek and its own output
+        inputs = []
+        outputs = []
+        for i, (position, path) in enumerate(zip(positions, paths)):
+            inputs.extend(('-threads', str(threads), '-accurate_seek', '-ss', str(position), '-i', path_video))
+            outputs.extend(('-map', f'{i}:v:0', '-frames:v', '1', '-filter:v', TIMELINE_THUMBNAIL_FILTER, path))
+        return ('ffmpeg', '-loglevel', 'error', '-y', *inputs, *outputs)
+
+    @staticmethod
+    def _get_select_frames_cmd(path_video, positions, paths):
+        # positions are evenly spaced: a frame is picked once its timestamp reaches a register 0,
+        # then the register is moved to the next position after the frame, so when frames are sparser than
+        # positions a position is skipped and frames are missing instead of being picked at shifted timestamps
+        delta = positions[1] - positions[0] if len(positions) > 1 else 0
+        next_position = f'ld(0)+{delta}*(floor((t-ld(0))/{delta})+1)' if delta else 'ld(0)'
+        select = f"select='if(gte(t\\,ld(0))\\,st(0\\,{next_position})+1)'"
+        # frames are numbered from 0 as `paths`
+        path_pattern = paths[0].rsplit('_', 1)[0] + '_%d.png'
+        return (
+            'ffmpeg', '-loglevel', 'error', '-y', '-i', path_video,
+            '-filter:v', f'setpts=PTS-STARTPTS,{select},{TIMELINE_THUMBNAIL_FILTER}',
+            '-vsync', 'vfr', '-frames:v', str(len(positions)), '-start_number', '0', path_pattern,
+        )
+
+    @staticmethod
+    def _run_capture(cmd, paths):
+        """
+        Run ffmpeg `cmd` and make sure it has written all `paths`.
+        """
+
+        with subprocess.Popen(cmd, stderr=subprocess.PIPE) as proc:
+            (_, error) = proc.communicate()
+        missing = sum(not os.path.isfile(path) for path in paths)
+        if proc.returncode != 0 or missing:
+            raise RuntimeError(f"Subprocess with command: '{cmd}' has failed, {missing} of {len(paths)} frames "
+                               f"are missing: {error.decode('utf-8', 'replace').strip()}")
+
+    @staticmethod
+    def _get_png_size(content):
+        """
+        Read width and height of a png image from its IHDR chunk.
+        :param content: png image
+        :type content: bytes
+        :return: width, height
+        :rtype: int, int
+        """
+
+        if content[:8] != b'\x89PNG\r\n\x1a\n' or content[12:16] != b'IHDR':
+            raise ValueError('Image is not a png.')
+        return struct.unpack('>II', content[16:24])
+
+    @staticmethod
+    def _get_max_frame_size():
+        """
+        Return max size of a single captured frame, an uncompressed png of `MAX_VIDEO_WIDTH` x `MAX_VIDEO_HEIGHT`.
+        :rtype: int
+        """
+
+        return int(app.config.get('MAX_VIDEO_WIDTH')) * int(app.config.get('MAX_VIDEO_HEIGHT')) * 4
 
     def _run_ffmpeg(self, path_input, path_output, preoptions=tuple(), options=tuple(), override=True):
         """
@@ -1,21 +1,26 @@
 import abc
 
+#: ways to find a frame at a thumbnail's position, see `VideoEditorInterface.capture_thumbnail`
+SEEK_MODES = ('accurate', 'fast', 'keyframe')
+
 
 class VideoEditorInterface(metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
-    def get_meta(self, filestream):
+    def get_meta(self, filestream=None, file_path=None):
         """
         Get metadata of file
         :param filestream: file to get meta from
         :type filestream: bytes
+        :param file_path: path to a file to get meta from, used instead of `filestream` if set
+        :type file_path: str
         :return: metadata
         :rtype: dict
         """
         pass
 
     @abc.abstractmethod
-    def edit_video(self, stream_file, filename, trim=None, crop=None, rotate=None, scale=None):
+    def edit_video(self, stream_file, filename, trim=None, crop=None, rotate=None, scale=None, file_path=None):
         """
         Edit video.
         :param stream_file: file to edit
@@ -30,12 +35,15 @@ class VideoEditorInterface(metaclass=abc.ABCMeta):
         :type video_rotate: int
         :param scale: width scale to
         :type scale: int
+        :param file_path: path to a file to edit, used instead of `stream_file` if set, file is not modified
+        :type file_path: str
         :return:
         """
         pass
 
     @abc.abstractmethod
-    def capture_thumbnail(self, stream_file, filename, duration, position, crop, rotate):
+    def capture_thumbnail(self, stream_file, filename, duration, position, crop, rotate, file_path=None,
+                          seek_mode='accurate'):
         """
         Capture video frame at a position.
         :param stream_file: video file
@@ -50,13 +58,18 @@ class VideoEditorInterface(metaclass=abc.ABCMeta):
         :type crop: dict
         :param rotate: rotate degree
         :type rotate: int
+        :param file_path: path to a video file, used instead of `stream_file` if set
+        :type file_path: str
+        :param seek_mode: 'accurate' - exact frame at a position, 'fast' - exact frame, decoded from the closest
+                          keyframe, 'keyframe' - the closest keyframe before a position
+        :type seek_mode: str
         :return: file stream, metadata
         :rtype: bytes, dict
         """
         pass
 
     @abc.abstractmethod
-    def capture_timeline_thumbnails(self, stream_file, filename, duration, thumbnails_amount):
+    def capture_timeline_thumbnails(self, stream_file, filename, duration, thumbnails_amount, file_path=None):
         """
         Capture thumbnails for timeline.
         :param stream_file: video file
@@ -67,6 +80,8 @@ class VideoEditorInterface(metaclass=abc.ABCMeta):
         :type duration: int
         :param thumbnails_amount: total number of thumbnails to capture
         :type thumbnails_amount: int
+        :param file_path: path to a video file, used instead of `stream_file` if set
+        :type file_path: str
         :return: file stream, metadata generator
         :return: bytes, generator
         """
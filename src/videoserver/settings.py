@@ -1,4 +1,5 @@
 import os
+import tempfile
 from distutils.util import strtobool as _strtobool
 
 
@@ -45,6 +46,7 @@ LOG_CONFIG_FILE = env('LOG_CONFIG_FILE', os.path.join(BASE_PATH, 'logging_config
 CORE_APPS = [
     'apps.swagger',
     'apps.projects',
+    'apps.storage',
 ]
 
 #: Mongo host port
@@ -83,8 +85,81 @@ CODEC_MIMETYPE_MAP = {
 
 #: media storage
 MEDIA_STORAGE = env('MEDIA_STORAGE', 'filesystem')
+#: how directories of new projects are named: 'date' (<year>/<month>/<day>/<project-id>) or
+# 'hash' (<xx>/<yy>/<project-id>, 2 levels of hex fan-out by a hash of a project id)
+# existing projects keep their directories, use `flask storage migrate-layout` to move them
+MEDIA_STORAGE_LAYOUT = env('MEDIA_STORAGE_LAYOUT', 'date')
 DEFAULT_PATH = os.path.join(BASE_PATH, 'media', 'projects')
 FS_MEDIA_STORAGE_PATH = env('FS_MEDIA_STORAGE_PATH', DEFAULT_PATH)
+#: several data volumes for fs storage: comma separated list of <name>:<path>[:<weight>], i.e.
+# 'disk1:/mnt/disk1/media:2,disk2:/mnt/disk2/media:1'
+# projects are spread over volumes by consistent hashing of a project id proportionally to volumes' weights,
+# storage ids of new projects start with a volume name, storage ids without it are kept in `FS_MEDIA_STORAGE_PATH`
+# use `flask storage rebalance` after a volume is added
+FS_MEDIA_STORAGE_VOLUMES = env('FS_MEDIA_STORAGE_VOLUMES', '')
+#: volume with less free bytes than that gets no new projects
+FS_MEDIA_STORAGE_VOLUME_MIN_FREE = int(env('FS_MEDIA_STORAGE_VOLUME_MIN_FREE', 1024 * 1024 * 1024))
+#: when fs storage flushes written files to a disk: 'none', 'file' (fsync a file) or 'full' (fsync a file and its dir)
+FS_MEDIA_STORAGE_FSYNC = env('FS_MEDIA_STORAGE_FSYNC', 'file')
+#: store every unique content once as a sha256 addressed blob, storage ids become hard links to blobs
+# blobs reference counters are kept in `media_blobs` collection
+FS_MEDIA_STORAGE_DEDUPLICATE = strtobool(env('FS_MEDIA_STORAGE_DEDUPLICATE', 'False'))
+#: directory inside `FS_MEDIA_STORAGE_PATH` for content addressed blobs
+FS_MEDIA_STORAGE_BLOBS_DIR = env('FS_MEDIA_STORAGE_BLOBS_DIR', '.blobs')
+#: serve range reads from memory mapped files, it saves an open and a seek per `Range` request,
+# see benchmarks/fs_storage_get_range.py
+# NOTE: it's safe only because fs storage never rewrites files in place, a mapped file truncated by
+# someone else leads to SIGBUS in a reader
+FS_MEDIA_STORAGE_MMAP = strtobool(env('FS_MEDIA_STORAGE_MMAP', 'True'))
+#: max number of memory mapped files kept opened per process
+FS_MEDIA_STORAGE_MMAP_CACHE_SIZE = int(env('FS_MEDIA_STORAGE_MMAP_CACHE_SIZE', 32))
+#: number of threads which remove files in `delete_many`
+FS_MEDIA_STORAGE_DELETE_WORKERS = int(env('FS_MEDIA_STORAGE_DELETE_WORKERS', 8))
+#: amazon s3 storage, used when `MEDIA_STORAGE` is 'amazon'
+# any S3 compatible storage can be used by setting `AWS_S3_ENDPOINT_URL`, i.e. http://localhost:9000 for MinIO
+AWS_S3_BUCKET = env('AWS_S3_BUCKET', 'videoserver')
+AWS_S3_REGION = env('AWS_S3_REGION', 'us-east-1')
+AWS_S3_ENDPOINT_URL = env('AWS_S3_ENDPOINT_URL')
+AWS_S3_ADDRESSING_STYLE = env('AWS_S3_ADDRESSING_STYLE', 'auto')
+AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID')
+AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY')
+#: max number of pooled http connections to s3
+AWS_S3_MAX_POOL_CONNECTIONS = int(env('AWS_S3_MAX_POOL_CONNECTIONS', 20))
+#: files bigger than that are uploaded and copied by parts, part size is `AWS_S3_MULTIPART_CHUNK_SIZE`
+AWS_S3_MULTIPART_THRESHOLD = int(env('AWS_S3_MULTIPART_THRESHOLD', 64 * 1024 * 1024))
+AWS_S3_MULTIPART_CHUNK_SIZE = int(env('AWS_S3_MULTIPART_CHUNK_SIZE', 16 * 1024 * 1024))
+#: lifetime of presigned urls in seconds
+AWS_S3_PRESIGNED_URL_EXPIRES = int(env('AWS_S3_PRESIGNED_URL_EXPIRES', 3600))
+#: keep files of `MEDIA_STORAGE` in a local disk cache, useful when storage is remote (i.e. 'amazon')
+MEDIA_STORAGE_CACHE = strtobool(env('MEDIA_STORAGE_CACHE', 'False'))
+MEDIA_STORAGE_CACHE_PATH = env('MEDIA_STORAGE_CACHE_PATH', os.path.join(BASE_PATH, 'media', 'cache'))
+#: max size of a local disk cache in bytes
+MEDIA_STORAGE_CACHE_SIZE = int(env('MEDIA_STORAGE_CACHE_SIZE', 10 * 1024 * 1024 * 1024))
+#: ranges of objects which are not cached whole are cached by aligned blocks of that size in bytes
+MEDIA_STORAGE_CACHE_BLOCK_SIZE = int(env('MEDIA_STORAGE_CACHE_BLOCK_SIZE', 1024 * 1024))
+#: keep small thumbnails of `MEDIA_STORAGE` in an in-process LRU cache of web workers, videos are never kept
+MEDIA_STORAGE_MEMORY_CACHE = strtobool(env('MEDIA_STORAGE_MEMORY_CACHE', 'True'))
+#: the same for celery workers, off by default since a task reads every file once
+MEDIA_STORAGE_MEMORY_CACHE_CELERY = strtobool(env('MEDIA_STORAGE_MEMORY_CACHE_CELERY', 'False'))
+#: max size of an in-process cache in bytes, it's allocated in every web and celery worker process
+MEDIA_STORAGE_MEMORY_CACHE_SIZE = int(env('MEDIA_STORAGE_MEMORY_CACHE_SIZE', 32 * 1024 * 1024))
+#: thumbnails bigger than that are never kept in an in-process cache
+MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE = int(env('MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE', 512 * 1024))
+#: collect call counts, bytes and latency histograms of `MEDIA_STORAGE`, exported at /storage/metrics
+#: metrics are kept per process, every web worker exports only its own calls
+MEDIA_STORAGE_INSTRUMENTATION = strtobool(env('MEDIA_STORAGE_INSTRUMENTATION', 'False'))
+#: max size of a chunk in bytes when a file is streamed from a storage
+MEDIA_STORAGE_CHUNK_SIZE = int(env('MEDIA_STORAGE_CHUNK_SIZE', 256 * 1024))
+#: how raw media files are delivered to a client
+# 'stream' - read a file by chunks in python
+# 'sendfile' - pass a file to `wsgi.file_wrapper`, WSGI servers like gunicorn or uwsgi use sendfile(2) for it
+# 'x-accel-redirect' - let nginx send a file, `MEDIA_DELIVERY_ACCEL_REDIRECT_PREFIX` must be an internal location
+#                      which is an alias for `FS_MEDIA_STORAGE_PATH`, with `FS_MEDIA_STORAGE_VOLUMES`
+#                      <prefix>/<name>/ must be an alias for a path of every volume as well
+# 'x-sendfile' - let apache (mod_xsendfile) or lighttpd send a file
+# 'redirect' - redirect a client to a storage's url if storage supports it (presigned url for s3), stream otherwise
+MEDIA_DELIVERY = env('MEDIA_DELIVERY', 'stream')
+MEDIA_DELIVERY_ACCEL_REDIRECT_PREFIX = env('MEDIA_DELIVERY_ACCEL_REDIRECT_PREFIX', '/protected-media/')
 
 #: media tool
 DEFAULT_MEDIA_TOOL = env('DEFAULT_MEDIA_TOOL', 'ffmpeg')
@@ -92,6 +167,20 @@ DEFAULT_MEDIA_TOOL = env('DEFAULT_MEDIA_TOOL', 'ffmpeg')
 #: pagination, items per page
 ITEMS_PER_PAGE = int(env('ITEMS_PER_PAGE', 25))
 DEFAULT_TOTAL_TIMELINE_THUMBNAILS = int(env('DEFAULT_TOTAL_TIMELINE_THUMBNAILS', 40))
+#: max amount of timeline thumbnails a client can request
+MAX_TOTAL_TIMELINE_THUMBNAILS = int(env('MAX_TOTAL_TIMELINE_THUMBNAILS', 200))
+#: save all thumbnails of a timeline into a single pack file instead of a file per thumbnail,
+# `offset` and `length` of every thumbnail in a pack are kept in a project
+TIMELINE_THUMBNAILS_PACK = strtobool(env('TIMELINE_THUMBNAILS_PACK', 'False'))
+#: timeline thumbnails of videos longer than that (seconds) are captured by seeking to every thumbnail,
+# shorter videos are decoded once from the beginning, both ways use a single ffmpeg process
+TIMELINE_THUMBNAILS_SEEK_DURATION = float(env('TIMELINE_THUMBNAILS_SEEK_DURATION', 120))
+#: seeking is split between several ffmpeg processes when a video is longer than
+# `TIMELINE_THUMBNAILS_PARALLEL_DURATION` seconds or its bitrate is higher than `TIMELINE_THUMBNAILS_PARALLEL_BITRATE`
+TIMELINE_THUMBNAILS_PARALLEL_DURATION = float(env('TIMELINE_THUMBNAILS_PARALLEL_DURATION', 30 * 60))
+TIMELINE_THUMBNAILS_PARALLEL_BITRATE = int(env('TIMELINE_THUMBNAILS_PARALLEL_BITRATE', 20 * 1000 * 1000))
+#: max number of those processes, they share `FFMPEG_THREADS` threads, 0 means a process per thread
+TIMELINE_THUMBNAILS_WORKERS = int(env('TIMELINE_THUMBNAILS_WORKERS', 0))
 
 #: set PORT for video server
 VIDEO_SERVER_PORT = env('VIDEO_SERVER_PORT', 5050)
@@ -105,6 +194,19 @@ MAX_VIDEO_WIDTH = env('MAX_VIDEO_WIDTH', 3840)
 MIN_VIDEO_HEIGHT = env('MIN_VIDEO_HEIGHT', 180)
 MAX_VIDEO_HEIGHT = env('MAX_VIDEO_HEIGHT', 2160)
 
+#: scratch space for intermediate files of ffmpeg, every task gets a directory which is removed when a task is finished,
+# directories left by dead processes are removed when a web server or celery worker starts
+SCRATCH_PATH = env('SCRATCH_PATH', os.path.join(tempfile.gettempdir(), 'videoserver'))
+#: optional tmpfs directory (i.e. /dev/shm/videoserver) for files not bigger than `SCRATCH_TMPFS_THRESHOLD` bytes
+SCRATCH_TMPFS_PATH = env('SCRATCH_TMPFS_PATH', '')
+SCRATCH_TMPFS_THRESHOLD = int(env('SCRATCH_TMPFS_THRESHOLD', 32 * 1024 * 1024))
+#: max number of bytes reserved by all tasks in `SCRATCH_PATH`, 0 means no limit
+SCRATCH_QUOTA = int(env('SCRATCH_QUOTA', 20 * 1024 * 1024 * 1024))
+#: seconds a task waits for a scratch space when quota is exhausted, 0 rejects a task right away
+SCRATCH_QUOTA_TIMEOUT = float(env('SCRATCH_QUOTA_TIMEOUT', 300))
+#: scratch directories older than that (seconds) are removed on startup even if their process is still running
+SCRATCH_STALE_AGE = int(env('SCRATCH_STALE_AGE', 24 * 60 * 60))
+
 #: ffmpeg command line defaults
 # the default is the number of available CPUs (0)
 FFMPEG_THREADS = env('FFMPEG_THREADS', '0')
@@ -114,3 +216,11 @@ FFMPEG_THREADS = env('FFMPEG_THREADS', '0')
 # but the file size will be larger when compared to medium. The visual quality will be the same.
 # Valid presets are ultrafast, superfast, veryfast, faster, fast, medium, slow, slower, veryslow and placebo.
 FFMPEG_PRESET = env('FFMPEG_PRESET', 'medium')
+# How a video is seeked to a trim start.
+# 'input' - decode a video from the closest keyframe before a trim start, the cost doesn't depend on a position.
+# 'output' - decode a video from the beginning, trimming the end of a long video costs nearly a full decode.
+# Both give the same frames, see `benchmarks/trim.py`.
+FFMPEG_TRIM_SEEK = env('FFMPEG_TRIM_SEEK', 'input')
+# Trim-only edits of h264 and hevc videos re-encode only partial GOPs at both ends of a trim
+# and stream copy everything between them, a full re-encode is used if a result is not accurate to a frame.
+FFMPEG_SMART_TRIM = strtobool(env('FFMPEG_SMART_TRIM', 'True'))
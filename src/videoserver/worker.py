@@ -1,6 +1,14 @@
 import logging
 
+from . import settings
 from .app import get_app
+from .lib.scratch import sweep_scratch
 
 logger = logging.getLogger(__name__)
-celery = get_app().celery
+# not named `app`, celery looks for its app instance by that name first
+flask_app = get_app({'MEDIA_STORAGE_MEMORY_CACHE': settings.MEDIA_STORAGE_MEMORY_CACHE_CELERY})
+celery = flask_app.celery
+
+# remove scratch files left by crashed workers
+with flask_app.app_context():
+    sweep_scratch()
@@ -1,4 +1,9 @@
 from .app import get_app
+from .lib.scratch import sweep_scratch
 
 
 application = get_app()
+
+# remove scratch files left by crashed workers
+with application.app_context():
+    sweep_scratch()
@@ -66,3 +66,35 @@ def test_get_raw_preview_thumbnail_404(test_app, client, projects):
         resp = client.get(url)
 
         assert resp.status == '404 NOT FOUND'
+
+
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_get_raw_timeline_thumbnail_packed(test_app, client, projects):
+    project = projects[0]
+    test_app.config['TIMELINE_THUMBNAILS_PACK'] = True
+
+    with test_app.test_request_context():
+        # capture timeline thumbnails
+        amount = 3
+        url = url_for(
+            'projects.retrieve_or_create_thumbnails', project_id=project['_id']
+        ) + f'?type=timeline&amount={amount}'
+        client.get(url)
+        resp = client.get(url)
+        thumbnails = resp.get_json()
+
+        # all thumbnails are saved in a single pack
+        assert len(thumbnails) == amount
+        assert len({thumbnail['storage_id'] for thumbnail in thumbnails}) == 1
+        assert thumbnails[1]['offset'] == thumbnails[0]['length']
+        pack = test_app.fs.get(thumbnails[0]['storage_id'])
+        assert len(pack) == sum(thumbnail['length'] for thumbnail in thumbnails)
+
+        # get raw timeline thumbnail
+        url = url_for('projects.get_raw_timeline_thumbnail', project_id=project['_id'], index=1)
+        resp = client.get(url)
+
+        assert resp.status == '200 OK'
+        assert resp.mimetype == 'image/png'
+        assert resp.data == pack[thumbnails[1]['offset']:thumbnails[1]['offset'] + thumbnails[1]['length']]
+        assert resp.data.startswith(b'\x89PNG')
@@ -1,3 +1,5 @@
+import os
+
 from bson import ObjectId
 
 import pytest
@@ -32,7 +34,61 @@ def test_get_raw_video_range(test_app, client, projects):
         assert resp.status == '206 PARTIAL CONTENT'
         assert resp.mimetype == 'video/mp4'
         assert resp.is_streamed
-        # TODO check resp.content_length
+        size = test_app.fs.stat(project['storage_id'])['size']
+        assert resp.content_length == size - 200
+        assert resp.headers['Content-Range'] == f'bytes 200-{size - 1}/{size}'
+        assert len(resp.data) == size - 200
+
+
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_get_raw_video_conditional(test_app, client, projects):
+    project = projects[0]
+
+    with test_app.test_request_context():
+        url = url_for('projects.get_raw_video', project_id=project['_id'])
+        resp = client.get(url)
+        etag = resp.headers['ETag']
+        size = resp.content_length
+        assert resp.headers['Last-Modified']
+
+        resp = client.get(url, headers={'If-None-Match': etag})
+        assert resp.status == '304 NOT MODIFIED'
+        assert resp.data == b''
+
+        resp = client.get(url, headers={'If-Modified-Since': resp.headers['Last-Modified']})
+        assert resp.status == '304 NOT MODIFIED'
+
+        # suffix range
+        resp = client.get(url, headers={'Range': 'bytes=-100', 'If-Range': etag})
+        assert resp.status == '206 PARTIAL CONTENT'
+        assert resp.headers['Content-Range'] == f'bytes {size - 100}-{size - 1}/{size}'
+        assert resp.content_length == 100
+
+        # video was changed, whole file is returned
+        resp = client.get(url, headers={'Range': 'bytes=0-99', 'If-Range': '"old-version"'})
+        assert resp.status == '200 OK'
+        assert resp.content_length == size
+
+        resp = client.get(url, headers={'Range': f'bytes={size}-'})
+        assert resp.status == '416 REQUESTED RANGE NOT SATISFIABLE'
+        assert resp.headers['Content-Range'] == f'bytes */{size}'
+
+
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_get_raw_video_stale_metadata(test_app, client, projects):
+    project = projects[0]
+    # i.e. video was replaced by an edit, but metadata is not updated yet
+    test_app.mongo.db.projects.find_one_and_update(
+        {'_id': ObjectId(project['_id'])},
+        {'$set': {'metadata.size': 100}}
+    )
+
+    with test_app.test_request_context():
+        url = url_for('projects.get_raw_video', project_id=project['_id'])
+        resp = client.get(url, headers={"Range": "bytes=200-"})
+
+        assert resp.status == '206 PARTIAL CONTENT'
+        assert resp.content_length == test_app.fs.stat(project['storage_id'])['size'] - 200
 
 
 @pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
@@ -52,3 +108,87 @@ def test_get_raw_video_409_resp(test_app, client, projects):
         resp = client.get(url)
 
         assert resp.status == '409 CONFLICT'
+
+
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_get_raw_video_x_accel_redirect(test_app, client, projects):
+    project = projects[0]
+    test_app.config['MEDIA_DELIVERY'] = 'x-accel-redirect'
+
+    with test_app.test_request_context():
+        url = url_for('projects.get_raw_video', project_id=project['_id'])
+        resp = client.get(
+            url,
+            headers={"Range": "bytes=200-"}
+        )
+
+        assert resp.status == '200 OK'
+        assert resp.mimetype == 'video/mp4'
+        assert resp.headers['X-Accel-Redirect'] == f'/protected-media/{project["storage_id"]}'
+        assert 'Content-Range' not in resp.headers
+        assert resp.data == b''
+
+
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_get_raw_video_sendfile(test_app, client, projects):
+    project = projects[0]
+    test_app.config['MEDIA_DELIVERY'] = 'sendfile'
+
+    with test_app.test_request_context():
+        url = url_for('projects.get_raw_video', project_id=project['_id'])
+        resp = client.get(
+            url,
+            headers={"Range": "bytes=200-"}
+        )
+
+        assert resp.status == '206 PARTIAL CONTENT'
+        assert resp.mimetype == 'video/mp4'
+        assert resp.content_length == len(resp.data)
+        assert resp.data == test_app.fs.get(project['storage_id'])[200:]
+
+
+@pytest.mark.parametrize('delivery', ['stream', 'sendfile'])
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_get_raw_video_missing_file(test_app, client, projects, delivery, monkeypatch):
+    project = projects[0]
+    test_app.config['MEDIA_DELIVERY'] = delivery
+    # file vanishes after a storage was asked for its size
+    monkeypatch.setattr(test_app.fs, 'stat', lambda storage_id: None)
+    os.remove(test_app.fs.get_local_path(project['storage_id']))
+
+    with test_app.test_request_context():
+        url = url_for('projects.get_raw_video', project_id=project['_id'])
+        resp = client.get(url)
+
+        assert resp.status == '404 NOT FOUND'
+
+
+@pytest.mark.parametrize('delivery', ['stream', 'sendfile'])
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_get_raw_video_replaced(test_app, client, projects, delivery, monkeypatch):
+    project = projects[0]
+    test_app.config['MEDIA_DELIVERY'] = delivery
+    file_path = test_app.fs.get_local_path(project['storage_id'])
+    stat = test_app.fs.stat
+    replaced = []
+
+    def stat_and_replace(storage_id):
+        result = stat(storage_id)
+        if not replaced:
+            # i.e. an edit replaces a video after its size was read but before it's opened
+            with open(f'{file_path}.tmp', 'wb') as f:
+                f.write(b'edited video')
+            os.replace(f'{file_path}.tmp', file_path)
+            replaced.append(True)
+        return result
+
+    monkeypatch.setattr(test_app.fs, 'stat', stat_and_replace)
+
+    with test_app.test_request_context():
+        url = url_for('projects.get_raw_video', project_id=project['_id'])
+        resp = client.get(url)
+
+        assert resp.status == '200 OK'
+        assert resp.content_length == len(b'edited video')
+        assert resp.data == b'edited video'
+        assert resp.headers['ETag'] == f'"{stat(project["storage_id"])["etag"]}"'
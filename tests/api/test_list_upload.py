@@ -1,4 +1,5 @@
 import json
+import os
 from io import BytesIO
 from unittest import mock
 
@@ -56,6 +57,8 @@ def test_upload_project_wrong_codec(test_app, client, filestreams):
         resp_data = json.loads(resp.data)
         assert resp.status == '400 BAD REQUEST'
         assert resp_data['file'] == ["Codec: 'mjpeg' is not supported."]
+        # rejected file is removed from storage
+        assert not [files for _, _, files in os.walk(test_app.config['FS_MEDIA_STORAGE_PATH']) if files]
 
 
 @pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
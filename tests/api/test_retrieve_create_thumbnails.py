@@ -57,6 +57,19 @@ def test_capture_timeline_thumbnails_remove_old(test_app, client, projects):
             assert test_app.fs.get(thumbnail_data['storage_id']).__class__ is bytes
 
 
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_capture_timeline_thumbnails_too_many(test_app, client, projects):
+    project = projects[0]
+    amount = test_app.config['MAX_TOTAL_TIMELINE_THUMBNAILS'] + 1
+
+    with test_app.test_request_context():
+        url = url_for(
+            'projects.retrieve_or_create_thumbnails', project_id=project['_id']
+        ) + f'?type=timeline&amount={amount}'
+        resp = client.get(url)
+        assert resp.status == '400 BAD REQUEST'
+
+
 @pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
 def test_capture_timeline_thumbnails_409_resp(test_app, client, projects):
     project = projects[0]
@@ -342,3 +355,44 @@ def test_upload_custom_preview_remove_old_thumbnail(test_app, client, projects,
         # check that old thumbnail is deleted
         with pytest.raises(FileNotFoundError):
             test_app.fs.get(captured_thumb_strage_id)
+
+
+@pytest.mark.parametrize('projects', [({'file': 'sample_0.mp4', 'duplicate': False},)], indirect=True)
+def test_capture_preview_thumbnail_seek_mode(test_app, client, projects):
+    project = projects[0]
+    position = 4
+
+    with test_app.test_request_context():
+        url = url_for(
+            'projects.retrieve_or_create_thumbnails', project_id=project['_id']
+        ) + f'?type=preview&position={position}'
+        resp = client.get(url)
+        assert resp.status == '202 ACCEPTED'
+        resp = client.get(url_for('projects.retrieve_edit_destroy_project', project_id=project['_id']))
+        preview = json.loads(resp.data)['thumbnails']['preview']
+
+        for seek_mode in ('fast', 'keyframe'):
+            url = url_for(
+                'projects.retrieve_or_create_thumbnails', project_id=project['_id']
+            ) + f'?type=preview&position={position}&seek_mode={seek_mode}'
+            resp = client.get(url)
+            assert resp.status == '200 OK'
+            assert resp.mimetype == 'image/png'
+            assert resp.data.startswith(b'\x89PNG')
+
+            # scrubbing previews don't replace a preview thumbnail
+            resp = client.get(
+                url_for('projects.retrieve_edit_destroy_project', project_id=project['_id'])
+            )
+            resp_data = json.loads(resp.data)
+            assert resp_data['thumbnails']['preview'] == preview
+            assert not resp_data['processing']['thumbnail_preview']
+            assert test_app.fs.get(preview['storage_id'])
+
+        url = url_for(
+            'projects.retrieve_or_create_thumbnails', project_id=project['_id']
+        ) + f'?type=preview&position={position}&seek_mode=random'
+        resp = client.get(url)
+        resp_data = json.loads(resp.data)
+        assert resp.status == '400 BAD REQUEST'
+        assert resp_data == {'seek_mode': ['unallowed value random']}
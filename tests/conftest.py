@@ -36,6 +36,8 @@ def test_app(request):
         """
         # drop test db
         test_app.mongo.db.projects.drop()
+        test_app.mongo.db.media_blobs.drop()
+        test_app.mongo.db.media_blob_links.drop()
         # drop test media folder
         if os.path.exists(test_app.config['FS_MEDIA_STORAGE_PATH']):
             shutil.rmtree(os.path.dirname(test_app.config.get('FS_MEDIA_STORAGE_PATH')))
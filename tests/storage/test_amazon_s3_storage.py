@@ -0,0 +1,194 @@
+import os
+from io import BytesIO
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from videoserver.lib.storage.amazon_s3_storage import AmazonS3Storage  # noqa
+from videoserver.lib.storage.caching_storage import CachingStorage  # noqa
+
+mock_s3 = getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_s3')
+
+
+@pytest.fixture(scope='function')
+def s3_app(test_app):
+    test_app.config['AWS_S3_BUCKET'] = 'videoserver-test'
+    test_app.config['AWS_ACCESS_KEY_ID'] = 'testing'
+    test_app.config['AWS_SECRET_ACCESS_KEY'] = 'testing'
+    test_app.config['AWS_S3_MULTIPART_THRESHOLD'] = 5 * 1024 * 1024
+    test_app.config['AWS_S3_MULTIPART_CHUNK_SIZE'] = 5 * 1024 * 1024
+
+    with mock_s3():
+        with test_app.app_context():
+            boto3.client('s3', region_name=test_app.config['AWS_S3_REGION']).create_bucket(
+                Bucket=test_app.config['AWS_S3_BUCKET']
+            )
+        yield test_app
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_s3_storage_put_get(s3_app, filestreams):
+    storage = AmazonS3Storage()
+    mp4_stream, jpg_stream_0 = filestreams
+
+    with s3_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+            asset_type='project',
+            content_type='video/mp4'
+        )
+        thumbn_0_storage_id = storage.put(
+            content=jpg_stream_0,
+            filename='sample_1_image.jpg',
+            storage_id=storage_id,
+            asset_type='thumbnail'
+        )
+        assert storage_id.endswith('/project_one/sample_video.mp4')
+        assert thumbn_0_storage_id.endswith('/project_one/thumbnail/sample_1_image.jpg')
+        assert storage.get(storage_id) == mp4_stream
+        assert storage.get(thumbn_0_storage_id) == jpg_stream_0
+
+        with pytest.raises(Exception):
+            storage.put(
+                content=jpg_stream_0,
+                filename='sample_1_image.jpg',
+                storage_id=storage_id,
+                asset_type='thumbnail',
+                override=False
+            )
+        with pytest.raises(FileNotFoundError):
+            storage.get(storage_id + '.random.png')
+
+
+def test_s3_storage_put_stream_multipart(s3_app):
+    storage = AmazonS3Storage()
+    # bigger than `AWS_S3_MULTIPART_THRESHOLD`
+    content = os.urandom(11 * 1024 * 1024)
+
+    with s3_app.app_context():
+        storage_id = storage.put_stream(
+            stream=BytesIO(content),
+            filename='big_video.mp4',
+            project_id='project_one',
+        )
+        head = storage.client.head_object(Bucket=storage.bucket, Key=storage_id)
+        # etag of multipart upload ends with a number of parts
+        assert head['ETag'].strip('"').endswith('-3')
+        assert storage.get(storage_id) == content
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_s3_storage_get_range_and_stream(s3_app, filestreams):
+    storage = AmazonS3Storage()
+    mp4_stream = filestreams[0]
+
+    with s3_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+        )
+        assert storage.get_range(storage_id, 1000000, 1000000) == mp4_stream[1000000:2000000]
+        assert len(storage.get_range(storage_id, 2000000, 1000000)) == 617862
+        assert storage.get_range(storage_id, 3000000, 1000000) == b''
+
+        chunks = list(storage.get_stream(storage_id, start=200, length=1500000, chunk_size=1000000))
+        assert b''.join(chunks) == mp4_stream[200:1500200]
+        assert b''.join(storage.get_stream(storage_id, start=200)) == mp4_stream[200:]
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_s3_storage_copy_replace_delete(s3_app, filestreams):
+    storage = AmazonS3Storage()
+    mp4_stream, jpg_stream_0 = filestreams
+
+    with s3_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+        )
+        thumbn_0_storage_id = storage.put(
+            content=jpg_stream_0,
+            filename='sample_1_image.jpg',
+            storage_id=storage_id,
+            asset_type='thumbnail'
+        )
+        copy_storage_id = storage.copy(
+            src_storage_id=storage_id,
+            dst_filename='sample_video.mp4',
+            project_id='project_two',
+        )
+        assert storage.get(copy_storage_id) == mp4_stream
+
+        etag = storage.stat(copy_storage_id)['etag']
+        storage.replace(content=jpg_stream_0, storage_id=copy_storage_id)
+        assert storage.get(copy_storage_id) == jpg_stream_0
+        assert storage.stat(copy_storage_id)['size'] == len(jpg_stream_0)
+        assert storage.stat(copy_storage_id)['etag'] != etag
+        assert storage.get(storage_id) == mp4_stream
+
+        storage.delete(copy_storage_id)
+        with pytest.raises(FileNotFoundError):
+            storage.get(copy_storage_id)
+
+        missing_storage_id = storage_id + '.random.png'
+        results = storage.delete_many([thumbn_0_storage_id, missing_storage_id])
+        assert results == {thumbn_0_storage_id: True, missing_storage_id: True}
+        with pytest.raises(FileNotFoundError):
+            storage.get(thumbn_0_storage_id)
+
+        storage.delete_dir(storage_id)
+        with pytest.raises(FileNotFoundError):
+            storage.get(storage_id)
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_s3_storage_presigned_url(s3_app, filestreams):
+    storage = AmazonS3Storage()
+    mp4_stream = filestreams[0]
+
+    with s3_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+        )
+        url = storage.get_url(storage_id)
+        assert storage_id in url
+        assert 'Signature' in url or 'X-Amz-Signature' in url
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_s3_storage_open_local(s3_app, filestreams):
+    storage = AmazonS3Storage()
+    mp4_stream = filestreams[0]
+    media_path = os.path.dirname(s3_app.config['FS_MEDIA_STORAGE_PATH'])
+    s3_app.config['SCRATCH_PATH'] = os.path.join(media_path, 'scratch')
+    s3_app.config['MEDIA_STORAGE_CACHE_PATH'] = os.path.join(media_path, 'cache')
+
+    with s3_app.app_context():
+        storage_id = storage.put(content=mp4_stream, filename='sample_video.mp4', project_id='project_one')
+
+        # file is downloaded into a scratch directory
+        with storage.open_local(storage_id) as file_path:
+            assert file_path.startswith(s3_app.config['SCRATCH_PATH'])
+            assert file_path.endswith('.mp4')
+            with open(file_path, 'rb') as f:
+                assert f.read() == mp4_stream
+        assert not os.path.exists(file_path)
+
+        # cached object is used
+        caching_storage = CachingStorage(storage)
+        with caching_storage.open_local(storage_id) as file_path:
+            assert file_path == caching_storage._get_object_path(storage_id)
+        with caching_storage.open_local(storage_id) as file_path:
+            with open(file_path, 'rb') as f:
+                assert f.read() == mp4_stream
+        stats = caching_storage.get_stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
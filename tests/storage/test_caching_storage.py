@@ -0,0 +1,185 @@
+import os
+
+import pytest
+
+from videoserver.lib.storage.caching_storage import CachingStorage
+from videoserver.lib.storage.file_system_storage import FileSystemStorage
+
+
+@pytest.fixture(scope='function')
+def cache_app(test_app):
+    test_app.config['MEDIA_STORAGE_CACHE_PATH'] = os.path.join(os.path.dirname(__file__), '..', 'media', 'cache')
+    test_app.config['SCRATCH_PATH'] = os.path.join(os.path.dirname(__file__), '..', 'media', 'scratch')
+    return test_app
+
+
+class RemoteStorage(FileSystemStorage):
+    """
+    Storage which doesn't provide its files in place, like a remote one.
+    """
+
+    def get_local_path(self, storage_id):
+        return None
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_caching_storage_read_through(cache_app, filestreams):
+    storage = CachingStorage(FileSystemStorage())
+    mp4_stream, jpg_stream_0 = filestreams
+
+    with cache_app.app_context():
+        storage_id = storage.storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+        )
+        assert storage.get(storage_id) == mp4_stream
+        assert storage.get_stats()['misses'] == 1
+        assert os.path.exists(storage._get_object_path(storage_id, storage._get_version(storage_id)))
+
+        assert storage.get(storage_id) == mp4_stream
+        assert storage.get_range(storage_id, 200, 1000) == mp4_stream[200:1200]
+        assert b''.join(storage.get_stream(storage_id, start=200)) == mp4_stream[200:]
+        stats = storage.get_stats()
+        assert stats['hits'] == 3
+        assert stats['misses'] == 1
+        assert stats['size'] == len(mp4_stream)
+
+        # cache is invalidated and updated on replace
+        storage.replace(content=jpg_stream_0, storage_id=storage_id)
+        assert storage.get(storage_id) == jpg_stream_0
+        assert storage.get_stats()['misses'] == 1
+
+        storage.delete_dir(storage_id)
+        assert not os.path.exists(os.path.dirname(storage._get_object_path(storage_id)))
+        with pytest.raises(FileNotFoundError):
+            storage.get(storage_id)
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_caching_storage_stream_and_ranges(cache_app, filestreams):
+    storage = CachingStorage(FileSystemStorage())
+    mp4_stream = filestreams[0]
+
+    with cache_app.app_context():
+        storage_id = storage.storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+        )
+        # not finished stream is not cached
+        chunks = storage.get_stream(storage_id, chunk_size=1000)
+        next(chunks)
+        chunks.close()
+        version = storage._get_version(storage_id)
+        assert not os.path.exists(storage._get_object_path(storage_id, version))
+
+        # range of not cached object is cached by aligned blocks
+        cache_app.config['MEDIA_STORAGE_CACHE_BLOCK_SIZE'] = 1024
+        assert storage.get_range(storage_id, 200, 1000) == mp4_stream[200:1200]
+        assert storage.get_stats()['misses'] == 1
+        assert os.path.exists(storage._get_block_path(storage_id, version, 0))
+        assert os.path.exists(storage._get_block_path(storage_id, version, 1))
+        # other ranges inside the same blocks are hits
+        assert storage.get_range(storage_id, 200, 1000) == mp4_stream[200:1200]
+        assert storage.get_range(storage_id, 1000, 1048) == mp4_stream[1000:2048]
+        assert storage.get_stats()['hits'] == 2
+        assert len(os.listdir(os.path.dirname(storage._get_object_path(storage_id)))) == 2
+        # the last block is shorter
+        last = len(mp4_stream) // 1024
+        assert storage.get_range(storage_id, last * 1024 - 10, 100) == mp4_stream[last * 1024 - 10:last * 1024 + 90]
+
+        # whole stream is cached
+        assert b''.join(storage.get_stream(storage_id)) == mp4_stream
+        assert os.path.exists(storage._get_object_path(storage_id, version))
+
+        storage.delete(storage_id)
+        assert not os.path.exists(storage._get_block_path(storage_id, version, 0))
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg', 'sample_1.jpg')], indirect=True)
+def test_caching_storage_eviction(cache_app, filestreams):
+    storage = CachingStorage(FileSystemStorage())
+    jpg_stream_0, jpg_stream_1 = filestreams
+    cache_app.config['MEDIA_STORAGE_CACHE_SIZE'] = len(jpg_stream_0) + len(jpg_stream_1) - 1
+
+    with cache_app.app_context():
+        storage_id_0 = storage.put(
+            content=jpg_stream_0,
+            filename='sample_0.jpg',
+            project_id='project_one',
+        )
+        storage_id_1 = storage.put(
+            content=jpg_stream_1,
+            filename='sample_1.jpg',
+            project_id='project_one',
+        )
+        # least recently used file was evicted
+        assert not os.path.exists(storage._get_object_path(storage_id_0, storage._get_version(storage_id_0)))
+        assert os.path.exists(storage._get_object_path(storage_id_1, storage._get_version(storage_id_1)))
+        assert storage.get_stats()['evictions'] == 1
+        assert storage.get(storage_id_0) == jpg_stream_0
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_caching_storage_revalidation(cache_app, filestreams):
+    storage = CachingStorage(FileSystemStorage())
+    mp4_stream, jpg_stream_0 = filestreams
+
+    with cache_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+        )
+        old_version = storage._get_version(storage_id)
+        assert storage.get_range(storage_id, 200, 1000) == mp4_stream[200:1200]
+
+        # file is replaced by another host, so this cache is not invalidated
+        storage.storage.replace(content=jpg_stream_0, storage_id=storage_id)
+        assert storage._get_version(storage_id) != old_version
+        assert storage.get(storage_id) == jpg_stream_0
+        assert b''.join(storage.get_stream(storage_id)) == jpg_stream_0
+        assert storage.get_range(storage_id, 200, 1000) == jpg_stream_0[200:1200]
+        # files of an old version are removed
+        assert os.listdir(os.path.dirname(storage._get_object_path(storage_id))) == [
+            os.path.basename(storage._get_object_path(storage_id, storage._get_version(storage_id)))
+        ]
+        assert storage.get_stats()['stale'] == 1
+
+        # file is removed by another host
+        storage.storage.delete(storage_id)
+        with pytest.raises(FileNotFoundError):
+            storage.get(storage_id)
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg',)], indirect=True)
+def test_caching_storage_metrics(cache_app, client, filestreams):
+    cache_app.fs = CachingStorage(FileSystemStorage())
+    storage_id = cache_app.fs.put(content=filestreams[0], filename='sample_0.jpg', project_id='project_one')
+    assert cache_app.fs.get(storage_id) == filestreams[0]
+
+    resp = client.get('/storage/metrics')
+    assert resp.status == '200 OK'
+    metrics = resp.get_data(as_text=True)
+    assert 'videoserver_storage_cache_hits_total 1' in metrics
+    assert f'videoserver_storage_cache_size_bytes {len(filestreams[0])}' in metrics
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_caching_storage_open_local(cache_app, filestreams):
+    storage = CachingStorage(RemoteStorage())
+    mp4_stream = filestreams[0]
+
+    with cache_app.app_context():
+        storage_id = storage.put(content=mp4_stream, filename='sample_video.mp4', project_id='project_one')
+        object_path = storage._get_object_path(storage_id, storage._get_version(storage_id))
+
+        with storage.open_local(storage_id) as file_path:
+            assert file_path.endswith('sample_video.mp4')
+            assert os.path.samefile(file_path, object_path)
+            # object is evicted by another process while a task still uses it
+            os.remove(object_path)
+            with open(file_path, 'rb') as f:
+                assert f.read() == mp4_stream
+        assert not os.path.exists(file_path)
@@ -1,6 +1,11 @@
+import errno
+import hashlib
 import os
+import shutil
+from io import BytesIO
 
 import pytest
+from videoserver.lib.storage import file_system_storage
 from videoserver.lib.storage.file_system_storage import FileSystemStorage
 
 
@@ -176,6 +181,74 @@ def test_fs_storage_delete(test_app, filestreams):
             storage.get(storage_id)
 
 
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg', 'sample_1.jpg')], indirect=True)
+def test_fs_storage_stat(test_app, filestreams):
+    storage = FileSystemStorage()
+    jpg_stream_0, jpg_stream_1 = filestreams
+    with test_app.app_context():
+        storage_id = storage.put(content=jpg_stream_0, filename='sample_0.jpg', project_id='project_one')
+        stat = storage.stat(storage_id)
+        assert stat['size'] == len(jpg_stream_0)
+        assert stat['mtime'].timestamp() == pytest.approx(os.path.getmtime(storage._get_file_path(storage_id)))
+        assert storage.stat(storage_id) == stat
+
+        storage.replace(content=jpg_stream_1, storage_id=storage_id)
+        new_stat = storage.stat(storage_id)
+        assert new_stat['size'] == len(jpg_stream_1)
+        assert new_stat['etag'] != stat['etag']
+
+        with pytest.raises(FileNotFoundError):
+            storage.stat(storage_id + '.random.png')
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_fs_storage_open_local(test_app, filestreams):
+    storage = FileSystemStorage()
+    mp4_stream = filestreams[0]
+    with test_app.app_context():
+        storage_id = storage.put(content=mp4_stream, filename='sample_video.mp4', project_id='project_one')
+        # file is used in place
+        with storage.open_local(storage_id) as file_path:
+            assert file_path == os.path.abspath(storage._get_file_path(storage_id))
+        assert os.path.exists(file_path)
+
+        with pytest.raises(FileNotFoundError):
+            with storage.open_local(storage_id + '.random.mp4'):
+                pass
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg', 'sample_1.jpg')], indirect=True)
+def test_fs_storage_delete_many(test_app, filestreams):
+    storage = FileSystemStorage()
+    test_app.config['FS_MEDIA_STORAGE_DELETE_WORKERS'] = 2
+    with test_app.app_context():
+        storage_ids = [
+            storage.put(content=stream, filename=f'sample_{i}.jpg', project_id='project_one')
+            for i, stream in enumerate(filestreams)
+        ]
+        # not existing file is reported as removed
+        storage_ids.append(storage_ids[0] + '.random.png')
+        # directory can't be removed as a file
+        storage_ids.append(os.path.dirname(storage_ids[0]))
+
+        results = storage.delete_many(storage_ids)
+        assert results == {
+            storage_ids[0]: True,
+            storage_ids[1]: True,
+            storage_ids[2]: True,
+            storage_ids[3]: False,
+        }
+        for storage_id in storage_ids[:2]:
+            with pytest.raises(FileNotFoundError):
+                storage.get(storage_id)
+        assert storage.delete_many([]) == {}
+
+        # directory of a project and empty date directories are removed, a root of a storage stays
+        storage.remove_empty_dirs(storage_ids[:2])
+        assert not os.path.exists(storage._get_file_path(storage_ids[0].split('/')[0]))
+        assert os.path.isdir(test_app.config['FS_MEDIA_STORAGE_PATH'])
+
+
 @pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
 def test_fs_storage_delete_dir(test_app, filestreams):
     storage = FileSystemStorage()
@@ -201,3 +274,391 @@ def test_fs_storage_delete_dir(test_app, filestreams):
             storage.get(thumbn_0_storage_id)
 
         assert not os.path.exists(os.path.dirname(storage._get_file_path(storage_id)))
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_fs_storage_get_stream(test_app, filestreams):
+    storage = FileSystemStorage()
+    project_id = 'project_one'
+    mp4_stream = filestreams[0]
+    with test_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id=project_id,
+            asset_type='project'
+        )
+        chunks = list(storage.get_stream(storage_id, chunk_size=1000000))
+        assert [len(chunk) for chunk in chunks] == [1000000, 1000000, 617862]
+        assert b''.join(chunks) == mp4_stream
+
+        chunks = list(storage.get_stream(storage_id, start=200, length=1500000, chunk_size=1000000))
+        assert [len(chunk) for chunk in chunks] == [1000000, 500000]
+        assert b''.join(chunks) == mp4_stream[200:1500200]
+
+        chunks = list(storage.get_stream(storage_id, start=3000000, length=1000))
+        assert chunks == []
+
+        with pytest.raises(FileNotFoundError):
+            storage.get_stream(storage_id + '.random.png')
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_fs_storage_get_range_mmap(test_app, filestreams):
+    storage = FileSystemStorage()
+    project_id = 'project_one'
+    mp4_stream, jpg_stream_0 = filestreams
+    test_app.config['FS_MEDIA_STORAGE_MMAP'] = True
+    with test_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id=project_id,
+            asset_type='project'
+        )
+        filestream_range = storage.get_range(storage_id, 1000000, 1000000)
+        assert filestream_range.__class__ is bytes
+        assert filestream_range == mp4_stream[1000000:2000000]
+        assert storage._get_file_path(storage_id) in FileSystemStorage._mmaps
+
+        # ranged stream is read from the same map
+        chunks = list(storage.get_stream(storage_id, start=200, length=1500000, chunk_size=1000000))
+        assert [len(c) for c in chunks] == [1000000, 500000]
+        assert b''.join(chunks) == mp4_stream[200:1500200]
+        assert b''.join(storage.get_stream(storage_id, start=2000000)) == mp4_stream[2000000:]
+        assert list(storage.get_stream(storage_id, start=3000000, length=1000)) == []
+
+        filestream_range = storage.get_range(storage_id, 2000000, 1000000)
+        assert len(filestream_range) == 617862
+
+        filestream_range = storage.get_range(storage_id, 3000000, 1000000)
+        assert len(filestream_range) == 0
+
+        # map is dropped when file is replaced
+        storage.replace(content=jpg_stream_0, storage_id=storage_id)
+        filestream_range = storage.get_range(storage_id, 0, 1000000)
+        assert filestream_range == jpg_stream_0
+
+        storage.delete(storage_id)
+        assert storage._get_file_path(storage_id) not in FileSystemStorage._mmaps
+        with pytest.raises(FileNotFoundError):
+            storage.get_range(storage_id, 0, 1000000)
+        with pytest.raises(FileNotFoundError):
+            storage.get_stream(storage_id, start=0, length=1000000)
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_fs_storage_put_stream(test_app, filestreams):
+    storage = FileSystemStorage()
+    mp4_stream, jpg_stream_0 = filestreams
+    project_id = 'project_one'
+    test_app.config['MEDIA_STORAGE_CHUNK_SIZE'] = 1000
+    with test_app.app_context():
+        storage_id = storage.put_stream(
+            stream=BytesIO(mp4_stream),
+            filename='sample_video.mp4',
+            project_id=project_id,
+            asset_type='project'
+        )
+        thumbn_0_storage_id = storage.put_stream(
+            stream=BytesIO(jpg_stream_0),
+            filename='sample_1_image.jpg',
+            storage_id=storage_id,
+            asset_type='thumbnail'
+        )
+        assert storage.get(storage_id) == mp4_stream
+        assert storage.get(thumbn_0_storage_id) == jpg_stream_0
+
+        with pytest.raises(Exception):
+            storage.put_stream(
+                stream=BytesIO(jpg_stream_0),
+                filename='sample_1_image.jpg',
+                storage_id=storage_id,
+                asset_type='thumbnail',
+                override=False
+            )
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_fs_storage_replace_is_atomic(test_app, filestreams):
+    storage = FileSystemStorage()
+    mp4_stream, jpg_stream_0 = filestreams
+    project_id = 'project_one'
+    test_app.config['FS_MEDIA_STORAGE_FSYNC'] = 'full'
+    with test_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id=project_id,
+            asset_type='project'
+        )
+        # reader which started before replace gets a complete old file
+        chunks = storage.get_stream(storage_id, chunk_size=1000000)
+        first_chunk = next(chunks)
+        storage.replace(content=jpg_stream_0, storage_id=storage_id)
+        assert first_chunk + b''.join(chunks) == mp4_stream
+        assert storage.get(storage_id) == jpg_stream_0
+
+        # override existing file with put
+        storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id=project_id,
+            asset_type='project'
+        )
+        assert storage.get(storage_id) == mp4_stream
+        # no temporary files are left
+        assert not [f for f in os.listdir(os.path.dirname(storage._get_file_path(storage_id))) if f.endswith('.tmp')]
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_fs_storage_deduplicate(test_app, filestreams):
+    storage = FileSystemStorage()
+    mp4_stream, jpg_stream_0 = filestreams
+    test_app.config['FS_MEDIA_STORAGE_DEDUPLICATE'] = True
+    with test_app.app_context():
+        storage_id_0 = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+            asset_type='project'
+        )
+        storage_id_1 = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_two',
+            asset_type='project'
+        )
+        digest = hashlib.sha256(mp4_stream).hexdigest()
+        blob_path = storage._get_blob_path(digest)
+        # both storage ids point to the same blob
+        assert os.stat(storage._get_file_path(storage_id_0)).st_ino == os.stat(blob_path).st_ino
+        assert os.stat(storage._get_file_path(storage_id_1)).st_ino == os.stat(blob_path).st_ino
+        assert test_app.mongo.db.media_blobs.find_one({'_id': digest})['refs'] == 2
+
+        # replace releases an old blob
+        storage.replace(content=jpg_stream_0, storage_id=storage_id_0)
+        assert storage.get(storage_id_0) == jpg_stream_0
+        assert storage.get(storage_id_1) == mp4_stream
+        assert test_app.mongo.db.media_blobs.find_one({'_id': digest})['refs'] == 1
+
+        # blob is removed with the last reference
+        storage.delete_dir(storage_id_1)
+        assert test_app.mongo.db.media_blobs.find_one({'_id': digest}) is None
+        assert not os.path.exists(blob_path)
+
+        storage.delete(storage_id_0)
+        assert test_app.mongo.db.media_blobs.count_documents({}) == 0
+        assert test_app.mongo.db.media_blob_links.count_documents({}) == 0
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg',)], indirect=True)
+def test_fs_storage_deduplicate_failures(test_app, filestreams, monkeypatch):
+    storage = FileSystemStorage()
+    jpg_stream_0 = filestreams[0]
+    test_app.config['FS_MEDIA_STORAGE_DEDUPLICATE'] = True
+    digest = hashlib.sha256(jpg_stream_0).hexdigest()
+    with test_app.app_context():
+        storage_id_0 = storage.put(content=jpg_stream_0, filename='sample_0.jpg', project_id='project_one')
+        blob_path = storage._get_blob_path(digest)
+
+        # blob was removed by a concurrent release of its last reference
+        os.remove(blob_path)
+        storage_id_1 = storage.put(content=jpg_stream_0, filename='sample_0.jpg', project_id='project_two')
+        assert storage.get(storage_id_1) == jpg_stream_0
+        assert os.stat(storage._get_file_path(storage_id_1)).st_ino == os.stat(blob_path).st_ino
+        assert test_app.mongo.db.media_blobs.find_one({'_id': digest})['refs'] == 2
+
+        # reference is released when linking fails
+        def link(src, dst):
+            raise PermissionError(errno.EACCES, 'Permission denied')
+
+        monkeypatch.setattr(os, 'link', link)
+        with pytest.raises(OSError):
+            storage.put(content=jpg_stream_0, filename='sample_0.jpg', project_id='project_three')
+        monkeypatch.undo()
+        assert test_app.mongo.db.media_blobs.find_one({'_id': digest})['refs'] == 2
+        assert test_app.mongo.db.media_blob_links.count_documents({}) == 2
+
+        # blob has too many links, file is stored as a separate copy which is not tracked
+        def link(src, dst):
+            raise OSError(errno.EMLINK, 'Too many links')
+
+        monkeypatch.setattr(os, 'link', link)
+        storage_id_2 = storage.put(content=jpg_stream_0, filename='sample_0.jpg', project_id='project_three')
+        monkeypatch.undo()
+        assert storage.get(storage_id_2) == jpg_stream_0
+        assert os.stat(storage._get_file_path(storage_id_2)).st_ino != os.stat(blob_path).st_ino
+        assert test_app.mongo.db.media_blobs.find_one({'_id': digest})['refs'] == 2
+        assert test_app.mongo.db.media_blob_links.count_documents({}) == 2
+
+        storage.delete(storage_id_2)
+        assert os.path.exists(blob_path)
+        storage.delete(storage_id_0)
+        storage.delete(storage_id_1)
+        assert test_app.mongo.db.media_blobs.count_documents({}) == 0
+        assert not os.path.exists(blob_path)
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_fs_storage_copy(test_app, filestreams):
+    storage = FileSystemStorage()
+    mp4_stream, jpg_stream_0 = filestreams
+    with test_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+            asset_type='project'
+        )
+        thumbn_0_storage_id = storage.put(
+            content=jpg_stream_0,
+            filename='sample_1_image.jpg',
+            storage_id=storage_id,
+            asset_type='thumbnail'
+        )
+        copy_storage_id = storage.copy(
+            src_storage_id=storage_id,
+            dst_filename='sample_video_copy.mp4',
+            project_id='project_two',
+        )
+        thumbn_copy_storage_id = storage.copy(
+            src_storage_id=thumbn_0_storage_id,
+            dst_filename='sample_1_image.jpg',
+            storage_id=copy_storage_id,
+            asset_type='thumbnail'
+        )
+        assert copy_storage_id.endswith('/project_two/sample_video_copy.mp4')
+        assert storage.get(copy_storage_id) == mp4_stream
+        assert storage.get(thumbn_copy_storage_id) == jpg_stream_0
+
+        # copy is independent from an original
+        storage.replace(content=jpg_stream_0, storage_id=storage_id)
+        assert storage.get(copy_storage_id) == mp4_stream
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_fs_storage_copy_short_copy_file_range(test_app, filestreams, tmp_path, monkeypatch):
+    mp4_stream = filestreams[0]
+    src_path = tmp_path / 'src.mp4'
+    src_path.write_bytes(mp4_stream)
+
+    def short_copy_file_range(src, dst, count, *args):
+        # copies a part of a file, then reports nothing is left
+        if os.fstat(dst).st_size:
+            return 0
+        os.write(dst, os.pread(src, min(count, 1000), 0))
+        os.lseek(src, 1000, os.SEEK_SET)
+        return min(count, 1000)
+
+    monkeypatch.setattr(file_system_storage, 'fcntl', None)
+    monkeypatch.setattr(os, 'copy_file_range', short_copy_file_range, raising=False)
+    with test_app.app_context():
+        with open(tmp_path / 'dst.mp4', 'wb') as dst:
+            method = FileSystemStorage._copy_file_data(str(src_path), dst)
+
+    # destination is never truncated
+    assert method == 'chunked copy'
+    assert (tmp_path / 'dst.mp4').read_bytes() == mp4_stream
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_fs_storage_copy_deduplicate(test_app, filestreams):
+    storage = FileSystemStorage()
+    mp4_stream = filestreams[0]
+    test_app.config['FS_MEDIA_STORAGE_DEDUPLICATE'] = True
+    with test_app.app_context():
+        storage_id = storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+            asset_type='project'
+        )
+        copy_storage_id = storage.copy(
+            src_storage_id=storage_id,
+            dst_filename='sample_video.mp4',
+            project_id='project_two',
+        )
+        digest = hashlib.sha256(mp4_stream).hexdigest()
+        assert os.stat(storage._get_file_path(copy_storage_id)).st_ino == os.stat(
+            storage._get_file_path(storage_id)).st_ino
+        assert test_app.mongo.db.media_blobs.find_one({'_id': digest})['refs'] == 2
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_fs_storage_hash_layout_and_move_dir(test_app, filestreams):
+    storage = FileSystemStorage()
+    mp4_stream, jpg_stream_0 = filestreams
+    project_id = 'project_one'
+    with test_app.app_context():
+        date_storage_id = storage.put(content=mp4_stream, filename='sample_video.mp4', project_id=project_id)
+
+        test_app.config['MEDIA_STORAGE_LAYOUT'] = 'hash'
+        digest = hashlib.sha1(project_id.encode()).hexdigest()
+        hash_dir = f'{digest[:2]}/{digest[2:4]}/{project_id}'
+        assert storage.generate_project_dir(project_id) == hash_dir
+        # thumbnails stay in a directory of a project
+        thumbnail_storage_id = storage.put(
+            content=jpg_stream_0,
+            filename='sample_0.jpg',
+            storage_id=date_storage_id,
+            asset_type='thumbnails'
+        )
+        assert thumbnail_storage_id.startswith(os.path.dirname(date_storage_id) + '/')
+        # old storage ids keep resolving
+        assert storage.get(date_storage_id) == mp4_stream
+
+        storage.move_dir(os.path.dirname(date_storage_id), hash_dir)
+        assert storage.get(f'{hash_dir}/sample_video.mp4') == mp4_stream
+        assert storage.get(f'{hash_dir}/thumbnails/sample_0.jpg') == jpg_stream_0
+        # empty date directories are removed
+        assert not os.path.exists(storage._get_file_path(date_storage_id.split('/')[0]))
+        # interrupted move can be repeated
+        storage.move_dir(os.path.dirname(date_storage_id), hash_dir)
+        with pytest.raises(FileNotFoundError):
+            storage.move_dir('2000/1/1/project_two', 'ab/cd/project_two')
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg',)], indirect=True)
+def test_fs_storage_volumes(test_app, filestreams, monkeypatch):
+    storage = FileSystemStorage()
+    jpg_stream_0 = filestreams[0]
+    media_path = os.path.dirname(test_app.config['FS_MEDIA_STORAGE_PATH'])
+    # volumes which don't exist (i.e. not mounted disks) are not used
+    os.makedirs(os.path.join(media_path, 'vol_a'))
+    os.makedirs(os.path.join(media_path, 'vol_b'))
+    test_app.config['FS_MEDIA_STORAGE_VOLUMES'] = (
+        f"vol_a:{os.path.join(media_path, 'vol_a')}:1,vol_b:{os.path.join(media_path, 'vol_b')}:3"
+    )
+    with test_app.app_context():
+        storage_ids = [
+            storage.put(content=jpg_stream_0, filename='sample_0.jpg', project_id=f'project_{i}')
+            for i in range(100)
+        ]
+        volumes = [storage_id.split('/', 1)[0] for storage_id in storage_ids]
+        # projects are spread according to volumes' weights
+        assert 10 < volumes.count('vol_a') < volumes.count('vol_b')
+        assert volumes.count('vol_a') + volumes.count('vol_b') == 100
+        assert os.path.exists(os.path.join(media_path, volumes[0], storage_ids[0].split('/', 1)[1]))
+        assert storage.get(storage_ids[0]) == jpg_stream_0
+        # placement is stable
+        assert storage.choose_volume('project_0') == volumes[0]
+
+        storage.delete_dir(storage_ids[0])
+        with pytest.raises(FileNotFoundError):
+            storage.get(storage_ids[0])
+
+        # full volume is skipped
+        usage = shutil.disk_usage(media_path)
+        monkeypatch.setattr(shutil, 'disk_usage', lambda path: usage._replace(free=0 if 'vol_b' in path else 1))
+        test_app.config['FS_MEDIA_STORAGE_VOLUME_MIN_FREE'] = 1
+        assert {storage.choose_volume(f'project_{i}') for i in range(100)} == {'vol_a'}
+
+        # storage ids without a volume are located in `FS_MEDIA_STORAGE_PATH`
+        assert storage._get_file_path('2019/1/1/project/sample_0.jpg') == os.path.join(
+            test_app.config['FS_MEDIA_STORAGE_PATH'], '2019/1/1/project/sample_0.jpg'
+        )
+
+        test_app.config['FS_MEDIA_STORAGE_VOLUMES'] = 'ab:/tmp/ab'
+        with pytest.raises(ValueError):
+            storage.get(storage_ids[1])
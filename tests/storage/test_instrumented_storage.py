@@ -0,0 +1,71 @@
+import pytest
+
+from videoserver.lib.storage import InstrumentedStorage, find_storage
+from videoserver.lib.storage.file_system_storage import FileSystemStorage
+from videoserver.lib.storage.memory_caching_storage import MemoryCachingStorage
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_instrumented_storage(test_app, filestreams):
+    storage = InstrumentedStorage(FileSystemStorage())
+    mp4_stream, jpg_stream = filestreams
+
+    with test_app.app_context():
+        video_storage_id = storage.put(content=mp4_stream, filename='sample_video.mp4', project_id='project_one')
+        thumbnail_storage_id = storage.put(
+            content=jpg_stream,
+            filename='sample_0.jpg',
+            asset_type='thumbnails',
+            storage_id=video_storage_id,
+        )
+        assert storage.get(thumbnail_storage_id) == jpg_stream
+        assert storage.get_range(video_storage_id, 10, 100) == mp4_stream[10:110]
+        assert b''.join(storage.get_stream(video_storage_id, start=10)) == mp4_stream[10:]
+        storage.replace(jpg_stream, thumbnail_storage_id)
+        storage.delete(thumbnail_storage_id)
+        with pytest.raises(FileNotFoundError):
+            storage.get(thumbnail_storage_id)
+
+        stats = storage.get_stats()
+        assert stats['backend'] == 'FileSystemStorage'
+        methods = stats['methods']
+        assert methods['put']['video']['bytes'] == len(mp4_stream)
+        assert methods['put']['thumbnails']['bytes'] == len(jpg_stream)
+        assert methods['get_range']['video']['bytes'] == 100
+        assert methods['get_stream']['video']['bytes'] == len(mp4_stream) - 10
+        assert methods['replace']['thumbnails']['count'] == 1
+        assert methods['delete']['thumbnails']['count'] == 1
+        assert methods['get']['thumbnails']['count'] == 2
+        assert methods['get']['thumbnails']['errors'] == 1
+        assert methods['get']['thumbnails']['bytes'] == len(jpg_stream)
+        assert sum(methods['get']['thumbnails']['histogram']) == 2
+
+        metrics = storage.export_prometheus()
+        labels = 'method="get",asset_type="thumbnails",backend="FileSystemStorage"'
+        assert f'videoserver_storage_calls_total{{{labels}}} 2' in metrics
+        assert f'videoserver_storage_latency_seconds_bucket{{{labels},le="+Inf"}} 2' in metrics
+
+        # instrumented storage can be found behind caches
+        assert find_storage(MemoryCachingStorage(storage), InstrumentedStorage) is storage
+        assert find_storage(storage.storage, InstrumentedStorage) is None
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg',)], indirect=True)
+def test_storage_metrics(test_app, client, filestreams):
+    test_app.fs = FileSystemStorage()
+    resp = client.get('/storage/metrics')
+    assert resp.status == '404 NOT FOUND'
+
+    test_app.fs = InstrumentedStorage(FileSystemStorage())
+    resp = client.get('/storage/metrics')
+    assert resp.status == '200 OK'
+    assert resp.mimetype == 'text/plain'
+
+    # cache hits are exported along with backend metrics
+    test_app.fs = MemoryCachingStorage(InstrumentedStorage(FileSystemStorage()))
+    storage_id = test_app.fs.put(content=filestreams[0], filename='sample_0.jpg', project_id='project_one')
+    assert test_app.fs.get(storage_id) == filestreams[0]
+    metrics = client.get('/storage/metrics').get_data(as_text=True)
+    assert 'videoserver_storage_memory_cache_hits_total 1' in metrics
+    assert f'videoserver_storage_memory_cache_size_bytes {len(filestreams[0])}' in metrics
+    assert 'videoserver_storage_calls_total{method="put",asset_type="video",backend="FileSystemStorage"} 1' in metrics
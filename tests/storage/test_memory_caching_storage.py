@@ -0,0 +1,69 @@
+import pytest
+
+from videoserver.lib.storage.file_system_storage import FileSystemStorage
+from videoserver.lib.storage.memory_caching_storage import MemoryCachingStorage
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg', 'sample_1.jpg')], indirect=True)
+def test_memory_caching_storage(test_app, filestreams):
+    storage = MemoryCachingStorage(FileSystemStorage())
+    mp4_stream, jpg_stream_0, jpg_stream_1 = filestreams
+    test_app.config['MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE'] = len(mp4_stream)
+
+    with test_app.app_context():
+        video_storage_id = storage.storage.put(
+            content=mp4_stream,
+            filename='sample_video.mp4',
+            project_id='project_one',
+        )
+        thumbnail_storage_id = storage.storage.put(
+            content=jpg_stream_0,
+            filename='sample_0.jpg',
+            asset_type='thumbnails',
+            storage_id=video_storage_id,
+        )
+
+        # videos are replaced in place by other processes, so they are never cached
+        assert b''.join(storage.get_stream(video_storage_id)) == mp4_stream
+        assert storage.get(video_storage_id) == mp4_stream
+        assert storage.get_stats()['items'] == 0
+
+        # big files are not cached
+        test_app.config['MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE'] = len(jpg_stream_0) - 1
+        assert b''.join(storage.get_stream(thumbnail_storage_id)) == jpg_stream_0
+        assert storage.get_stats()['items'] == 0
+        test_app.config['MEDIA_STORAGE_MEMORY_CACHE_MAX_ITEM_SIZE'] = len(mp4_stream)
+
+        assert b''.join(storage.get_stream(thumbnail_storage_id)) == jpg_stream_0
+        assert storage.get_stats()['items'] == 1
+        # cached file is served without reading a storage
+        storage.storage.delete(thumbnail_storage_id)
+        assert b''.join(storage.get_stream(thumbnail_storage_id)) == jpg_stream_0
+        assert storage.get_range(thumbnail_storage_id, 10, 20) == jpg_stream_0[10:30]
+        stats = storage.get_stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 2
+        assert stats['size'] == len(jpg_stream_0)
+
+        # invalidated on delete
+        storage.delete(video_storage_id)
+        storage.delete(thumbnail_storage_id)
+        assert storage.get_stats()['items'] == 0
+        with pytest.raises(FileNotFoundError):
+            storage.get(thumbnail_storage_id)
+
+        # bounded by size
+        test_app.config['MEDIA_STORAGE_MEMORY_CACHE_SIZE'] = len(jpg_stream_0) + len(jpg_stream_1) - 1
+        storage_id_0 = storage.put(content=jpg_stream_0, filename='sample_0.jpg', asset_type='thumbnails',
+                                   storage_id=video_storage_id)
+        storage_id_1 = storage.put(content=jpg_stream_1, filename='sample_1.jpg', asset_type='thumbnails',
+                                   storage_id=video_storage_id)
+        assert storage.get_stats()['evictions'] == 1
+        assert storage._get_cached(storage_id_0) is None
+        assert storage.get(storage_id_1) == jpg_stream_1
+
+        # invalidated on replace and delete_dir
+        storage.replace(content=jpg_stream_0, storage_id=storage_id_1)
+        assert storage.get(storage_id_1) == jpg_stream_0
+        storage.delete_dir(storage_id_1)
+        assert storage.get_stats()['items'] == 0
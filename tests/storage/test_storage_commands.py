@@ -0,0 +1,268 @@
+import os
+import time
+from datetime import datetime
+
+import bson
+import pytest
+
+from videoserver.apps.storage import commands
+from videoserver.lib.storage.file_system_storage import FileSystemStorage
+
+
+def _wait_cutoff(monkeypatch, grace_period=24):
+    """
+    Make gc's grace period end now, so files written before are old and files written after are new.
+    """
+
+    time.sleep(0.05)
+    cutoff = time.time()
+    time.sleep(0.05)
+    monkeypatch.setattr(commands, 'time', lambda: cutoff + grace_period * 3600)
+    return cutoff
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_migrate_layout(test_app, filestreams):
+    storage = FileSystemStorage()
+    mp4_stream, jpg_stream_0 = filestreams
+    runner = test_app.test_cli_runner()
+
+    with test_app.app_context():
+        project_id = bson.ObjectId()
+        storage_id = storage.put(content=mp4_stream, filename='sample_video.mp4', project_id=project_id)
+        thumbnail_storage_id = storage.put(
+            content=jpg_stream_0,
+            filename='sample_0.jpg',
+            storage_id=storage_id,
+            asset_type='thumbnails'
+        )
+        test_app.mongo.db.projects.insert_one({
+            '_id': project_id,
+            'storage_id': storage_id,
+            'create_time': datetime.utcnow(),
+            'processing': {'video': False, 'thumbnail_preview': False, 'thumbnails_timeline': False},
+            'thumbnails': {
+                'timeline': [{'storage_id': thumbnail_storage_id}],
+                'preview': {'storage_id': thumbnail_storage_id},
+            }
+        })
+        # duplicate which is being copied and a failed upload have no file yet
+        test_app.mongo.db.projects.insert_many([
+            {
+                '_id': bson.ObjectId(),
+                'processing': {'video': True, 'thumbnail_preview': False, 'thumbnails_timeline': False},
+                'thumbnails': {'timeline': [], 'preview': None},
+            },
+            {
+                '_id': bson.ObjectId(),
+                'storage_id': None,
+                'processing': {'video': False, 'thumbnail_preview': False, 'thumbnails_timeline': False},
+                'thumbnails': {'timeline': [], 'preview': None},
+            },
+        ])
+
+    result = runner.invoke(args=['storage', 'migrate-layout', '--layout', 'hash', '--dry-run'])
+    assert result.exit_code == 0
+    assert '1 projects would be moved' in result.output
+
+    result = runner.invoke(args=['storage', 'migrate-layout', '--layout', 'hash', '--workers', '2'])
+    assert result.exit_code == 0, result.output
+    assert '1 projects were moved to "hash" layout, 0 failed, 0 skipped' in result.output
+
+    with test_app.app_context():
+        project = test_app.mongo.db.projects.find_one({'_id': project_id})
+        hash_dir = storage.generate_project_dir(project_id, layout='hash')
+        assert project['storage_id'] == f'{hash_dir}/sample_video.mp4'
+        assert project['thumbnails']['timeline'][0]['storage_id'] == f'{hash_dir}/thumbnails/sample_0.jpg'
+        assert project['thumbnails']['preview']['storage_id'] == f'{hash_dir}/thumbnails/sample_0.jpg'
+        assert storage.get(project['storage_id']) == mp4_stream
+        assert not os.path.exists(storage._get_file_path(os.path.dirname(storage_id)))
+
+    # nothing to do when projects are already migrated
+    result = runner.invoke(args=['storage', 'migrate-layout', '--layout', 'hash'])
+    assert '0 projects were moved' in result.output
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_migrate_layout_project_changed(test_app, filestreams, monkeypatch):
+    storage = FileSystemStorage()
+    runner = test_app.test_cli_runner()
+
+    with test_app.app_context():
+        project_id = bson.ObjectId()
+        storage_id = storage.put(content=filestreams[0], filename='sample_video.mp4', project_id=project_id)
+        test_app.mongo.db.projects.insert_one({
+            '_id': project_id,
+            'storage_id': storage_id,
+            'create_time': datetime.utcnow(),
+            'processing': {'video': False, 'thumbnail_preview': False, 'thumbnails_timeline': False},
+            'thumbnails': {'timeline': [], 'preview': None},
+        })
+
+    move_dir = FileSystemStorage.move_dir
+
+    def move_and_change(self, src_dir, dst_dir):
+        move_dir(self, src_dir, dst_dir)
+        if src_dir == os.path.dirname(storage_id):
+            # project is edited while its directory is being moved
+            test_app.mongo.db.projects.update_one(
+                {'_id': project_id}, {'$set': {'storage_id': f'{src_dir}/edited.mp4'}}
+            )
+
+    monkeypatch.setattr(FileSystemStorage, 'move_dir', move_and_change)
+    result = runner.invoke(args=['storage', 'migrate-layout', '--layout', 'hash'])
+    assert result.exit_code != 0
+    assert 'files were moved back' in result.output
+    assert '0 projects were moved to "hash" layout, 1 failed, 0 skipped' in result.output
+
+    with test_app.app_context():
+        assert storage.get(storage_id) == filestreams[0]
+        hash_dir = storage.generate_project_dir(project_id, layout='hash')
+        assert not os.path.exists(storage._get_file_path(hash_dir))
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg',)], indirect=True)
+def test_rebalance(test_app, filestreams):
+    storage = FileSystemStorage()
+    runner = test_app.test_cli_runner()
+    media_path = os.path.dirname(test_app.config['FS_MEDIA_STORAGE_PATH'])
+    vol_a = f"vol_a:{os.path.join(media_path, 'vol_a')}"
+    vol_b = f"vol_b:{os.path.join(media_path, 'vol_b')}"
+    os.makedirs(os.path.join(media_path, 'vol_a'))
+    os.makedirs(os.path.join(media_path, 'vol_b'))
+    test_app.config['FS_MEDIA_STORAGE_VOLUMES'] = vol_a
+
+    with test_app.app_context():
+        project_ids = []
+        for _ in range(20):
+            project_id = bson.ObjectId()
+            storage_id = storage.put(content=filestreams[0], filename='sample_0.jpg', project_id=project_id)
+            assert storage_id.startswith('vol_a/')
+            test_app.mongo.db.projects.insert_one({
+                '_id': project_id,
+                'storage_id': storage_id,
+                'processing': {'video': False, 'thumbnail_preview': False, 'thumbnails_timeline': False},
+                'thumbnails': {'timeline': [], 'preview': {}}
+            })
+            project_ids.append(project_id)
+        # duplicate which is being copied has no file yet
+        test_app.mongo.db.projects.insert_one({
+            '_id': bson.ObjectId(),
+            'processing': {'video': True, 'thumbnail_preview': False, 'thumbnails_timeline': False},
+            'thumbnails': {'timeline': [], 'preview': None},
+        })
+
+    # new volume is added
+    test_app.config['FS_MEDIA_STORAGE_VOLUMES'] = f'{vol_a},{vol_b}'
+    result = runner.invoke(args=['storage', 'rebalance'])
+    assert result.exit_code == 0, result.output
+    assert '0 failed, 0 skipped' in result.output
+
+    with test_app.app_context():
+        volumes = []
+        for project_id in project_ids:
+            project = test_app.mongo.db.projects.find_one({'_id': project_id})
+            volume = project['storage_id'].split('/', 1)[0]
+            assert volume == storage.choose_volume(project_id)
+            assert storage.get(project['storage_id']) == filestreams[0]
+            volumes.append(volume)
+        assert 'vol_b' in volumes and 'vol_a' in volumes
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4', 'sample_0.jpg')], indirect=True)
+def test_gc(test_app, filestreams, monkeypatch):
+    storage = FileSystemStorage()
+    mp4_stream, jpg_stream_0 = filestreams
+    runner = test_app.test_cli_runner()
+
+    with test_app.app_context():
+        project_id = bson.ObjectId()
+        storage_id = storage.put(content=mp4_stream, filename='sample_video.mp4', project_id=project_id)
+        thumbnail_storage_id = storage.put(
+            content=jpg_stream_0,
+            filename='sample_0.jpg',
+            storage_id=storage_id,
+            asset_type='thumbnails'
+        )
+        orphan_thumbnail_storage_id = storage.put(
+            content=jpg_stream_0,
+            filename='sample_1.jpg',
+            storage_id=storage_id,
+            asset_type='thumbnails'
+        )
+        orphan_storage_id = storage.put(content=mp4_stream, filename='sample_video.mp4', project_id=bson.ObjectId())
+        # ctime can't be set, so grace period ends right after files above were written
+        cutoff = _wait_cutoff(monkeypatch)
+        new_orphan_storage_id = storage.put(content=mp4_stream, filename='new.mp4', project_id=bson.ObjectId())
+        test_app.mongo.db.projects.insert_one({
+            '_id': project_id,
+            'storage_id': storage_id,
+            'processing': {'video': False, 'thumbnail_preview': False, 'thumbnails_timeline': False},
+            'thumbnails': {
+                'timeline': [{'storage_id': thumbnail_storage_id}],
+                'preview': None,
+            }
+        })
+        # file with an old mtime is kept when it was written inside a grace period
+        old = cutoff - 24 * 3600
+        os.utime(storage.get_local_path(new_orphan_storage_id), (old, old))
+
+    result = runner.invoke(args=['storage', 'gc', '--dry-run'])
+    assert result.exit_code == 0, result.output
+    assert orphan_storage_id in result.output
+    assert orphan_thumbnail_storage_id in result.output
+    assert new_orphan_storage_id not in result.output
+    assert '2 orphan files' in result.output
+
+    result = runner.invoke(args=['storage', 'gc', '--batch-size', '1', '--workers', '2'])
+    assert result.exit_code == 0, result.output
+    assert f'2 orphan files ({len(mp4_stream) + len(jpg_stream_0)} bytes) were removed, 0 failed' in result.output
+
+    with test_app.app_context():
+        assert storage.get(storage_id) == mp4_stream
+        assert storage.get(thumbnail_storage_id) == jpg_stream_0
+        assert storage.get(new_orphan_storage_id) == mp4_stream
+        assert not os.path.exists(storage.get_local_path(orphan_thumbnail_storage_id))
+        # empty directory of an orphan project is removed
+        assert not os.path.exists(os.path.dirname(storage.get_local_path(orphan_storage_id)))
+
+        # nothing is removed if db is empty
+        test_app.mongo.db.projects.drop()
+    result = runner.invoke(args=['storage', 'gc'])
+    assert result.exit_code != 0
+    assert 'No projects were found' in result.output
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.jpg',)], indirect=True)
+def test_gc_deduplicated(test_app, filestreams, monkeypatch):
+    storage = FileSystemStorage()
+    runner = test_app.test_cli_runner()
+    test_app.config['FS_MEDIA_STORAGE_DEDUPLICATE'] = True
+
+    with test_app.app_context():
+        project_id = bson.ObjectId()
+        storage_id = storage.put(content=filestreams[0], filename='sample_0.jpg', project_id=project_id)
+        test_app.mongo.db.projects.insert_one({
+            '_id': project_id,
+            'storage_id': storage_id,
+            'processing': {'video': False, 'thumbnail_preview': False, 'thumbnails_timeline': False},
+            'thumbnails': {'timeline': [], 'preview': None}
+        })
+        # blob was written long ago
+        old = time.time() - 2 * 24 * 3600
+        os.utime(storage.get_local_path(storage_id), (old, old))
+        _wait_cutoff(monkeypatch)
+
+        # upload which is not in db yet is a hard link to an old blob
+        new_storage_id = storage.put(content=filestreams[0], filename='sample_0.jpg', project_id=bson.ObjectId())
+        assert os.stat(storage.get_local_path(new_storage_id)).st_mtime < old + 1
+
+    result = runner.invoke(args=['storage', 'gc', '--dry-run'])
+    assert result.exit_code == 0, result.output
+    assert new_storage_id not in result.output
+    assert '0 orphan files' in result.output
+
+    result = runner.invoke(args=['storage', 'gc'])
+    assert result.exit_code == 0, result.output
+    with test_app.app_context():
+        assert storage.get(new_storage_id) == filestreams[0]
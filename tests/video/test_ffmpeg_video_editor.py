@@ -1,3 +1,6 @@
+import math
+from fractions import Fraction
+
 import pytest
 
 from videoserver.lib.video_editor.ffmpeg import FFMPEGVideoEditor
@@ -23,6 +26,87 @@ def test_ffmpeg_video_editor_trim(test_app, filestreams):
         assert metadata['duration'] == 3.0
 
 
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_ffmpeg_video_editor_trim_seek(test_app, filestreams):
+    editor = FFMPEGVideoEditor()
+    mp4_stream = filestreams[0]
+
+    with test_app.app_context():
+        metadata = {}
+        for seek in ('input', 'output'):
+            test_app.config['FFMPEG_TRIM_SEEK'] = seek
+            _, metadata[seek] = editor.edit_video(
+                stream_file=mp4_stream,
+                filename='test_ffmpeg_video_editor_sample.mp4',
+                trim={'start': 5, 'end': 9}
+            )
+        # input seeking returns the same frames
+        assert metadata['input']['duration'] == metadata['output']['duration'] == 4.0
+        assert metadata['input']['nb_frames'] == metadata['output']['nb_frames']
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_ffmpeg_video_editor_smart_trim(test_app, filestreams, tmp_path):
+    editor = FFMPEGVideoEditor()
+    mp4_stream = filestreams[0]
+
+    with test_app.app_context():
+        metadata = {}
+        start_times = {}
+        for smart_trim in (True, False):
+            test_app.config['FFMPEG_SMART_TRIM'] = smart_trim
+            content, metadata[smart_trim] = editor.edit_video(
+                stream_file=mp4_stream,
+                filename='test_ffmpeg_video_editor_sample.mp4',
+                trim={'start': 1.5, 'end': 11.5}
+            )
+            path = tmp_path / f'trimmed_{smart_trim}.mp4'
+            path.write_bytes(content)
+            output = editor._run((
+                'ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,start_time', '-of', 'csv=p=0', str(path)
+            ))
+            start_times[smart_trim] = dict(line.split(',') for line in output.decode().split())
+        # partial GOPs are re-encoded, the rest is copied, the result is accurate to a frame
+        assert metadata[True]['duration'] == metadata[False]['duration'] == 10.0
+        # no frame is duplicated or dropped at joins
+        assert metadata[True]['nb_frames'] == metadata[False]['nb_frames']
+        assert metadata[True]['codec_name'] == metadata[False]['codec_name']
+        # audio and video are kept in sync
+        frame_duration = float(1 / Fraction(metadata[False]['r_frame_rate']))
+        assert start_times[True].keys() == start_times[False].keys()
+        for codec_type, start_time in start_times[True].items():
+            assert abs(float(start_time) - float(start_times[False][codec_type])) < frame_duration
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_ffmpeg_video_editor_smart_trim_rotated(test_app, filestreams, tmp_path):
+    editor = FFMPEGVideoEditor()
+    path_source = tmp_path / 'sample.mp4'
+    path_source.write_bytes(filestreams[0])
+    path_rotated = tmp_path / 'rotated.mp4'
+    # phone videos keep a rotation in metadata
+    editor._run((
+        'ffmpeg', '-loglevel', 'error', '-i', str(path_source), '-c', 'copy', '-metadata:s:v:0', 'rotate=90',
+        str(path_rotated)
+    ))
+    source = editor._get_meta(str(path_source))
+
+    with test_app.app_context():
+        assert editor._probe_video_stream(str(path_rotated))['rotation']
+        metadata = {}
+        for smart_trim in (True, False):
+            test_app.config['FFMPEG_SMART_TRIM'] = smart_trim
+            _, metadata[smart_trim] = editor.edit_video(
+                stream_file=path_rotated.read_bytes(),
+                filename='test_ffmpeg_video_editor_rotated.mp4',
+                trim={'start': 1.5, 'end': 11.5}
+            )
+        # the whole video is rotated, orientation doesn't change in the middle
+        assert metadata[True]['width'] == metadata[False]['width'] == source['height']
+        assert metadata[True]['height'] == metadata[False]['height'] == source['width']
+        assert metadata[True]['nb_frames'] == metadata[False]['nb_frames']
+
+
 @pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
 def test_ffmpeg_video_editor_crop(test_app, filestreams):
     editor = FFMPEGVideoEditor()
@@ -114,6 +198,28 @@ def test_ffmpeg_video_editor_capture_timeline_thumbnails(test_app, filestreams):
             assert meta['mimetype'] == 'image/png'
             assert meta['width'] == 89
             assert meta['height'] == 50
+            assert meta['size'] == len(thumbnail)
+        # exactly the requested amount is captured
+        assert i == 9
+
+
+@pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
+def test_ffmpeg_video_editor_capture_dense_timeline_thumbnails(test_app, filestreams):
+    editor = FFMPEGVideoEditor()
+    mp4_stream = filestreams[0]
+
+    with test_app.app_context():
+        filename = 'test_ffmpeg_video_editor_sample.mp4'
+        content, metadata = editor.edit_video(stream_file=mp4_stream, filename=filename, trim={'start': 0, 'end': 2})
+        # positions are closer to each other than frames
+        amount = 2 * math.ceil(Fraction(metadata['r_frame_rate'])) + 1
+        thumbnails = [thumbnail for thumbnail, _ in editor.capture_timeline_thumbnails(content, filename, 2, amount)]
+
+        # the same frames as seeking to every position gives
+        test_app.config['TIMELINE_THUMBNAILS_SEEK_DURATION'] = 0
+        seeked = [thumbnail for thumbnail, _ in editor.capture_timeline_thumbnails(content, filename, 2, amount)]
+        assert len(thumbnails) == amount
+        assert thumbnails == seeked
 
 
 @pytest.mark.parametrize('filestreams', [('sample_0.mp4',)], indirect=True)
@@ -137,3 +243,47 @@ def test_ffmpeg_video_editor_capture_thumbnail(test_app, filestreams):
         assert meta['mimetype'] == 'image/png'
         assert meta['width'] == 360
         assert meta['height'] == 720
+
+
+def test_ffmpeg_video_editor_capture_workers(test_app, tmp_path):
+    editor = FFMPEGVideoEditor()
+    path_video = tmp_path / 'video.mp4'
+    # 1 Mbit/s for an hour
+    with open(path_video, 'wb') as f:
+        f.truncate(450 * 1000 * 1000)
+
+    with test_app.app_context():
+        test_app.config['FFMPEG_THREADS'] = '8'
+        test_app.config['TIMELINE_THUMBNAILS_WORKERS'] = 0
+        test_app.config['TIMELINE_THUMBNAILS_PARALLEL_DURATION'] = 1800
+        test_app.config['TIMELINE_THUMBNAILS_PARALLEL_BITRATE'] = 20 * 1000 * 1000
+        # long video
+        assert editor._get_capture_workers(str(path_video), 40, 3600) == (8, 1)
+        # too few thumbnails to split
+        assert editor._get_capture_workers(str(path_video), 10, 3600) == (3, 2)
+        assert editor._get_capture_workers(str(path_video), 4, 3600) == (1, 1)
+        # short video with a low bitrate
+        assert editor._get_capture_workers(str(path_video), 40, 600) == (1, 1)
+        # short video with a high bitrate
+        assert editor._get_capture_workers(str(path_video), 40, 60) == (8, 1)
+        # limited number of processes
+        test_app.config['TIMELINE_THUMBNAILS_WORKERS'] = 2
+        assert editor._get_capture_workers(str(path_video), 40, 3600) == (2, 4)
+
+
+def test_ffmpeg_video_editor_seek_capture_batches(test_app, monkeypatch):
+    editor = FFMPEGVideoEditor()
+    commands = []
+    monkeypatch.setattr(editor, '_run_capture', lambda cmd, paths: commands.append((cmd, paths)))
+    positions = list(range(20))
+    paths = [f'timeline_{i}.png' for i in positions]
+
+    with test_app.app_context():
+        editor._run_seek_capture('video.mp4', positions, paths, 1)
+
+    # a single command never opens more than `TIMELINE_THUMBNAILS_MAX_INPUTS` inputs
+    assert [len(batch) for _, batch in commands] == [8, 8, 4]
+    assert [path for _, batch in commands for path in batch] == paths
+    for cmd, batch in commands:
+        assert cmd.count('-i') == len(batch)
+        assert cmd.count('-threads') == len(batch)
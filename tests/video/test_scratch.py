@@ -0,0 +1,114 @@
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import pytest
+
+from videoserver.lib import scratch as scratch_module
+from videoserver.lib.scratch import ScratchSpaceError, scratch_dir, sweep_scratch
+
+
+@pytest.fixture(scope='function')
+def scratch_app(test_app):
+    media_path = os.path.dirname(test_app.config['FS_MEDIA_STORAGE_PATH'])
+    test_app.config['SCRATCH_PATH'] = os.path.join(media_path, 'scratch')
+    test_app.config['SCRATCH_TMPFS_PATH'] = os.path.join(media_path, 'tmpfs')
+    test_app.config['SCRATCH_TMPFS_THRESHOLD'] = 100
+    test_app.config['SCRATCH_QUOTA'] = 1000
+    test_app.config['SCRATCH_QUOTA_TIMEOUT'] = 0
+    return test_app
+
+
+def test_scratch_dir(scratch_app):
+    with scratch_app.app_context():
+        with scratch_dir(reserve=500) as scratch:
+            small_path = scratch.write('small.png', b'x' * 100)
+            big_path = scratch.write('big.mp4', b'x' * 101)
+            # small files are placed on tmpfs
+            assert small_path == os.path.join(scratch_app.config['SCRATCH_TMPFS_PATH'], scratch.name, 'small.png')
+            assert big_path == os.path.join(scratch_app.config['SCRATCH_PATH'], scratch.name, 'big.mp4')
+            assert scratch.get_path('../unknown.mp4') == os.path.join(scratch.path, 'unknown.mp4')
+
+            # quota is exceeded
+            with pytest.raises(ScratchSpaceError):
+                with scratch_dir(reserve=501):
+                    pass
+            with pytest.raises(ScratchSpaceError):
+                with scratch_dir(reserve=1001):
+                    pass
+
+        assert not os.path.exists(small_path)
+        assert not os.path.exists(big_path)
+        assert not os.path.exists(scratch.path)
+        with scratch_dir(reserve=1000):
+            pass
+
+
+def test_scratch_dir_waits_for_space(scratch_app, monkeypatch):
+    monkeypatch.setattr(scratch_module, 'QUOTA_POLL_INTERVAL', 0.05)
+    scratch_app.config['SCRATCH_QUOTA_TIMEOUT'] = 10
+    released = threading.Event()
+
+    def hold_space():
+        with scratch_app.app_context():
+            with scratch_dir(reserve=800):
+                released.wait()
+
+    thread = threading.Thread(target=hold_space)
+    thread.start()
+    with scratch_app.app_context():
+        while not os.path.isdir(scratch_app.config['SCRATCH_PATH']) or \
+                len(os.listdir(scratch_app.config['SCRATCH_PATH'])) < 2:
+            time.sleep(0.01)
+        threading.Timer(0.2, released.set).start()
+        started = time.monotonic()
+        with scratch_dir(reserve=800):
+            assert time.monotonic() - started >= 0.15
+    thread.join()
+
+
+def test_sweep_scratch(scratch_app):
+    dead_process = subprocess.Popen(['true'])
+    dead_process.wait()
+    hostname = socket.gethostname()
+    root = scratch_app.config['SCRATCH_PATH']
+    tmpfs_root = scratch_app.config['SCRATCH_TMPFS_PATH']
+    dead_dirs = [os.path.join(path, f'{hostname}-{dead_process.pid}-abc') for path in (root, tmpfs_root)]
+    live_dir = os.path.join(root, f'{hostname}-{os.getpid()}-abc')
+    other_host_dir = os.path.join(root, f'other-host-{os.getpid()}-abc')
+    old_dir = os.path.join(root, f'other-host-{os.getpid()}-def')
+    unknown_dir = os.path.join(root, 'unknown')
+    for path in dead_dirs + [live_dir, other_host_dir, old_dir, unknown_dir]:
+        os.makedirs(path)
+    old = time.time() - scratch_app.config['SCRATCH_STALE_AGE'] - 1
+    os.utime(old_dir, (old, old))
+
+    with scratch_app.app_context():
+        assert sweep_scratch() == 3
+
+    for path in dead_dirs + [old_dir]:
+        assert not os.path.exists(path)
+    for path in (live_dir, other_host_dir, unknown_dir):
+        assert os.path.exists(path)
+
+
+def test_scratch_dir_releases_space_of_dead_processes(scratch_app):
+    dead_process = subprocess.Popen(['true'])
+    dead_process.wait()
+    root = scratch_app.config['SCRATCH_PATH']
+    tmpfs_root = scratch_app.config['SCRATCH_TMPFS_PATH']
+    dead_dirs = [os.path.join(path, f'{socket.gethostname()}-{dead_process.pid}-abc') for path in (root, tmpfs_root)]
+    for path in dead_dirs:
+        os.makedirs(path)
+    # i.e. a worker was killed in the middle of a task
+    with open(os.path.join(dead_dirs[0], scratch_module.RESERVATION_FILENAME), 'w') as f:
+        f.write('1000')
+
+    with scratch_app.app_context():
+        with scratch_dir(reserve=1000):
+            pass
+
+    for path in dead_dirs:
+        assert not os.path.exists(path)